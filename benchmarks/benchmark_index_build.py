@@ -0,0 +1,67 @@
+__author__ = 'white'
+
+import sys
+import getopt
+import json
+import os
+import time
+from server.models import LineFile
+import multiprocessing
+from server.indexer import ReadlineIndexBuilder, ChunkedIndexBuilder
+
+
+# Compares the lines per second of the index builders on a text file,
+# for example one generated by tests/test_data/generate_big_test_file.py
+#
+# Run from the repository root:
+#   python -m benchmarks.benchmark_index_build text_file_path [num_of_lines_per_index_page] [num_of_index_workers]
+
+class CommandArgError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def benchmark(file_path, num_of_lines_per_index_page, index_builder, num_of_index_workers=1):
+    line_file = LineFile(file_path, num_of_lines_per_index_page, num_of_index_workers)
+    line_file.index_builder = index_builder
+    t1 = time.time()
+    line_file.buildIndex()
+    seconds = time.time() - t1
+    return {
+        "builder": index_builder.__name__ if num_of_index_workers == 1 else "ParallelIndexBuilder",
+        "num_of_index_workers": num_of_index_workers,
+        "num_lines": line_file.num_lines,
+        "seconds": round(seconds, 3),
+        "lines_per_second": int(line_file.num_lines / seconds) if seconds > 0 else None
+    }
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], [])
+
+        if len(args) < 1:
+            raise CommandArgError("Invalid args! Please enter: {0} {1} {2} {3}".format("python", "-m benchmarks.benchmark_index_build", "text_file_path", "[num_of_lines_per_index_page] [num_of_index_workers]"))
+
+        file_path = args[0]
+        if not os.path.isfile(file_path):
+            raise CommandArgError("The file %s doesn't exist!" % file_path)
+        num_of_lines_per_index_page = int(args[1]) if len(args) > 1 else 10000
+        num_of_index_workers = int(args[2]) if len(args) > 2 else multiprocessing.cpu_count()
+
+        result = []
+        for index_builder in (ReadlineIndexBuilder, ChunkedIndexBuilder):
+            result.append(benchmark(file_path, num_of_lines_per_index_page, index_builder))
+        if num_of_index_workers > 1:
+            result.append(benchmark(file_path, num_of_lines_per_index_page, ChunkedIndexBuilder, num_of_index_workers))
+        print json.dumps(result, indent=4)
+        return 0
+
+    except CommandArgError, err:
+        print err.msg
+        return -1
+
+if __name__ == "__main__":
+    sys.exit(main())
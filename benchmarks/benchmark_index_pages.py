@@ -0,0 +1,106 @@
+__author__ = 'white'
+
+import sys
+import getopt
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from server.index import IndexPageFile
+from server.indexer import ChunkedIndexBuilder
+
+
+# Compares the index page formats on the first page of a text file: the size of the page file, the time to load it
+# and the time of a lookup in a loaded page. The JSON pages of older versions, parsed in full on every load,
+# are timed with json.load as the baseline.
+#
+# Run from the repository root:
+#   python -m benchmarks.benchmark_index_pages text_file_path [num_of_lines_per_index_page] [num_of_lookups]
+
+page_formats = (("fixed", None), ("fixed", "zlib"), ("delta", None), ("delta", "zlib"))
+
+
+class CommandArgError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+# The offsets of the first page of the text file
+def first_page_offsets(file_path, num_of_lines_per_index_page):
+    offsets = [0]
+    with open(file_path, "rb") as text_file:
+        while len(offsets) <= num_of_lines_per_index_page:
+            chunk = text_file.read(1024 * 1024)
+            if not chunk:
+                break
+            offsets.extend(ChunkedIndexBuilder.find_boundaries(chunk, text_file.tell() - len(chunk)))
+    return offsets[:num_of_lines_per_index_page + 1]
+
+
+def time_calls(function, args_list):
+    t1 = time.time()
+    for args in args_list:
+        function(*args)
+    return (time.time() - t1) / len(args_list) * 1000000
+
+
+def benchmark(folder, offsets, num_of_lookups):
+    positions = [(random.randint(0, len(offsets) - 2),) for i in xrange(num_of_lookups)]
+    result = []
+
+    json_file_path = os.path.join(folder, "json_0.idx")
+    with open(json_file_path, "w") as index_file:
+        json.dump(offsets[:-1], index_file)
+    result.append({
+        "format": "json",
+        "page_bytes": os.path.getsize(json_file_path),
+        "load_us": round(time_calls(lambda: json.load(open(json_file_path)), [()] * 20), 1)
+    })
+
+    for encoding, compression in page_formats:
+        index_file_path = os.path.join(folder, "%s_%s_0.idx" % (encoding, compression))
+        IndexPageFile.write(index_file_path, offsets, "\0" * 16, encoding, compression)
+        index_page = IndexPageFile.load(index_file_path, 0)
+        result.append({
+            "format": encoding if compression is None else "%s+%s" % (encoding, compression),
+            "page_bytes": os.path.getsize(index_file_path),
+            "load_us": round(time_calls(lambda: IndexPageFile.load(index_file_path, 0).close(), [()] * 20), 1),
+            "lookup_us": round(time_calls(index_page.get_line_range, positions), 3)
+        })
+        index_page.close()
+    return result
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], [])
+
+        if len(args) < 1:
+            raise CommandArgError("Invalid args! Please enter: {0} {1} {2} {3}".format("python", "-m benchmarks.benchmark_index_pages", "text_file_path", "[num_of_lines_per_index_page] [num_of_lookups]"))
+
+        file_path = args[0]
+        if not os.path.isfile(file_path):
+            raise CommandArgError("The file %s doesn't exist!" % file_path)
+        num_of_lines_per_index_page = int(args[1]) if len(args) > 1 else 10000
+        num_of_lookups = int(args[2]) if len(args) > 2 else 100000
+
+        offsets = first_page_offsets(file_path, num_of_lines_per_index_page)
+        if len(offsets) < 2:
+            raise CommandArgError("The file %s has no lines!" % file_path)
+        folder = tempfile.mkdtemp()
+        try:
+            print json.dumps(benchmark(folder, offsets, num_of_lookups), indent=4)
+        finally:
+            shutil.rmtree(folder)
+        return 0
+
+    except CommandArgError, err:
+        print err.msg
+        return -1
+
+if __name__ == "__main__":
+    sys.exit(main())
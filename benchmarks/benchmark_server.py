@@ -0,0 +1,135 @@
+__author__ = 'white'
+
+import sys
+import getopt
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import time
+from server.server import Server
+from benchmarks.load_generator import LoadGenerator
+from configuration import settings as server_settings
+
+
+# Starts a line server on a text file with the settings of configuration.py, in every server mode and index page
+# encoding asked for, drives each one with the load generator and prints the reports as JSON, together with
+# the commit benchmarked, so runs on different commits can be compared.
+# A text file can be generated with benchmarks/generate_text_file.py.
+#
+# Run from the repository root:
+#   python -m benchmarks.benchmark_server [--modes=fork,event,prefork] [--index-page-encodings=fixed,delta]
+#       [--connections=n] [--duration=seconds] [--pattern=uniform|zipf|sequential] [--command=GET|MGET|STREAM]
+#       [--lines-per-request=n] [--pipeline=n] text_file_path
+
+class CommandArgError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def run_server(settings, text_file_path):
+    Server(settings, text_file_path).start()
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(text_file_path, server_mode, index_page_encoding, load_settings):
+    settings = dict(server_settings)
+    settings.update({
+        "host": "127.0.0.1",
+        "port": free_port(),
+        "control_port": free_port(),
+        "server_mode": server_mode,
+        "index_page_encoding": index_page_encoding
+    })
+    process = multiprocessing.Process(target=run_server, args=(settings, text_file_path))
+    process.start()
+    try:
+        load_settings = dict(load_settings)
+        load_settings.update({
+            "host": settings["host"],
+            "port": settings["port"],
+            "control_port": settings["control_port"],
+            "label": "%s/%s" % (server_mode, index_page_encoding)
+        })
+        load_generator = LoadGenerator(load_settings)
+        for i in range(500):
+            try:
+                load_generator.control("PROGRESS")
+                break
+            except socket.error:
+                time.sleep(0.01)
+        else:
+            raise Exception("The server did not start")
+        load_generator.wait_until_ready()
+        report = load_generator.run()
+        report["server_mode"] = server_mode
+        report["index_page_encoding"] = index_page_encoding
+        load_generator.control("SHUTDOWN")
+        process.join(10)
+        return report
+    finally:
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    load_options = [("connections", int), ("duration", float), ("pattern", str), ("command", str),
+                    ("lines-per-request", int), ("pipeline", int)]
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ["modes=", "index-page-encodings="] +
+                                       ["%s=" % name for name, value_type in load_options])
+        except getopt.GetoptError, err:
+            raise CommandArgError(str(err))
+
+        if len(args) < 1:
+            raise CommandArgError("Invalid args! Please enter: {0} {1} {2} {3}".format("python", "-m benchmarks.benchmark_server", "[--modes=fork,event,prefork] [--index-page-encodings=fixed,delta] [--connections=n] [--duration=seconds] [--pattern=uniform|zipf|sequential] [--command=GET|MGET|STREAM] [--lines-per-request=n] [--pipeline=n]", "text_file_path"))
+
+        text_file_path = os.path.abspath(args[0])
+        if not os.path.isfile(text_file_path):
+            raise CommandArgError("The file %s doesn't exist!" % text_file_path)
+        options = dict(opts)
+        modes = options.get("--modes", "fork,event,prefork").split(",")
+        index_page_encodings = options.get("--index-page-encodings", "fixed,delta").split(",")
+        value_types = dict(load_options)
+        load_settings = {}
+        for name, value in opts:
+            name = name[2:]
+            if name in value_types:
+                load_settings[name.replace("-", "_")] = value_types[name](value)
+        if "command" in load_settings:
+            load_settings["command"] = load_settings["command"].upper()
+
+        reports = []
+        for server_mode in modes:
+            for index_page_encoding in index_page_encodings:
+                reports.append(benchmark(text_file_path, server_mode, index_page_encoding, load_settings))
+        print json.dumps({"commit": current_commit(), "text_file_path": text_file_path, "reports": reports},
+                         indent=4, sort_keys=True)
+        return 0
+
+    except CommandArgError, err:
+        print err.msg
+        return -1
+
+if __name__ == "__main__":
+    sys.exit(main())
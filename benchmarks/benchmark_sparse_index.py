@@ -0,0 +1,88 @@
+__author__ = 'white'
+
+import sys
+import getopt
+import json
+import os
+import random
+import time
+from server.models import LineFile
+
+
+# Compares the index size and the GET latency of the sparse index mode for several checkpoint intervals,
+# on a text file such as one generated by tests/test_data/generate_big_test_file.py
+#
+# Run from the repository root:
+#   python -m benchmarks.benchmark_sparse_index text_file_path [num_of_lines_per_index_page] [num_of_gets]
+
+checkpoint_intervals = (1, 4, 16, 64, 256)
+
+
+class CommandArgError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+# The value below which the given fraction of the sorted values fall
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def benchmark(file_path, num_of_lines_per_index_page, checkpoint_interval, line_numbers):
+    line_file = LineFile(file_path, num_of_lines_per_index_page, index_checkpoint_interval=checkpoint_interval)
+    line_file.prepare_index()
+    index_folder = os.path.join(line_file.file_dir, "index")
+    index_size = sum(os.path.getsize(os.path.join(index_folder, name)) for name in os.listdir(index_folder)
+                     if name.startswith(line_file.file_path_hash) and name.endswith(".idx"))
+
+    # The first pass maps the index pages, the second one is timed
+    for line_no in line_numbers:
+        line_file.get_line(line_no)
+    latencies = []
+    for line_no in line_numbers:
+        t1 = time.time()
+        line_file.get_line(line_no)
+        latencies.append(time.time() - t1)
+    latencies.sort()
+    return {
+        "index_checkpoint_interval": checkpoint_interval,
+        "num_lines": line_file.num_lines,
+        "index_bytes": index_size,
+        "index_bytes_per_line": round(float(index_size) / line_file.num_lines, 3) if line_file.num_lines else None,
+        "get_p50_us": round(percentile(latencies, 0.5) * 1000000, 1),
+        "get_p99_us": round(percentile(latencies, 0.99) * 1000000, 1)
+    }
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], [])
+
+        if len(args) < 1:
+            raise CommandArgError("Invalid args! Please enter: {0} {1} {2} {3}".format("python", "-m benchmarks.benchmark_sparse_index", "text_file_path", "[num_of_lines_per_index_page] [num_of_gets]"))
+
+        file_path = args[0]
+        if not os.path.isfile(file_path):
+            raise CommandArgError("The file %s doesn't exist!" % file_path)
+        num_of_lines_per_index_page = int(args[1]) if len(args) > 1 else 10000
+        num_of_gets = int(args[2]) if len(args) > 2 else 100000
+
+        result = []
+        line_numbers = None
+        for checkpoint_interval in checkpoint_intervals:
+            if line_numbers is None:
+                line_file = LineFile(file_path, num_of_lines_per_index_page, index_checkpoint_interval=checkpoint_interval)
+                line_file.prepare_index()
+                line_numbers = [random.randint(1, max(line_file.num_lines, 1)) for i in xrange(num_of_gets)]
+            result.append(benchmark(file_path, num_of_lines_per_index_page, checkpoint_interval, line_numbers))
+        print json.dumps(result, indent=4)
+        return 0
+
+    except CommandArgError, err:
+        print err.msg
+        return -1
+
+if __name__ == "__main__":
+    sys.exit(main())
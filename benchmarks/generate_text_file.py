@@ -0,0 +1,163 @@
+__author__ = 'white'
+
+import sys
+import getopt
+import json
+import os
+import random
+import string
+import time
+
+
+# Generates a text file of random letters for benchmarks, of a number of lines or of a size in bytes.
+# Like tests/test_data/generate_big_test_file.py, but instead of choosing every character with random.choice,
+# lines are cut from a pool of random letters made with os.urandom, and written in blocks of about a megabyte.
+#
+# The length of a line (without its newline) is drawn from a distribution:
+#   "uniform"      between min_line_length and max_line_length
+#   "fixed"        always max_line_length
+#   "exponential"  exponentially distributed around mean_line_length, within min_line_length and max_line_length,
+#                  so most lines are short and a few are long
+#
+# Run from the repository root:
+#   python -m benchmarks.generate_text_file [--lines=n | --size=bytes] [--min-line-length=n] [--max-line-length=n]
+#       [--mean-line-length=n] [--distribution=uniform|fixed|exponential] [--seed=n] file_path
+
+class CommandArgError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class TextFileGenerator(object):
+
+    DISTRIBUTIONS = ("uniform", "fixed", "exponential")
+
+    # Maps every byte to a letter. 256 is not a multiple of 52, so the first letters are a little more frequent
+    LETTERS = "".join(string.ascii_letters[i % len(string.ascii_letters)] for i in range(256))
+
+    POOL_SIZE = 1024 * 1024
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, min_line_length=1, max_line_length=100, mean_line_length=None, distribution="uniform", seed=None):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError("Unknown line length distribution %s" % distribution)
+        if not 0 <= min_line_length <= max_line_length:
+            raise ValueError("Invalid line lengths %d-%d" % (min_line_length, max_line_length))
+        self.min_line_length = min_line_length
+        self.max_line_length = max_line_length
+        self.mean_line_length = mean_line_length or (min_line_length + max_line_length) / 2.0
+        self.distribution = distribution
+        self.random = random.Random(seed)
+        # The pool holds its letters twice, so a line of up to max_line_length starting anywhere in the first copy
+        # is cut with one slice
+        pool_size = max(self.POOL_SIZE, max_line_length)
+        letters = os.urandom(pool_size).translate(self.LETTERS) if seed is None else \
+            "".join(chr(self.random.getrandbits(8)) for i in xrange(pool_size)).translate(self.LETTERS)
+        self.pool_size = pool_size
+        self.pool = letters + letters
+
+    # A function returning the length of the next line
+    def line_length_function(self):
+        rand = self.random.random
+        min_line_length = self.min_line_length
+        max_line_length = self.max_line_length
+        if self.distribution == "fixed":
+            return lambda: max_line_length
+        if self.distribution == "uniform":
+            span = max_line_length - min_line_length + 1
+            return lambda: min_line_length + int(rand() * span)
+        expovariate = self.random.expovariate
+        lambd = 1.0 / max(self.mean_line_length - min_line_length, 1)
+        return lambda: min(min_line_length + int(expovariate(lambd)), max_line_length)
+
+    # Returns a block of lines of about BLOCK_SIZE bytes, at most max_lines lines and max_bytes bytes.
+    # The block may have fewer bytes than max_bytes only when its next line would not fit.
+    def block(self, max_lines, max_bytes):
+        lines = []
+        size = 0
+        pool = self.pool
+        rand = self.random.random
+        pool_size = self.pool_size
+        line_length = self.line_length_function()
+        max_size = min(self.BLOCK_SIZE, max_bytes)
+        while size < max_size and len(lines) < max_lines:
+            length = line_length()
+            if size + length + 1 > max_bytes:
+                # the last line of the file is cut to fill it to its size exactly
+                length = max_bytes - size - 1
+                if length < 0:
+                    break
+            start = int(rand() * pool_size)
+            lines.append(pool[start:start + length])
+            size += length + 1
+        if not lines:
+            return ""
+        return "\n".join(lines) + "\n"
+
+    # Writes num_of_lines lines, or lines up to size bytes, to file_path. Returns the number of lines and bytes written
+    def write(self, file_path, num_of_lines=None, size=None):
+        if num_of_lines is None and size is None:
+            raise ValueError("Either the number of lines or the size of the file is needed")
+        lines_left = num_of_lines if num_of_lines is not None else sys.maxint
+        bytes_left = size if size is not None else sys.maxint
+        lines_written = 0
+        bytes_written = 0
+        with open(file_path, "wb") as f:
+            while lines_left > 0 and bytes_left > 0:
+                block = self.block(lines_left, bytes_left)
+                if not block:
+                    break
+                f.write(block)
+                num_lines = block.count("\n")
+                lines_left -= num_lines
+                bytes_left -= len(block)
+                lines_written += num_lines
+                bytes_written += len(block)
+        return lines_written, bytes_written
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ["lines=", "size=", "min-line-length=", "max-line-length=",
+                                                      "mean-line-length=", "distribution=", "seed="])
+        except getopt.GetoptError, err:
+            raise CommandArgError(str(err))
+
+        if len(args) < 1:
+            raise CommandArgError("Invalid args! Please enter: {0} {1} {2} {3}".format("python", "-m benchmarks.generate_text_file", "[--lines=n | --size=bytes] [--min-line-length=n] [--max-line-length=n] [--mean-line-length=n] [--distribution=uniform|fixed|exponential] [--seed=n]", "file_path"))
+
+        options = dict(opts)
+        num_of_lines = int(options["--lines"]) if "--lines" in options else None
+        size = int(options["--size"]) if "--size" in options else None
+        if num_of_lines is None and size is None:
+            raise CommandArgError("Please enter --lines or --size")
+        try:
+            generator = TextFileGenerator(int(options.get("--min-line-length", 1)),
+                                          int(options.get("--max-line-length", 100)),
+                                          float(options["--mean-line-length"]) if "--mean-line-length" in options else None,
+                                          options.get("--distribution", "uniform"),
+                                          int(options["--seed"]) if "--seed" in options else None)
+        except ValueError, err:
+            raise CommandArgError(str(err))
+
+        t1 = time.time()
+        num_lines, num_bytes = generator.write(args[0], num_of_lines, size)
+        seconds = time.time() - t1
+        print json.dumps({
+            "file_path": args[0],
+            "num_lines": num_lines,
+            "bytes": num_bytes,
+            "seconds": round(seconds, 3),
+            "megabytes_per_second": round(num_bytes / seconds / 1024 / 1024, 1) if seconds > 0 else None
+        }, indent=4)
+        return 0
+
+    except CommandArgError, err:
+        print err.msg
+        return -1
+
+if __name__ == "__main__":
+    sys.exit(main())
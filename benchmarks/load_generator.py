@@ -0,0 +1,375 @@
+__author__ = 'white'
+
+import sys
+import getopt
+import json
+import math
+import multiprocessing
+import random
+import socket
+import threading
+import time
+from array import array
+from server.metrics import ServerMetrics
+from client.line_client import LineConnection, LineRequest, LineClientError
+
+
+# Drives a running line server with many concurrent connections and reports the throughput and the latency
+# percentiles as JSON, so server modes and index formats can be compared across commits.
+#
+# Connections are spread over worker processes, each serving its connections in threads, so the load generator
+# itself is not held back by the GIL. Every connection sends pipeline commands at a time and waits for their replies,
+# with the LineConnection of client/line_client.py, so services are measured with the client they use.
+# The latency of a command is the time from sending it to having read its whole reply.
+#
+# The line numbers requested follow an access pattern:
+#   "uniform"     any line with the same probability
+#   "zipf"        line ranks drawn from a Zipf distribution with the given exponent. Ranks are scattered over the file,
+#                 so the popular lines are not all on the first index page
+#   "sequential"  every connection reads the lines in order from a random line, wrapping around at the end of the file
+#
+# Commands are "GET" (a range of lines_per_request lines when it is more than 1), "MGET" of lines_per_request lines
+# chosen by the access pattern, or "STREAM" of lines_per_request lines.
+#
+# The number of lines of the file is read from the STATS of the server control port, unless --num-lines is given.
+#
+# Run from the repository root:
+#   python -m benchmarks.load_generator [--host=localhost] [--port=10497] [--control-port=8080] [--file=name]
+#       [--num-lines=n] [--connections=n] [--processes=n] [--duration=seconds] [--pattern=uniform|zipf|sequential]
+#       [--zipf-exponent=s] [--command=GET|MGET|STREAM] [--lines-per-request=n] [--pipeline=n] [--label=text]
+
+class CommandArgError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class UniformPattern(object):
+
+    def __init__(self, num_lines, rand):
+        self.num_lines = num_lines
+        self.rand = rand
+
+    def next(self):
+        return int(self.rand.random() * self.num_lines) + 1
+
+
+class SequentialPattern(object):
+
+    def __init__(self, num_lines, rand):
+        self.num_lines = num_lines
+        self.line_no = rand.randint(1, num_lines)
+
+    def next(self):
+        line_no = self.line_no
+        self.line_no = line_no % self.num_lines + 1
+        return line_no
+
+
+# Zipf distributed ranks 1 to num_lines, drawn in constant time and memory by rejection-inversion
+# (W. Hormann and G. Derflinger, "Rejection-inversion to generate variates from monotone discrete distributions", 1996).
+# Rank r is mapped to line (r - 1) * stride % num_lines + 1, which visits every line once for a stride coprime to num_lines.
+class ZipfPattern(object):
+
+    # A prime larger than any file has lines, so it is coprime to every num_lines
+    stride = 2305843009213693951
+
+    def __init__(self, num_lines, rand, exponent=1.0):
+        if exponent <= 0:
+            raise ValueError("The Zipf exponent must be positive")
+        self.num_lines = num_lines
+        self.rand = rand
+        self.exponent = exponent
+        self.h_integral_x1 = self.h_integral(1.5) - 1.0
+        self.h_integral_n = self.h_integral(num_lines + 0.5)
+        self.s = 2.0 - self.h_integral_inverse(self.h_integral(2.5) - self.h(2.0))
+
+    def h(self, x):
+        return math.exp(-self.exponent * math.log(x))
+
+    def h_integral(self, x):
+        log_x = math.log(x)
+        return self.helper2((1.0 - self.exponent) * log_x) * log_x
+
+    def h_integral_inverse(self, x):
+        t = max(x * (1.0 - self.exponent), -1.0)
+        return math.exp(self.helper1(t) * x)
+
+    # log(1 + x) / x, and its limit 1 at 0
+    @classmethod
+    def helper1(cls, x):
+        if abs(x) > 1e-8:
+            return math.log1p(x) / x
+        return 1.0 - x * (0.5 - x * (1.0 / 3.0 - 0.25 * x))
+
+    # (exp(x) - 1) / x, and its limit 1 at 0
+    @classmethod
+    def helper2(cls, x):
+        if abs(x) > 1e-8:
+            return math.expm1(x) / x
+        return 1.0 + x * 0.5 * (1.0 + x * (1.0 / 3.0) * (1.0 + 0.25 * x))
+
+    def rank(self):
+        while True:
+            u = self.h_integral_n + self.rand.random() * (self.h_integral_x1 - self.h_integral_n)
+            x = self.h_integral_inverse(u)
+            k = min(max(int(x + 0.5), 1), self.num_lines)
+            if k - x <= self.s or u >= self.h_integral(k + 0.5) - self.h(k):
+                return k
+
+    def next(self):
+        return int((self.rank() - 1) * self.stride % self.num_lines) + 1
+
+
+PATTERNS = ("uniform", "zipf", "sequential")
+
+
+def make_pattern(pattern, num_lines, rand, zipf_exponent=1.0):
+    if pattern == "uniform":
+        return UniformPattern(num_lines, rand)
+    if pattern == "zipf":
+        return ZipfPattern(num_lines, rand, zipf_exponent)
+    if pattern == "sequential":
+        return SequentialPattern(num_lines, rand)
+    raise ValueError("Unknown access pattern %s" % pattern)
+
+
+# The latency under which a fraction of the sorted latencies fall
+def percentile(sorted_latencies, fraction):
+    if not sorted_latencies:
+        return None
+    return sorted_latencies[max(int(math.ceil(fraction * len(sorted_latencies))) - 1, 0)]
+
+
+class LoadGenerator(object):
+
+    COMMANDS = ("GET", "MGET", "STREAM")
+
+    PERCENTILES = (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+
+    settings = {
+        "host": "localhost",
+        "port": 10497,
+        "control_port": 8080,
+        "file": None,
+        "num_lines": None,
+        "connections": 16,
+        "processes": multiprocessing.cpu_count(),
+        "duration": 10.0,
+        "pattern": "uniform",
+        "zipf_exponent": 1.0,
+        "command": "GET",
+        "lines_per_request": 1,
+        "pipeline": 1,
+        "timeout": 10.0,
+        "label": None
+    }
+
+    def __init__(self, settings):
+        self.settings = dict(LoadGenerator.settings)
+        self.settings.update(settings)
+        if self.settings["command"] not in self.COMMANDS:
+            raise ValueError("Unknown command %s" % self.settings["command"])
+        if self.settings["pattern"] not in PATTERNS:
+            raise ValueError("Unknown access pattern %s" % self.settings["pattern"])
+
+    # Sends a command to the server control port and returns its reply
+    def control(self, command):
+        s = socket.create_connection((self.settings["host"], self.settings["control_port"]), self.settings["timeout"])
+        try:
+            s.sendall(command + "\n")
+            return s.makefile("rb").readline()
+        finally:
+            s.close()
+
+    # The statistics of the file read, from the STATS of the control port
+    def file_stats(self):
+        files = json.loads(self.control("STATS"))["files"]
+        name = self.settings["file"]
+        if name is None:
+            if len(files) != 1:
+                raise ValueError("The server has several files, please choose one")
+            name = files.keys()[0]
+        if name not in files:
+            raise ValueError("The server has no file %s" % name)
+        return files[name]
+
+    # Waits until the index of the file is built, so requests are not answered with "ERR NOT READY"
+    def wait_until_ready(self, timeout=600):
+        deadline = time.time() + timeout
+        while True:
+            stats = self.file_stats()
+            if stats["index_progress"]["state"] == "ready":
+                return stats
+            if time.time() > deadline:
+                raise Exception("The index of the file is not ready")
+            time.sleep(0.1)
+
+    def run(self):
+        settings = self.settings
+        if settings["num_lines"] is None:
+            settings["num_lines"] = self.wait_until_ready()["num_lines"]
+        num_processes = max(1, min(settings["processes"], settings["connections"]))
+        # every process starts sending at the same time
+        start_time = time.time() + 0.5
+        jobs = []
+        for i in range(num_processes):
+            num_connections = settings["connections"] / num_processes + (i < settings["connections"] % num_processes)
+            jobs.append((settings, num_connections, start_time, random.getrandbits(32)))
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            results = pool.map(run_connections, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return self.report(results)
+
+    def report(self, results):
+        settings = self.settings
+        latencies = array("d")
+        outcomes = dict((outcome, 0) for outcome in ServerMetrics.OUTCOMES)
+        connection_errors = 0
+        seconds = 0.0
+        for result in results:
+            latencies.extend(result["latencies"])
+            for outcome, count in result["outcomes"].items():
+                outcomes[outcome] += count
+            connection_errors += result["connection_errors"]
+            seconds = max(seconds, result["seconds"])
+        sorted_latencies = sorted(latencies)
+        report = dict((key, settings[key]) for key in ("label", "host", "port", "file", "num_lines", "connections",
+                                                       "pattern", "command", "lines_per_request", "pipeline"))
+        if settings["pattern"] == "zipf":
+            report["zipf_exponent"] = settings["zipf_exponent"]
+        report.update({
+            "requests": len(latencies),
+            "outcomes": outcomes,
+            "connection_errors": connection_errors,
+            "seconds": round(seconds, 3),
+            "requests_per_second": round(len(latencies) / seconds, 1) if seconds > 0 else None,
+            "lines_per_second": round(len(latencies) * settings["lines_per_request"] / seconds, 1) if seconds > 0 else None,
+            "latency_ms_mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            "latency_ms_max": round(sorted_latencies[-1] * 1000, 3) if latencies else None
+        })
+        for name, fraction in self.PERCENTILES:
+            value = percentile(sorted_latencies, fraction)
+            report["latency_ms_%s" % name] = round(value * 1000, 3) if value is not None else None
+        return report
+
+
+# A connection of a worker process, sending commands until the end of the run
+class LoadConnection(threading.Thread):
+
+    def __init__(self, settings, deadline, rand):
+        self.settings = settings
+        self.deadline = deadline
+        self.pattern = make_pattern(settings["pattern"], settings["num_lines"], rand, settings["zipf_exponent"])
+        self.latencies = array("d")
+        self.outcomes = dict((outcome, 0) for outcome in ServerMetrics.OUTCOMES)
+        self.connection_errors = 0
+        super(LoadConnection, self).__init__()
+        self.daemon = True
+
+    # The next command, as a LineRequest
+    def next_request(self):
+        settings = self.settings
+        cmd = settings["command"]
+        count = settings["lines_per_request"]
+        if cmd == "MGET":
+            return LineRequest.mget([self.pattern.next() for i in range(count)], settings["file"])
+        first = self.pattern.next()
+        if cmd == "GET" and count == 1:
+            return LineRequest.get(first, settings["file"])
+        last = min(first + count - 1, settings["num_lines"])
+        if cmd == "GET":
+            return LineRequest.get_range(first, last, settings["file"])
+        return LineRequest.stream(first, last, settings["file"])
+
+    def record(self, requests, sent):
+        for request in requests:
+            if request.answered_at is not None:
+                self.latencies.append(request.answered_at - sent)
+                self.outcomes[ServerMetrics.get_outcome(request.header)] += 1
+
+    def run(self):
+        settings = self.settings
+        while time.time() < self.deadline:
+            try:
+                connection = LineConnection((settings["host"], settings["port"]), settings["timeout"])
+            except socket.error:
+                self.connection_errors += 1
+                time.sleep(0.01)
+                continue
+            try:
+                while time.time() < self.deadline:
+                    requests = [self.next_request() for i in range(settings["pipeline"])]
+                    sent = time.time()
+                    try:
+                        connection.execute(requests, settings["pipeline"])
+                    finally:
+                        self.record(requests, sent)
+                connection.quit()
+            except (socket.error, LineClientError):
+                self.connection_errors += 1
+            finally:
+                connection.close()
+
+
+# Runs the connections of one worker process. Runs in a process of the pool, so it is a module level function
+def run_connections(job):
+    settings, num_connections, start_time, seed = job
+    rand = random.Random(seed)
+    deadline = start_time + settings["duration"]
+    connections = [LoadConnection(settings, deadline, random.Random(rand.getrandbits(32)))
+                   for i in range(num_connections)]
+    time.sleep(max(start_time - time.time(), 0))
+    for connection in connections:
+        connection.start()
+    for connection in connections:
+        connection.join()
+    outcomes = dict((outcome, 0) for outcome in ServerMetrics.OUTCOMES)
+    latencies = array("d")
+    for connection in connections:
+        latencies.extend(connection.latencies)
+        for outcome, count in connection.outcomes.items():
+            outcomes[outcome] += count
+    return {
+        "latencies": latencies,
+        "outcomes": outcomes,
+        "connection_errors": sum(connection.connection_errors for connection in connections),
+        "seconds": time.time() - start_time
+    }
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options = [("host", str), ("port", int), ("control-port", int), ("file", str), ("num-lines", int),
+               ("connections", int), ("processes", int), ("duration", float), ("pattern", str),
+               ("zipf-exponent", float), ("command", str), ("lines-per-request", int), ("pipeline", int),
+               ("timeout", float), ("label", str)]
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ["%s=" % name for name, value_type in options])
+        except getopt.GetoptError, err:
+            raise CommandArgError("%s\nPlease enter: python -m benchmarks.load_generator %s" %
+                                  (err, " ".join("[--%s=...]" % name for name, value_type in options)))
+        value_types = dict(options)
+        settings = {}
+        try:
+            for name, value in opts:
+                name = name[2:]
+                settings[name.replace("-", "_")] = value_types[name](value)
+            if "command" in settings:
+                settings["command"] = settings["command"].upper()
+            report = LoadGenerator(settings).run()
+        except ValueError, err:
+            raise CommandArgError(str(err))
+        print json.dumps(report, indent=4, sort_keys=True)
+        return 0
+
+    except CommandArgError, err:
+        print err.msg
+        return -1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,532 @@
+__author__ = 'white'
+import collections
+import contextlib
+import errno
+import select
+import socket
+import threading
+import time
+from server.protocol import LineProtocol
+
+
+# A client of the line server, so services do not each hand-roll the socket code of the protocol (see protocol.py).
+#
+# Commands are LineRequest objects, answered by execute(requests) in a single batch: the commands are pipelined,
+# up to window commands are in flight on a connection at a time, and each reply is parsed as it arrives.
+# Commands name the file they read, as a pooled connection may have been used for another file before.
+#
+# Two clients are built on this:
+#   LineClient           a thread-safe client, each batch takes a connection from a LineConnectionPool
+#   MultiplexLineClient  spreads a batch over several connections and serves them all from one thread with a poll loop,
+#                        like the event loop server mode
+#
+# Lines are read with get, get_range, get_many and stream. Line numbers, ranges and MGET commands are split
+# to fit MAX_RANGE_LINES and MAX_COMMAND_LENGTH, so any batch can be asked for.
+#
+# Every socket operation times out after timeout seconds. A batch is retried up to retries times, after retry_interval
+# seconds doubling at each retry, when a connection fails or when commands are answered with "ERR NOT READY"
+# or with a server error.
+# Only the commands not answered yet are sent again, on a new connection.
+#
+#   client = LineClient("localhost", 10497, max_connections=8)
+#   client.get(5), client.get_range(1, 100), client.get_many([3, 1, 4]), client.stream(1, 100, "other.txt")
+
+class LineClientError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        super(LineClientError, self).__init__(msg)
+
+
+# Commands still answered with "Server error: ..." after the retries
+class LineServerError(LineClientError):
+    pass
+
+
+# Commands still answered with "ERR NOT READY" after the retries
+class LineNotReadyError(LineClientError):
+    pass
+
+
+# A command and its reply
+class LineRequest(object):
+
+    # The kinds of reply: a line (GET n, and each line of MGET), lines (GET a-b), bytes (STREAM a-b)
+    LINE = "line"
+    RANGE = "range"
+    STREAM = "stream"
+
+    def __init__(self, command, kind, count=1):
+        self.command = command
+        self.kind = kind
+        # the number of replies the command is answered with, one per line number for MGET
+        self.count = count
+        self.reset()
+
+    def reset(self):
+        # a line, a list of lines or bytes per reply, None for "ERR"
+        self.replies = []
+        # the first line of the reply
+        self.header = None
+        self.not_ready = False
+        # the message of a "Server error: ..." reply
+        self.server_error = None
+        self.answered_at = None
+
+    @property
+    def done(self):
+        return len(self.replies) == self.count
+
+    # The line of GET n, the lines of GET a-b, the bytes of STREAM a-b or the list of lines of MGET,
+    # None or a None line if there is no such line
+    def result(self):
+        if self.command.startswith("MGET"):
+            return self.replies
+        return self.replies[0]
+
+    @classmethod
+    def get(cls, line_no, file_name=None):
+        return cls(cls.prefix("GET", file_name) + "%d\n" % line_no, cls.LINE)
+
+    @classmethod
+    def get_range(cls, first, last, file_name=None):
+        return cls(cls.prefix("GET", file_name) + "%d-%d\n" % (first, last), cls.RANGE)
+
+    @classmethod
+    def mget(cls, line_nos, file_name=None):
+        return cls(cls.prefix("MGET", file_name) + " ".join(str(line_no) for line_no in line_nos) + "\n", cls.LINE,
+                   len(line_nos))
+
+    @classmethod
+    def stream(cls, first, last, file_name=None):
+        return cls(cls.prefix("STREAM", file_name) + "%d-%d\n" % (first, last), cls.STREAM)
+
+    @classmethod
+    def prefix(cls, cmd, file_name):
+        return "%s %s " % (cmd, file_name) if file_name else "%s " % cmd
+
+
+# Parses the replies of a connection from the data received, which may end anywhere in a reply.
+# A reply is consumed as it is parsed, so a long reply is not copied over and over as its data arrives.
+class LineReplyParser(object):
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        # the fields of the first line of the reply being read, None between replies
+        self.fields = None
+        self.parts = []
+        self.lines_left = 0
+        self.bytes_left = 0
+
+    def feed(self, data):
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += data
+
+    # Parses the replies to request from the data fed, returns True once all of them are read
+    def parse(self, request):
+        while not request.done:
+            if self.fields is None:
+                if not self.__parse_header(request):
+                    return False
+            elif self.lines_left:
+                line = self.__read_line()
+                if line is None:
+                    return False
+                self.parts.append(line)
+                self.lines_left -= 1
+            else:
+                data = self.buffer[self.pos:self.pos + self.bytes_left]
+                if not data:
+                    return False
+                self.parts.append(data)
+                self.pos += len(data)
+                self.bytes_left -= len(data)
+            if self.fields is not None and not self.lines_left and not self.bytes_left:
+                request.replies.append(self.__value(request.kind))
+                self.fields = None
+        return True
+
+    def __parse_header(self, request):
+        header = self.__read_line()
+        if header is None:
+            return False
+        if not request.replies:
+            request.header = header + "\n"
+        if header + "\n" == LineProtocol.NOT_READY:
+            request.not_ready = True
+            request.replies.append(None)
+            return True
+        if header == "ERR":
+            request.replies.append(None)
+            return True
+        if header.startswith(LineProtocol.SERVER_ERROR):
+            request.server_error = self.unescape(header[len(LineProtocol.SERVER_ERROR):])
+            request.replies.append(None)
+            return True
+        if header + "\n" == LineProtocol.INVALID_COMMAND:
+            raise LineClientError("The server rejected the command %r" % request.command)
+        fields = header.split()
+        if fields[:1] != ["OK"] or not all(field.isdigit() for field in fields[1:]) or \
+                len(fields) != {LineRequest.LINE: 1, LineRequest.RANGE: 2, LineRequest.STREAM: 3}[request.kind]:
+            raise LineClientError("Unexpected reply %r to %r" % (header[:100], request.command))
+        self.fields = fields
+        self.parts = []
+        self.lines_left = 1 if request.kind == LineRequest.LINE else 0
+        if request.kind == LineRequest.RANGE:
+            self.lines_left = int(fields[1])
+        elif request.kind == LineRequest.STREAM:
+            self.bytes_left = int(fields[2])
+        return True
+
+    # The message of a server error, see LineProtocol.format_error
+    @classmethod
+    def unescape(cls, message):
+        return message.decode("string_escape")
+
+    def __read_line(self):
+        end = self.buffer.find("\n", self.pos)
+        if end == -1:
+            return None
+        line = self.buffer[self.pos:end]
+        self.pos = end + 1
+        return line
+
+    def __value(self, kind):
+        if kind == LineRequest.LINE:
+            return self.parts[0]
+        if kind == LineRequest.RANGE:
+            return self.parts
+        return "".join(self.parts)
+
+
+# A blocking connection to the line server
+class LineConnection(object):
+
+    recv_size = 65536
+
+    def __init__(self, address, timeout=10.0):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.parser = LineReplyParser()
+        # set once a batch fails, as the replies still on their way would be read as the replies of the next batch
+        self.broken = False
+
+    # Sends the commands of requests, keeping up to window of them in flight, and reads their replies in order
+    def execute(self, requests, window=64):
+        try:
+            sent = answered = 0
+            while answered < len(requests):
+                if sent < len(requests) and sent - answered <= window / 2:
+                    end = min(len(requests), answered + window)
+                    self.sock.sendall("".join(request.command for request in requests[sent:end]))
+                    sent = end
+                if self.parser.parse(requests[answered]):
+                    requests[answered].answered_at = time.time()
+                    answered += 1
+                    continue
+                data = self.sock.recv(self.recv_size)
+                if not data:
+                    raise socket.error("The server closed the connection")
+                self.parser.feed(data)
+        except:
+            self.broken = True
+            raise
+
+    def quit(self):
+        try:
+            self.sock.sendall("QUIT\n")
+        except socket.error:
+            pass
+
+    def close(self):
+        self.broken = True
+        self.sock.close()
+
+
+# A thread-safe pool of up to max_connections connections. A thread waits up to acquire_timeout seconds
+# for a connection when they are all in use.
+class LineConnectionPool(object):
+
+    def __init__(self, address, max_connections=8, timeout=10.0, acquire_timeout=10.0):
+        self.address = address
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.changed = threading.Condition()
+        self.idle = []
+        self.num_connections = 0
+        self.closed = False
+
+    def acquire(self):
+        deadline = time.time() + self.acquire_timeout
+        with self.changed:
+            while not self.idle and self.num_connections >= self.max_connections:
+                timeout = deadline - time.time()
+                if self.closed or timeout <= 0:
+                    raise LineClientError("No connection to %s:%d is free" % self.address)
+                self.changed.wait(timeout)
+            if self.closed:
+                raise LineClientError("The connection pool is closed")
+            if self.idle:
+                return self.idle.pop()
+            self.num_connections += 1
+        try:
+            return LineConnection(self.address, self.timeout)
+        except:
+            with self.changed:
+                self.num_connections -= 1
+                self.changed.notify()
+            raise
+
+    # Puts a connection back in the pool, or closes it if it is broken
+    def release(self, connection):
+        with self.changed:
+            if connection.broken or self.closed:
+                connection.close()
+                self.num_connections -= 1
+            else:
+                self.idle.append(connection)
+            self.changed.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    # Closes the idle connections, the connections in use are closed when they are released
+    def close(self):
+        with self.changed:
+            self.closed = True
+            for connection in self.idle:
+                connection.quit()
+                connection.close()
+            self.num_connections -= len(self.idle)
+            self.idle = []
+            self.changed.notify_all()
+
+
+# The line reading methods and the retries of both clients. Each client defines send_batch, which sends a batch of
+# requests and raises after answering what it can if a connection fails.
+class BaseLineClient(object):
+
+    def __init__(self, file_name=None, retries=3, retry_interval=0.1, window=64):
+        self.file_name = file_name
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.window = window
+
+    # Answers every request, retrying the ones not answered
+    def execute(self, requests):
+        for request in requests:
+            request.reset()
+        pending = list(requests)
+        attempt = 0
+        while True:
+            error = None
+            try:
+                self.send_batch(pending)
+            except socket.error, err:
+                error = err
+            pending = [request for request in pending
+                       if not request.done or request.not_ready or request.server_error is not None]
+            if not pending:
+                return requests
+            if attempt >= self.retries:
+                if error is not None:
+                    raise LineClientError("%d commands failed after %d retries: %s" % (len(pending), attempt, error))
+                server_errors = [request.server_error for request in pending if request.server_error is not None]
+                if server_errors:
+                    raise LineServerError("%d commands failed after %d retries: %s" %
+                                          (len(pending), attempt, server_errors[0]))
+                raise LineNotReadyError("%d commands were not ready after %d retries" % (len(pending), attempt))
+            time.sleep(self.retry_interval * 2 ** attempt)
+            attempt += 1
+            for request in pending:
+                request.reset()
+
+    # Line line_no, or None if there is no such line
+    def get(self, line_no, file_name=None):
+        return self.execute([LineRequest.get(line_no, file_name or self.file_name)])[0].result()
+
+    # Lines first to last, cut at the last line of the file, or None if there is no line first
+    def get_range(self, first, last, file_name=None):
+        return self.__read_range(LineRequest.get_range, first, last, file_name, [])
+
+    # The lines of line_nos, None for the lines the file does not have
+    def get_many(self, line_nos, file_name=None):
+        file_name = file_name or self.file_name
+        prefix_length = len(LineRequest.prefix("MGET", file_name))
+        requests = []
+        batch = []
+        length = prefix_length
+        for line_no in line_nos:
+            size = len(str(line_no)) + 1
+            if batch and length + size >= LineProtocol.MAX_COMMAND_LENGTH:
+                requests.append(LineRequest.mget(batch, file_name))
+                batch = []
+                length = prefix_length
+            batch.append(line_no)
+            length += size
+        if batch:
+            requests.append(LineRequest.mget(batch, file_name))
+        lines = []
+        for request in self.execute(requests):
+            lines.extend(request.result())
+        return lines
+
+    # The bytes of lines first to last as they are in the text file, cut at the last line of the file,
+    # or None if there is no line first
+    def stream(self, first, last, file_name=None):
+        parts = self.__read_range(LineRequest.stream, first, last, file_name, [])
+        return "".join(parts) if parts is not None else None
+
+    # Reads a range of lines in ranges of up to MAX_RANGE_LINES. A range past the end of the file is answered
+    # with "ERR", so the parts end at the first one.
+    def __read_range(self, make_request, first, last, file_name, parts):
+        if first < 0 or last < first:
+            raise ValueError("Invalid line range %d-%d" % (first, last))
+        file_name = file_name or self.file_name
+        requests = [make_request(start, min(start + LineProtocol.MAX_RANGE_LINES - 1, last), file_name)
+                    for start in xrange(first, last + 1, LineProtocol.MAX_RANGE_LINES)]
+        for request in self.execute(requests):
+            if request.result() is None:
+                break
+            if request.kind == LineRequest.RANGE:
+                parts.extend(request.result())
+            else:
+                parts.append(request.result())
+        return parts if requests[0].result() is not None else None
+
+
+# A thread-safe client: every batch is sent on a connection of the pool
+class LineClient(BaseLineClient):
+
+    def __init__(self, host="localhost", port=10497, file_name=None, max_connections=8, timeout=10.0,
+                 acquire_timeout=10.0, retries=3, retry_interval=0.1, window=64):
+        super(LineClient, self).__init__(file_name, retries, retry_interval, window)
+        self.pool = LineConnectionPool((host, port), max_connections, timeout, acquire_timeout)
+
+    def send_batch(self, requests):
+        with self.pool.connection() as connection:
+            connection.execute(requests, self.window)
+
+    def close(self):
+        self.pool.close()
+
+
+# A connection of MultiplexLineClient, with the commands it still has to send and the ones in flight
+class MultiplexConnection(LineConnection):
+
+    def __init__(self, address, timeout=10.0):
+        super(MultiplexConnection, self).__init__(address, timeout)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        self.waiting = collections.deque()
+        self.in_flight = collections.deque()
+        self.out_buffer = ""
+
+    # Moves commands from waiting to in flight, up to window of them
+    def fill(self, window):
+        commands = []
+        while self.waiting and len(self.in_flight) < window:
+            request = self.waiting.popleft()
+            self.in_flight.append(request)
+            commands.append(request.command)
+        self.out_buffer += "".join(commands)
+
+    @property
+    def events(self):
+        return select.POLLIN | (select.POLLOUT if self.out_buffer else 0)
+
+
+# Spreads each batch over up to num_connections connections and serves them from the calling thread with a poll loop,
+# so many commands are in flight at once without a thread per connection. A client is used by one thread at a time.
+class MultiplexLineClient(BaseLineClient):
+
+    def __init__(self, host="localhost", port=10497, file_name=None, num_connections=4, timeout=10.0,
+                 retries=3, retry_interval=0.1, window=64):
+        super(MultiplexLineClient, self).__init__(file_name, retries, retry_interval, window)
+        self.address = (host, port)
+        self.num_connections = num_connections
+        self.timeout = timeout
+        self.connections = []
+
+    def send_batch(self, requests):
+        while len(self.connections) < min(self.num_connections, len(requests)):
+            self.connections.append(MultiplexConnection(self.address, self.timeout))
+        active = {}
+        poll = select.poll()
+        for i, connection in enumerate(self.connections):
+            connection.waiting.extend(requests[i::len(self.connections)])
+            connection.fill(self.window)
+            if connection.in_flight:
+                active[connection.fd] = connection
+                poll.register(connection.fd, connection.events)
+        error = None
+        while active:
+            try:
+                events = poll.poll(self.timeout * 1000)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not events:
+                events = [(fd, 0) for fd in active]
+                error = socket.timeout("timed out")
+            for fd, event in events:
+                connection = active[fd]
+                try:
+                    if not event:
+                        raise error
+                    self.__handle_event(connection, event)
+                except (socket.error, LineClientError), err:
+                    error = err
+                    self.__close(connection)
+                if connection.in_flight and not connection.broken:
+                    poll.modify(fd, connection.events)
+                else:
+                    poll.unregister(fd)
+                    del active[fd]
+        if error is not None:
+            raise error
+
+    def __handle_event(self, connection, event):
+        if event & select.POLLNVAL:
+            raise socket.error(errno.EBADF, "The connection is closed")
+        if event & select.POLLOUT and connection.out_buffer:
+            try:
+                sent = connection.sock.send(connection.out_buffer)
+                connection.out_buffer = connection.out_buffer[sent:]
+            except socket.error, err:
+                if err.errno != errno.EAGAIN:
+                    raise
+        if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+            try:
+                data = connection.sock.recv(connection.recv_size)
+            except socket.error, err:
+                if err.errno == errno.EAGAIN:
+                    return
+                raise
+            if not data:
+                raise socket.error("The server closed the connection")
+            connection.parser.feed(data)
+            while connection.in_flight and connection.parser.parse(connection.in_flight[0]):
+                connection.in_flight.popleft().answered_at = time.time()
+            connection.fill(self.window)
+
+    def __close(self, connection):
+        connection.close()
+        connection.waiting.clear()
+        connection.in_flight.clear()
+        self.connections.remove(connection)
+
+    def close(self):
+        for connection in self.connections:
+            connection.quit()
+            connection.close()
+        self.connections = []
@@ -1,5 +1,6 @@
 
 import socket
+import multiprocessing
 
 # Some line server settings
 settings = {
@@ -10,6 +11,74 @@ settings = {
 
     "control_port": 8080,
 
-    "num_of_lines_per_index_page": 10000
+    "num_of_lines_per_index_page": 10000,
+
+    # number of processes scanning the text file when building indexes, 1 scans it in the server process
+    "num_of_index_workers": multiprocessing.cpu_count(),
+
+    # seconds between checks for lines appended to the text file, 0 only checks when a GET asks for a line past the end
+    "index_refresh_interval": 5,
+
+    # memory budget of the mapped index pages kept in the LRU index page cache
+    "index_cache_max_bytes": 64 * 1024 * 1024,
+
+    # memory budget of the decompressed blocks of gzip or zstd compressed text files
+    "block_cache_max_bytes": 16 * 1024 * 1024,
+
+    # shared memory for caching the contents of frequently requested lines, 0 disables the cache.
+    # Lines longer than line_cache_max_line_length are never cached.
+    "line_cache_max_bytes": 32 * 1024 * 1024,
+    "line_cache_max_line_length": 256,
+
+    # "fork" forks a process for every connection, "event" serves all connections from one process with an epoll loop
+    # and num_of_io_threads threads reading lines, "prefork" starts num_of_worker_processes long-lived worker processes
+    # serving connections in threads
+    "server_mode": "fork",
+    "num_of_io_threads": 4,
+    "num_of_worker_processes": multiprocessing.cpu_count(),
+
+    # in the event mode, a connection is not read while more than output_buffer_max_bytes of its replies wait to be sent
+    "output_buffer_max_bytes": 1024 * 1024,
+
+    # in the prefork mode, every worker binds its own socket with SO_REUSEPORT instead of sharing one listening socket
+    "prefork_reuse_port": False,
+
+    # When the indexes of the text files are built: "start" before the server starts listening,
+    # "lazy" when a request first reads a file, "background" as soon as the server is listening
+    "index_build_mode": "background",
+
+    # How long a GET for a line not indexed yet waits for its index page, before replying "ERR NOT READY"
+    "index_wait_timeout": 2.0,
+
+    # The index records the offset of every index_checkpoint_interval-th line only, and a GET scans forward from the
+    # nearest recorded line. 1 records every line, larger values make the index smaller and lookups slower
+    "index_checkpoint_interval": 1,
+
+    # How index pages store line offsets: "fixed" 8 bytes per line, "delta" varint-encoded differences between lines,
+    # usually one or two bytes per line but slower to look up. index_page_compression "zlib" also compresses the pages,
+    # None leaves them as they are
+    "index_page_encoding": "fixed",
+    "index_page_compression": None,
+
+    # Level of the server log. Messages from users are only logged at "DEBUG"
+    "log_level": "INFO",
+
+    # When set, answered GET, MGET and STREAM commands are written to this file as JSON lines, in batches.
+    # Only an access_log_sample_rate fraction of the commands is logged, and at most access_log_max_per_second
+    # a second per process (0 for no limit)
+    "access_log_path": None,
+    "access_log_sample_rate": 1.0,
+    "access_log_max_per_second": 0,
+
+    # Set to "host:port" of the control port of a primary server to run as a replica: indexes are copied from the
+    # primary instead of scanning the text files, which must be copies of the primary's. A replica waits up to
+    # replica_wait_timeout seconds for the primary to have an index, and then builds it itself
+    "replica_of": None,
+    "replica_wait_timeout": 600,
+
+    # SIGTERM and SIGINT stop the server gracefully: it stops accepting connections and lets the open connections
+    # finish the commands already received for up to shutdown_drain_timeout seconds before closing them.
+    # SIGHUP rebuilds the index of every text file which has changed, while the old index keeps serving
+    "shutdown_drain_timeout": 10.0
 }
 
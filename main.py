@@ -8,7 +8,6 @@ from server.server import Server
 from server.server_control import ServerController
 from utils.tools import ErrorUtil, LoggingUtil
 from configuration import settings
-import signal
 
 
 class CommandArgError(Exception):
@@ -21,21 +20,20 @@ def main(argv=None):
     if argv is None:
         argv = sys.argv
     try:
-        #signal.signal(signal.SIGINT, exit_gracefully)
-
-        LoggingUtil.init_logging()
+        LoggingUtil.init_logging(settings["log_level"])
 
         opts, args = getopt.getopt(argv[1:], [])
 
         if len(args) < 1:
-            raise CommandArgError("Invalid args! Please enter: {0} {1} {2}".format("python", "main.py", "line_file_path"))
+            raise CommandArgError("Invalid args! Please enter: {0} {1} {2}".format("python", "main.py", "line_file_path [line_file_path ...]"))
 
-        text_file_path = args[0]
-        if not os.path.isfile(text_file_path):
-            raise CommandArgError("The file %s doesn't exist!" % text_file_path)
+        text_file_paths = args
+        for text_file_path in text_file_paths:
+            if not os.path.isfile(text_file_path):
+                raise CommandArgError("The file %s doesn't exist!" % text_file_path)
 
         global server
-        server = Server(settings, text_file_path)
+        server = Server(settings, text_file_paths)
         server.start()
 
         return 0
@@ -45,10 +43,9 @@ def main(argv=None):
         logger.error(err.msg)
         return -1
 
-    # forcefully kill itself on Ctrl-C, otherwise it will stuck in TCP socket listening for loop inside ForkTCPServer
-    except KeyboardInterrupt as e:
-        server.tcp_server.shutdown()
-        os.kill(os.getpid(), 9)
+    # Ctrl-C before the server is listening. Once it listens, SIGINT and SIGTERM stop it gracefully (see Server.stop)
+    except KeyboardInterrupt:
+        return -1
 
     except Exception, arg:
         error = ErrorUtil.get_error(arg)
@@ -1,8 +1,8 @@
 
 if [ $# -eq 0 ]
 then
-    echo "Missing text file path. Please enter: ./run.sh text_file_path"
+    echo "Missing text file path. Please enter: ./run.sh text_file_path [text_file_path ...]"
 else
-    python main.py "$1"
+    python main.py "$@"
 fi
 
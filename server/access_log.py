@@ -0,0 +1,102 @@
+__author__ = 'white'
+import os
+import json
+import time
+import random
+import threading
+import collections
+from metrics import ServerMetrics
+
+
+# The access log records answered GET, MGET and STREAM commands as JSON lines:
+#   {"time": ..., "pid": ..., "client": "host:port", "command": "GET", "file": null, "args": [12],
+#    "outcome": "ok", "latency_us": 35}
+# A request only appends a tuple to a deque. A writer thread formats the entries and appends them to the log file
+# with one write per batch, every flush_interval seconds or sooner when batch_size entries are waiting.
+# The file is opened in append mode, so the batches of the processes serving connections do not overwrite each other.
+#
+# Only a sample_rate fraction of the requests is logged, and at most max_per_second requests a second per process
+# (0 for no limit).
+# Like QueueLoggingHandler, a forked process starts its own writer thread the first time it logs, and a process
+# about to exit calls flush so its last entries are not lost. The threads of a process logging for the first time
+# at once start a single writer.
+class AccessLog(object):
+
+    def __init__(self, file_path, sample_rate=1.0, max_per_second=0, flush_interval=1.0, batch_size=1000):
+        self.file_path = file_path
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.entries = collections.deque()
+        self.second = 0
+        self.logged_this_second = 0
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.fd = None
+        self.write_lock = None
+        self.wakeup = None
+
+    def log(self, client_address, cmd, params, seconds, reply):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        now = time.time()
+        if self.max_per_second:
+            second = int(now)
+            if second != self.second:
+                self.second = second
+                self.logged_this_second = 0
+            if self.logged_this_second >= self.max_per_second:
+                return
+            self.logged_this_second += 1
+        if self.pid != os.getpid():
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.__start_writer()
+        self.entries.append((now, client_address, cmd, params, seconds, reply[:16]))
+        if len(self.entries) >= self.batch_size:
+            self.wakeup.set()
+
+    # The entries logged by the parent process before a fork are written by the parent
+    def __start_writer(self):
+        self.entries = collections.deque()
+        self.fd = None
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = os.getpid()
+        writer = threading.Thread(target=self.__write, name="AccessLogWriter")
+        writer.daemon = True
+        writer.start()
+
+    def __write(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    # Writes the entries logged so far by this process
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        with self.write_lock:
+            lines = []
+            pid = self.pid
+            for i in xrange(len(self.entries)):
+                logged, client_address, cmd, params, seconds, reply = self.entries.popleft()
+                lines.append(json.dumps({
+                    "time": round(logged, 6),
+                    "pid": pid,
+                    "client": "%s:%d" % client_address if client_address else None,
+                    "command": cmd,
+                    "file": params[0],
+                    "args": params[1:],
+                    "outcome": ServerMetrics.get_outcome(reply),
+                    "latency_us": int(seconds * 1000000)
+                }, sort_keys=True))
+            if not lines:
+                return
+            if self.fd is None:
+                self.fd = os.open(self.file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            data = "\n".join(lines) + "\n"
+            while data:
+                data = data[os.write(self.fd, data):]
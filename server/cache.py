@@ -0,0 +1,175 @@
+__author__ = 'white'
+import mmap
+import struct
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+
+# A bounded cache with least recently used eviction.
+# Every entry has a size (bytes for the caches in this package), and entries are evicted until the total size
+# is within max_size. The cache can be used by several threads at the same time.
+# Evicted values are only dropped, not closed, because another thread may still be using them.
+class LRUCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns the cached value, or None if the key is not in the cache
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size and len(self.entries) > 1:
+                evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    # Removes all the entries whose key matches the predicate
+    def discard(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / requests if requests else None,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size
+            }
+
+
+# A cache of line contents in an anonymous shared memory mapping, so it is shared by the server process and every
+# child process forked after it is created.
+#
+# The mapping is split into slots of a fixed size, grouped into sets of WAYS slots. A line can only be stored in the
+# set picked by hashing its key, and when the set is full the least frequently used slot is replaced (the use counts
+# of the other slots in the set are halved at the same time, so old popularity fades).
+# Lines longer than the slot payload are not cached.
+#
+# Every slot records the index version it was stored for, and a lookup with another index version is a miss,
+# so rebuilding or extending the index invalidates the cache.
+#
+# Sets are protected by a fixed number of process-shared locks. A lock that can not be taken within a short time
+# (for example because a child was killed while holding it) makes the operation a miss instead of blocking the request.
+class SharedLineCache(object):
+
+    WAYS = 4
+    NUM_LOCKS = 16
+    LOCK_TIMEOUT = 0.1
+
+    # file key, line number, index version, line length, use count
+    SLOT_HEADER = struct.Struct("<QQIII")
+    # hits, misses, stores, evictions of each lock stripe
+    STATS = struct.Struct("<QQQQ")
+
+    def __init__(self, max_bytes, max_line_length):
+        self.max_line_length = max_line_length
+        self.slot_size = self.SLOT_HEADER.size + max_line_length
+        self.stats_size = self.STATS.size * self.NUM_LOCKS
+        self.num_sets = max(1, (max_bytes - self.stats_size) / (self.slot_size * self.WAYS))
+        self.max_bytes = self.stats_size + self.num_sets * self.WAYS * self.slot_size
+        self.buf = mmap.mmap(-1, self.max_bytes)
+        self.locks = [multiprocessing.Lock() for i in range(self.NUM_LOCKS)]
+
+    def __get_set(self, file_key, line_no):
+        set_number = ((line_no * 2654435761) ^ file_key) % self.num_sets
+        return set_number, self.stats_size + set_number * self.WAYS * self.slot_size
+
+    def __count(self, stripe, hits=0, misses=0, stores=0, evictions=0):
+        pos = stripe * self.STATS.size
+        counts = self.STATS.unpack_from(self.buf, pos)
+        self.STATS.pack_into(self.buf, pos, counts[0] + hits, counts[1] + misses, counts[2] + stores, counts[3] + evictions)
+
+    # Returns the cached line, or None
+    def get(self, file_key, line_no, index_version):
+        set_number, set_pos = self.__get_set(file_key, line_no)
+        lock = self.locks[set_number % self.NUM_LOCKS]
+        if not lock.acquire(True, self.LOCK_TIMEOUT):
+            return None
+        try:
+            for pos in xrange(set_pos, set_pos + self.WAYS * self.slot_size, self.slot_size):
+                slot_file_key, slot_line_no, slot_version, length, uses = self.SLOT_HEADER.unpack_from(self.buf, pos)
+                if slot_line_no == line_no and slot_file_key == file_key and slot_version == index_version:
+                    self.SLOT_HEADER.pack_into(self.buf, pos, file_key, line_no, index_version, length, min(uses + 1, 0xffffffff))
+                    self.__count(set_number % self.NUM_LOCKS, hits=1)
+                    start = pos + self.SLOT_HEADER.size
+                    return self.buf[start:start + length]
+            self.__count(set_number % self.NUM_LOCKS, misses=1)
+            return None
+        finally:
+            lock.release()
+
+    def put(self, file_key, line_no, index_version, line):
+        if len(line) > self.max_line_length:
+            return
+        set_number, set_pos = self.__get_set(file_key, line_no)
+        lock = self.locks[set_number % self.NUM_LOCKS]
+        if not lock.acquire(True, self.LOCK_TIMEOUT):
+            return
+        try:
+            victim_pos = None
+            victim_uses = None
+            evicted = 0
+            for pos in xrange(set_pos, set_pos + self.WAYS * self.slot_size, self.slot_size):
+                slot_file_key, slot_line_no, slot_version, length, uses = self.SLOT_HEADER.unpack_from(self.buf, pos)
+                if slot_line_no == 0 or (slot_line_no == line_no and slot_file_key == file_key) or slot_version != index_version:
+                    victim_pos = pos
+                    evicted = 0
+                    break
+                if victim_uses is None or uses < victim_uses:
+                    victim_pos, victim_uses = pos, uses
+                    evicted = 1
+            if evicted:
+                for pos in xrange(set_pos, set_pos + self.WAYS * self.slot_size, self.slot_size):
+                    header = list(self.SLOT_HEADER.unpack_from(self.buf, pos))
+                    header[4] /= 2
+                    self.SLOT_HEADER.pack_into(self.buf, pos, *header)
+            self.SLOT_HEADER.pack_into(self.buf, victim_pos, file_key, line_no, index_version, len(line), 1)
+            start = victim_pos + self.SLOT_HEADER.size
+            self.buf[start:start + len(line)] = line
+            self.__count(set_number % self.NUM_LOCKS, stores=1, evictions=evicted)
+        finally:
+            lock.release()
+
+    def stats(self):
+        totals = [0, 0, 0, 0]
+        for stripe in range(self.NUM_LOCKS):
+            for i, count in enumerate(self.STATS.unpack_from(self.buf, stripe * self.STATS.size)):
+                totals[i] += count
+        hits, misses, stores, evictions = totals
+        requests = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": float(hits) / requests if requests else None,
+            "stores": stores,
+            "evictions": evictions,
+            "max_bytes": self.max_bytes,
+            "max_line_length": self.max_line_length
+        }
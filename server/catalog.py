@@ -0,0 +1,193 @@
+import os
+import threading
+import logging
+import time
+import json
+from collections import OrderedDict
+from models import LineFile, IndexProgress
+from metrics import ServerMetrics
+from replica import IndexReplica
+from utils.tools import ErrorUtil
+
+
+# The catalog holds the LineFile of every text file served by one server, by name.
+# A file is named after its file name without the directory, and the first file added is the default file,
+# read by clients which never chose a file.
+#
+# All the files share the server's index page cache, line cache and cache of decompressed blocks, so memory stays
+# within one budget however many files are served. They also count into the same server metrics and access log.
+# Index pages are keyed by the hash of their file path, which keeps the pages of different files apart both in the cache
+# and in the index directory.
+#
+# Indexes are built by a thread of the main process while the server is listening, so processes forked to serve
+# connections never build an index, they wait for the lines they need (see LineFile). When they are built is set by
+# index_build_mode:
+#   "start"       every index is prepared before the server starts listening
+#   "lazy"        an index is built when a request first asks for a line of its file
+#   "background"  the indexes are built one after another as soon as the server starts, files asked for by requests first
+# Prepared indexes are recorded in the manifest, so every process reuses them.
+#
+# On a replica server (replica_of set to "host:port" of the control port of a primary server), an index which has to be
+# built is first fetched from the primary, waiting up to replica_wait_timeout seconds for the primary to have it.
+#
+# An index whose build failed is built again after a delay, doubled after every failure. Meanwhile requests for its
+# lines are answered "ERR NOT READY" at once.
+
+class CatalogError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        super(CatalogError, self).__init__(msg)
+
+
+class LineFileCatalog(object):
+
+    def __init__(self, settings, index_cache=None, line_cache=None, block_cache=None, metrics=None, access_log=None):
+        self.settings = settings
+        self.index_cache = index_cache
+        self.line_cache = line_cache
+        self.block_cache = block_cache
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.access_log = access_log
+        self.line_files = OrderedDict()
+        self.index_builder = None
+
+    def add(self, text_file_path):
+        name = os.path.basename(text_file_path)
+        if name in self.line_files:
+            raise CatalogError("Two text files are named %s" % name)
+        line_file = LineFile(text_file_path, self.settings["num_of_lines_per_index_page"],
+                             self.settings["num_of_index_workers"], self.index_cache, self.line_cache,
+                             self.settings["index_checkpoint_interval"], self.settings["index_page_encoding"],
+                             self.settings["index_page_compression"])
+        line_file.build_index_on_request = False
+        line_file.index_wait_timeout = self.settings["index_wait_timeout"]
+        line_file.block_cache = self.block_cache
+        line_file.metrics = self.metrics
+        if self.settings["replica_of"]:
+            line_file.replica = IndexReplica(IndexReplica.parse_address(self.settings["replica_of"]), name,
+                                             self.settings["replica_wait_timeout"])
+        self.line_files[name] = line_file
+        return line_file
+
+    # Returns the LineFile named name, the default file if name is None, or None if there is no such file
+    def get(self, name=None):
+        if name is None:
+            return self.default()
+        return self.line_files.get(name)
+
+    def default(self):
+        for line_file in self.line_files.values():
+            return line_file
+        return None
+
+    def names(self):
+        return self.line_files.keys()
+
+    # Prepares the indexes as set by index_build_mode
+    def prepare_indexes(self):
+        mode = self.settings["index_build_mode"]
+        if mode == "start":
+            for line_file in self.line_files.values():
+                line_file.prepare_index()
+        self.index_builder = CatalogIndexBuilder(self, mode == "background")
+        self.index_builder.start()
+
+    def stop(self):
+        if self.index_builder:
+            self.index_builder.stop()
+
+    # Brings the indexes of the files which have changed since they were indexed up to date, while their old indexes
+    # keep serving (see LineFile.reload_index). Indexes not built yet are left to the index builder.
+    def reload(self):
+        logger = logging.getLogger(__name__)
+        for name, line_file in self.line_files.items():
+            if line_file.indexing_completed:
+                try:
+                    if line_file.reload_index():
+                        logger.info("The index of %s is reloaded" % name)
+                except Exception:
+                    logger.error("Reloading the index of %s failed", name, exc_info=True)
+
+    # Switches to the indexes another process has brought up to date
+    def refresh(self):
+        logger = logging.getLogger(__name__)
+        for name, line_file in self.line_files.items():
+            if line_file.indexing_completed:
+                try:
+                    line_file.prepare_index(rebuild=False)
+                except Exception:
+                    logger.error("Refreshing the index of %s failed", name, exc_info=True)
+
+    # The index progress of every file
+    def progress(self):
+        return dict((name, line_file.progress.to_dict()) for name, line_file in self.line_files.items())
+
+    def stats(self):
+        return {
+            "index_cache": self.index_cache.stats() if self.index_cache is not None else None,
+            "line_cache": self.line_cache.stats() if self.line_cache is not None else None,
+            "block_cache": self.block_cache.stats() if self.block_cache is not None else None,
+            "metrics": self.metrics.to_dict(),
+            "files": dict((name, {"num_lines": line_file.num_lines, "indexing_completed": line_file.indexing_completed,
+                                  "index_progress": line_file.progress.to_dict()})
+                          for name, line_file in self.line_files.items())
+        }
+
+
+# The thread building the indexes of a catalog. It builds the indexes requests have asked for, the indexes whose build
+# failed when their retry is due and, if build_all is set, every other index not prepared yet.
+class CatalogIndexBuilder(threading.Thread):
+
+    poll_interval = 0.05
+
+    # Seconds before building a failed index again, doubled after every failure up to max_retry_interval
+    retry_interval = 1.0
+    max_retry_interval = 300.0
+
+    def __init__(self, catalog, build_all):
+        self.catalog = catalog
+        self.build_all = build_all
+        # The number of failed builds in a row and the time of the next build, by file name
+        self.retries = {}
+        self.stopped = threading.Event()
+        super(CatalogIndexBuilder, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        logger = logging.getLogger(__name__)
+        while not self.stopped.is_set():
+            name, line_file = self.__next_line_file()
+            if line_file is None:
+                self.stopped.wait(self.poll_interval)
+                continue
+            try:
+                line_file.prepare_index()
+                self.retries.pop(name, None)
+                logger.info("The index of %s is ready" % name)
+            except Exception, arg:
+                line_file.progress.failed()
+                error = ErrorUtil.get_error(arg)
+                logger.error(json.dumps(error, indent=4, sort_keys=True))
+                failures = self.retries.get(name, (0, None))[0] + 1
+                delay = min(self.retry_interval * 2 ** (failures - 1), self.max_retry_interval)
+                self.retries[name] = (failures, time.time() + delay)
+                logger.warning("Building the index of %s failed %d times, retrying in %s seconds", name, failures, delay)
+
+    def stop(self):
+        self.stopped.set()
+
+    # The next file to index: the first one asked for by a request, the first failed one due for a retry,
+    # or the first one not prepared yet
+    def __next_line_file(self):
+        pending = [(name, line_file) for name, line_file in self.catalog.line_files.items()
+                   if line_file.progress.state.value == IndexProgress.PENDING]
+        for name, line_file in pending:
+            if line_file.progress.requested.value:
+                return name, line_file
+        now = time.time()
+        for name, line_file in self.catalog.line_files.items():
+            if line_file.progress.state.value == IndexProgress.FAILED and self.retries.get(name, (0, 0))[1] <= now:
+                return name, line_file
+        if self.build_all and pending:
+            return pending[0]
+        return None, None
@@ -0,0 +1,272 @@
+__author__ = 'white'
+import os
+import mmap
+import struct
+import bisect
+import zlib
+from indexer import IndexPageBuilder, ChunkedIndexBuilder
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Text files can be served compressed with gzip or zstd, if they are made of independently compressed blocks:
+# a gzip file of several members (as written by bgzip, or by CompressedSource.write_blocks), or a zstd file of
+# several frames (as written by the zstd seekable format or by write_blocks). Every block can be decompressed on its own,
+# so a GET only decompresses the block holding its line.
+# An ordinary gzip or zstd file is a single block and is decompressed in full to read any line.
+#
+# While the index is built, the decompressed text is scanned and the start of every block is recorded in a block table:
+# its offset in the compressed file and the offset of its first byte in the decompressed text.
+# Index pages hold offsets in the decompressed text, as for plain text files, and a CompressedTextBuffer turns them
+# into reads of the blocks holding them, through an LRU cache of decompressed blocks.
+# Blocks written by write_blocks end with a newline, so a line is never split between two blocks.
+
+GZIP_MAGIC = "\x1f\x8b"
+ZSTD_MAGIC = "\x28\xb5\x2f\xfd"
+
+# Skippable zstd frames, like the seek table of the zstd seekable format, hold no text
+ZSTD_SKIPPABLE_MAGICS = (0x184D2A50, 0x184D2A5F)
+
+BLOCK_ENTRY = struct.Struct("<QQ")
+
+
+class CompressedSourceError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        super(CompressedSourceError, self).__init__(msg)
+
+
+class CompressedSource(object):
+
+    # Bytes of compressed data decompressed at a time while scanning a gzip member
+    scan_chunk_size = 1024 * 1024
+
+    # The compression of a file ("gzip" or "zstd") found from its first bytes, None for a plain text file
+    @classmethod
+    def detect(cls, file_path):
+        with open(file_path, "rb") as source_file:
+            magic = source_file.read(4)
+        if magic.startswith(GZIP_MAGIC):
+            return "gzip"
+        if magic == ZSTD_MAGIC:
+            return "zstd"
+        return None
+
+    # Decompresses the compressed file and yields (compressed_start, data) for every piece of decompressed text,
+    # in order. compressed_start is the offset of the block in the compressed file for the first piece of a block,
+    # None for the next pieces of the same block.
+    @classmethod
+    def scan(cls, buf, compression):
+        if compression == "gzip":
+            return cls.__scan_gzip(buf)
+        return cls.__scan_zstd(buf)
+
+    @classmethod
+    def __scan_gzip(cls, buf):
+        pos = 0
+        while pos < len(buf):
+            block_start = pos
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while not decompressor.unused_data and pos < len(buf):
+                chunk = buf[pos:pos + cls.scan_chunk_size]
+                pos += len(chunk)
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield block_start, data
+                    block_start = None
+            pos -= len(decompressor.unused_data)
+            data = decompressor.flush()
+            if data:
+                yield block_start, data
+
+    @classmethod
+    def __scan_zstd(cls, buf):
+        pos = 0
+        while pos < len(buf):
+            frame_end, has_text = cls.zstd_frame_end(buf, pos)
+            if has_text:
+                yield pos, cls.decompress_block("zstd", buf[pos:frame_end])
+            pos = frame_end
+
+    # Returns the end of the zstd frame starting at pos, and whether it holds text, by reading the frame
+    # and block headers without decompressing the frame
+    @classmethod
+    def zstd_frame_end(cls, buf, pos):
+        magic = struct.unpack_from("<I", buf, pos)[0]
+        if ZSTD_SKIPPABLE_MAGICS[0] <= magic <= ZSTD_SKIPPABLE_MAGICS[1]:
+            return pos + 8 + struct.unpack_from("<I", buf, pos + 4)[0], False
+        if magic != struct.unpack("<I", ZSTD_MAGIC)[0]:
+            raise CompressedSourceError("Invalid zstd frame at offset %d" % pos)
+        descriptor = ord(buf[pos + 4])
+        single_segment = (descriptor >> 5) & 1
+        pos += 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 3] + \
+            (single_segment, 2, 4, 8)[descriptor >> 6]
+        while True:
+            block_header = struct.unpack("<I", buf[pos:pos + 3] + "\0")[0]
+            pos += 3
+            block_type = (block_header >> 1) & 3
+            pos += 1 if block_type == 1 else block_header >> 3
+            if block_header & 1:
+                break
+        if (descriptor >> 2) & 1:
+            pos += 4
+        return pos, True
+
+    # Decompresses one block: a gzip member or a zstd frame
+    @classmethod
+    def decompress_block(cls, compression, data):
+        if compression == "gzip":
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        if zstandard is None:
+            raise CompressedSourceError("zstandard is not installed, zstd files can not be read")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    # Compresses a text file into blocks of about block_size bytes of text, cut after a newline
+    @classmethod
+    def write_blocks(cls, text_file_path, compressed_file_path, compression="gzip", block_size=1024 * 1024):
+        if compression == "zstd" and zstandard is None:
+            raise CompressedSourceError("zstandard is not installed, zstd files can not be written")
+        with open(text_file_path, "rb") as text_file:
+            with open(compressed_file_path, "wb") as compressed_file:
+                while True:
+                    block = text_file.read(block_size)
+                    if not block:
+                        break
+                    if not block.endswith("\n"):
+                        block += text_file.readline()
+                    if compression == "gzip":
+                        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                        compressed_file.write(compressor.compress(block) + compressor.flush())
+                    else:
+                        compressed_file.write(zstandard.ZstdCompressor().compress(block))
+
+
+# The start of every block of a compressed file, in the compressed file and in the decompressed text.
+# The last entry holds the compressed file size and the decompressed text size.
+class BlockTable(object):
+
+    def __init__(self, compressed_starts, starts):
+        self.compressed_starts = compressed_starts
+        self.starts = starts
+
+    def add(self, compressed_start, start):
+        self.compressed_starts.append(compressed_start)
+        self.starts.append(start)
+
+    def num_blocks(self):
+        return len(self.starts) - 1
+
+    # The block holding the byte at offset of the decompressed text
+    def find(self, offset):
+        return bisect.bisect_right(self.starts, offset, 0, len(self.starts) - 1) - 1
+
+    # The table is written to a temporary file and renamed, like index pages
+    def write(self, block_table_file_path):
+        tmp_file_path = "%s.%d.tmp" % (block_table_file_path, os.getpid())
+        with open(tmp_file_path, "wb") as block_table_file:
+            for entry in zip(self.compressed_starts, self.starts):
+                block_table_file.write(BLOCK_ENTRY.pack(*entry))
+        os.rename(tmp_file_path, block_table_file_path)
+
+    @classmethod
+    def load(cls, block_table_file_path):
+        with open(block_table_file_path, "rb") as block_table_file:
+            data = block_table_file.read()
+        if not data or len(data) % BLOCK_ENTRY.size:
+            raise CompressedSourceError("The block table %s is truncated" % block_table_file_path)
+        entries = struct.unpack("<%dQ" % (len(data) / 8), data)
+        return BlockTable(list(entries[0::2]), list(entries[1::2]))
+
+
+# Scans the decompressed text of a compressed file like ChunkedIndexBuilder and records its block table
+class CompressedIndexBuilder(object):
+
+    def __init__(self, file_path, num_of_lines_per_index_page, write_page, compression):
+        self.file_path = file_path
+        self.num_of_lines_per_index_page = num_of_lines_per_index_page
+        self.write_page = write_page
+        self.compression = compression
+        self.block_table = BlockTable([], [])
+
+    def build(self):
+        page_builder = IndexPageBuilder(self.num_of_lines_per_index_page, self.write_page)
+        with open(self.file_path, "rb") as compressed_file:
+            buf = mmap.mmap(compressed_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = 0
+            for compressed_start, data in CompressedSource.scan(buf, self.compression):
+                if compressed_start is not None:
+                    self.block_table.add(compressed_start, size)
+                if size == 0:
+                    page_builder.add([0])
+                page_builder.add(ChunkedIndexBuilder.find_boundaries(data, size))
+                size += len(data)
+            self.block_table.add(len(buf), size)
+        finally:
+            buf.close()
+        if size and page_builder.offsets[-1] != size:
+            page_builder.add([size])
+        return page_builder.finish()
+
+
+# Reads the decompressed text of a compressed file like a mapped plain text file: by slicing and with find.
+# Decompressed blocks are kept in an LRU cache, which can be shared by several files, keyed by cache_key and
+# the block number.
+class CompressedTextBuffer(object):
+
+    def __init__(self, file_path, compression, block_table, block_cache, cache_key):
+        self.compression = compression
+        self.block_table = block_table
+        self.block_cache = block_cache
+        self.cache_key = cache_key
+        with open(file_path, "rb") as compressed_file:
+            self.buf = mmap.mmap(compressed_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buf) < block_table.compressed_starts[-1]:
+            raise CompressedSourceError("The compressed file %s is shorter than its block table" % file_path)
+
+    def __len__(self):
+        return self.block_table.starts[-1]
+
+    def get_block(self, block_number):
+        key = (self.cache_key, block_number)
+        block = self.block_cache.get(key)
+        if block is None:
+            compressed_starts = self.block_table.compressed_starts
+            compressed = self.buf[compressed_starts[block_number]:compressed_starts[block_number + 1]]
+            block = CompressedSource.decompress_block(self.compression, compressed)
+            self.block_cache.put(key, block, len(block))
+        return block
+
+    # Only slices with a step of 1 are supported
+    def __getitem__(self, index):
+        start, end, step = index.indices(len(self))
+        pieces = []
+        starts = self.block_table.starts
+        block_number = self.block_table.find(start)
+        while start < end:
+            block = self.get_block(block_number)
+            block_start = starts[block_number]
+            pieces.append(block[start - block_start:end - block_start])
+            start = starts[block_number + 1]
+            block_number += 1
+        return "".join(pieces)
+
+    # Finds a one-byte string in [start, end) of the text, -1 if it is not there
+    def find(self, sub, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        starts = self.block_table.starts
+        block_number = self.block_table.find(start)
+        while start < end:
+            block_start = starts[block_number]
+            pos = self.get_block(block_number).find(sub, start - block_start, end - block_start)
+            if pos != -1:
+                return block_start + pos
+            start = starts[block_number + 1]
+            block_number += 1
+        return -1
+
+    def close(self):
+        self.buf.close()
@@ -0,0 +1,329 @@
+import os
+import socket
+import select
+import errno
+import logging
+import threading
+import Queue
+import collections
+import time
+from multiprocessing.pool import ThreadPool
+from protocol import LineProtocol
+
+
+# The event loop server mode serves every connection from one process with an epoll loop, instead of forking a
+# process per connection. It speaks the same protocol as UserRequestHandler.
+#
+# The loop never blocks on the text file: GET, MGET and STREAM commands are handed to a small thread pool, and the pool threads
+# put the replies on a queue and wake the loop through a pipe. A connection has at most one batch of commands in the pool
+# at a time, so replies are always sent in the order of the commands.
+# The event loop never blocks on a socket either, so STREAM replies are copied into the output buffer
+# instead of being sent straight from the text file.
+#
+# When a client ends its input, or the server stops reading because it is being stopped (see lifecycle.py),
+# the commands received are still answered before the connection is closed.
+#
+# A client which sends commands faster than it reads the replies is not read from, and its next commands are not
+# answered, while more than output_buffer_max_bytes of replies wait to be sent to it. A client which sends commands faster
+# than the thread pool answers them is not read from while max_batch_commands commands wait to be answered.
+# A command longer than MAX_COMMAND_LENGTH is cut, so the commands and the bytes read by one recv are all that is held
+# for a connection past these limits, and its buffers stay bounded.
+# A batch of commands failing in the thread pool closes its connection, like an error in UserRequestHandler.
+
+# The state of one client connection
+class EventConnection(object):
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.client_address = client_address
+        self.in_buffer = ""
+        self.out_buffer = ""
+        self.commands = collections.deque()
+        self.file_name = None
+        self.waiting = False
+        self.reading = True
+        self.closing = False
+        self.closed = False
+        self.events = select.EPOLLIN
+
+
+class EventLoopServer(object):
+
+    # Number of commands answered at most by one task of the thread pool, so the replies of a batch do not fill
+    # the output buffer of a connection far past output_buffer_max_bytes
+    max_batch_commands = 100
+
+    # Number of bytes read from a connection at most at once
+    recv_size = 65536
+
+    def __init__(self, catalog, settings, server_address):
+        self.catalog = catalog
+        self.settings = settings
+        self.server_address = server_address
+        self.request_queue_size = settings["num_of_connections_max"]
+        self.output_buffer_max_bytes = settings["output_buffer_max_bytes"]
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connections = {}
+        self.replies = Queue.Queue()
+        self.wake_read, self.wake_write = os.pipe()
+        self.thread_pool = None
+        self.epoll = None
+        self.stop_requested = False
+        self.drain_deadline = None
+        self.stopped = threading.Event()
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+
+    def serve_forever(self):
+        logger = logging.getLogger(__name__)
+        self.stopped.clear()
+        self.thread_pool = ThreadPool(self.settings["num_of_io_threads"])
+        self.epoll = select.epoll()
+        self.epoll.register(self.socket.fileno(), select.EPOLLIN)
+        self.epoll.register(self.wake_read, select.EPOLLIN)
+        draining = False
+        try:
+            while not self.stop_requested:
+                timeout = -1
+                if self.drain_deadline is not None:
+                    if not draining:
+                        self.__start_draining()
+                        draining = True
+                    timeout = self.drain_deadline - time.time()
+                    if not self.connections or timeout <= 0:
+                        break
+                try:
+                    events = self.epoll.poll(timeout)
+                except IOError, err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    try:
+                        if not draining and fd == self.socket.fileno():
+                            self.__accept()
+                        elif fd == self.wake_read:
+                            os.read(self.wake_read, 4096)
+                            self.__send_replies()
+                        elif fd in self.connections:
+                            self.__handle_event(self.connections[fd], event)
+                    except Exception:
+                        logger.error("Error serving connection %d", fd, exc_info=True)
+                        if fd in self.connections:
+                            self.__close(self.connections[fd])
+        finally:
+            if self.connections and draining:
+                logger.warning("%d connections were still open when the server stopped", len(self.connections))
+            for connection in self.connections.values():
+                self.__close(connection)
+            self.thread_pool.terminate()
+            self.epoll.close()
+            self.stopped.set()
+
+    # Stops the event loop and waits until it has exited, like SocketServer's shutdown
+    def shutdown(self):
+        self.stop_requested = True
+        os.write(self.wake_write, "x")
+        self.stopped.wait()
+
+    # Stops accepting connections and lets the connections answer the commands already received until deadline,
+    # then stops the event loop and waits until it has exited
+    def drain(self, deadline):
+        self.drain_deadline = deadline
+        os.write(self.wake_write, "d")
+        self.stopped.wait()
+
+    # Every connection reads the index of the LineFile objects of this process, which are reloaded in place
+    def reload(self):
+        pass
+
+    # Reported by the STATS command of the control port
+    def process_stats(self):
+        return {"server_mode": "event", "connections": len(self.connections)}
+
+    def server_close(self):
+        self.socket.close()
+
+    def __accept(self):
+        logger = logging.getLogger(__name__)
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error, err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            logger.info("User connection from: %s", client_address)
+            sock.setblocking(0)
+            connection = EventConnection(sock, client_address)
+            self.catalog.metrics.count("connections_opened")
+            self.connections[connection.fd] = connection
+            self.epoll.register(connection.fd, select.EPOLLIN)
+
+    def __start_draining(self):
+        self.epoll.unregister(self.socket.fileno())
+        self.socket.close()
+        for connection in self.connections.values():
+            try:
+                connection.sock.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+
+    def __handle_event(self, connection, event):
+        if event & select.EPOLLIN and connection.reading:
+            try:
+                data = connection.sock.recv(self.recv_size)
+            except socket.error, err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.__close(connection)
+                return
+            if not data:
+                # The connection is closed once the commands received are answered
+                connection.reading = False
+                self.__process_commands(connection)
+                return
+            connection.in_buffer += data
+            self.__process_commands(connection)
+        if event & select.EPOLLOUT and not connection.closed:
+            self.__write(connection)
+            # The commands held back while the output buffer was full
+            if connection.commands and not connection.closed and not self.__is_output_full(connection):
+                self.__process_commands(connection)
+        if event & (select.EPOLLHUP | select.EPOLLERR):
+            self.__close(connection)
+
+    # Handles the buffered commands of a connection. Up to max_batch_commands consecutive GET, MGET and STREAM commands
+    # are answered together by one task of the thread pool, and the next commands wait until their replies are queued.
+    # No command is answered while the output buffer is full.
+    def __process_commands(self, connection):
+        logger = logging.getLogger(__name__)
+        log_messages = logger.isEnabledFor(logging.DEBUG)
+        request_msgs, connection.in_buffer = LineProtocol.split_commands(connection.in_buffer)
+        for request_msg in request_msgs:
+            if log_messages:
+                logger.debug("Message from user: %s", request_msg)
+            connection.commands.append(LineProtocol.validate_command(request_msg))
+        while connection.commands and not connection.waiting and not connection.closing and not connection.closed:
+            if self.__is_output_full(connection):
+                self.__write(connection)
+                if connection.closed or self.__is_output_full(connection):
+                    break
+            batch = []
+            while connection.commands and connection.commands[0][1] not in ("QUIT", "SHUTDOWN") and \
+                    len(batch) < self.max_batch_commands:
+                is_validate, cmd, params = connection.commands.popleft()
+                if not is_validate:
+                    self.catalog.metrics.count("invalid_commands")
+                    batch.append(LineProtocol.INVALID_COMMAND)
+                elif cmd == "USE":
+                    batch.append(LineProtocol.get_use_response(self.catalog, params[0]))
+                    if batch[-1].startswith("OK"):
+                        connection.file_name = params[0]
+                else:
+                    batch.append((self.catalog.get(params[0] or connection.file_name), cmd, params))
+            if any(isinstance(item, tuple) for item in batch):
+                connection.waiting = True
+                self.thread_pool.apply_async(_answer_commands, (batch, self.catalog, connection.client_address),
+                                             callback=lambda reply, connection=connection: self.__reply(connection, reply))
+            elif batch:
+                connection.out_buffer += "".join(batch)
+            else:
+                is_validate, cmd, params = connection.commands.popleft()
+                if cmd == "SHUTDOWN":
+                    LineProtocol.notify_main_server_shutdown(self.settings)
+                connection.closing = True
+        if not connection.reading and not connection.commands and not connection.waiting:
+            connection.closing = True
+        self.__write(connection)
+
+    # Called by a pool thread when a batch of commands is answered
+    def __reply(self, connection, reply):
+        self.replies.put((connection, reply))
+        os.write(self.wake_write, "r")
+
+    def __send_replies(self):
+        while True:
+            try:
+                connection, reply = self.replies.get_nowait()
+            except Queue.Empty:
+                return
+            if connection.closed:
+                continue
+            if reply is None:
+                self.__close(connection)
+                continue
+            connection.waiting = False
+            connection.out_buffer += reply
+            self.__process_commands(connection)
+
+    def __is_output_full(self, connection):
+        return len(connection.out_buffer) > self.output_buffer_max_bytes
+
+    # The commands waiting to be answered fill a batch, so no more are read until a batch is answered
+    def __is_input_full(self, connection):
+        return len(connection.commands) >= self.max_batch_commands
+
+    def __write(self, connection):
+        if connection.closed:
+            return
+        if connection.out_buffer:
+            try:
+                sent = connection.sock.send(connection.out_buffer)
+                connection.out_buffer = connection.out_buffer[sent:]
+            except socket.error, err:
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.__close(connection)
+                    return
+        if connection.closing and not connection.out_buffer:
+            self.__close(connection)
+            return
+        reading = connection.reading and not self.__is_output_full(connection) and not self.__is_input_full(connection)
+        events = (select.EPOLLIN if reading else 0) | (select.EPOLLOUT if connection.out_buffer else 0)
+        if events != connection.events:
+            self.epoll.modify(connection.fd, events)
+            connection.events = events
+
+    def __close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.catalog.metrics.count("connections_closed")
+        self.connections.pop(connection.fd, None)
+        try:
+            self.epoll.unregister(connection.fd)
+        except (IOError, ValueError):
+            pass
+        connection.sock.close()
+
+
+# Answers a batch of commands of a client, counts them in the metrics of the catalog and writes them to its access log.
+# Every item is either a reply already known or the LineFile, command and parameters of a data command.
+# Returns None if the batch failed, as a pool thread has no other way to tell the event loop.
+def _answer_commands(batch, catalog, client_address):
+    try:
+        replies = []
+        for item in batch:
+            if isinstance(item, tuple):
+                line_file, cmd, params = item
+                started = time.time()
+                replies.append(LineProtocol.get_data_response(line_file, cmd, params))
+                seconds = time.time() - started
+                catalog.metrics.request(cmd, seconds, replies[-1])
+                if catalog.access_log is not None:
+                    catalog.access_log.log(client_address, cmd, params, seconds, replies[-1])
+            else:
+                replies.append(item)
+        return "".join(replies)
+    except Exception:
+        logger = logging.getLogger(__name__)
+        logger.error("Error serving %s", client_address, exc_info=True)
+        return None
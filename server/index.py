@@ -0,0 +1,441 @@
+__author__ = 'white'
+import json
+import mmap
+import os
+import hashlib
+import random
+import struct
+import zlib
+from compressed import CompressedSource
+
+
+# Index pages are stored in a binary, fixed-width format so a lookup never has to parse a page.
+#
+# Each page file starts with a small header:
+#   magic ("LIDX"), format version, flags, number of lines in the page and a fingerprint of the source text file
+# followed by (number of lines + 1) packed little-endian uint64 file offsets.
+# Entry i is the start offset of line i of the page, entry i + 1 is where that line ends (the start of the next line),
+# so the last entry of a page is the end offset of its last line.
+#
+# Page files are mapped with mmap, so finding the offset of a line is a single unpack_from at a computed position.
+# Index pages written by older versions (a JSON list of line start offsets) have no manifest, so their index is
+# built again.
+#
+# The header version tells how the offsets are encoded:
+#   1 ("fixed")  packed uint64 offsets, as described above
+#   2 ("delta")  the offsets are cut into groups of restart_interval offsets. A restart table holds the first offset of
+#                every group, as a uint64, and the position of the rest of the group in the delta area, as a uint32.
+#                The delta area holds the difference between every other offset and the one before it, as a varint
+#                (7 bits per byte, least significant first, high bit set on every byte but the last).
+#                The restart interval is stored in the last header field.
+# Offsets only grow and lines are short, so most deltas fit in one or two bytes and a delta page is several times
+# smaller than a fixed page. Finding an offset decodes at most restart_interval - 1 varints of its group.
+#
+# With the FLAG_ZLIB header flag, the offsets are compressed with zlib. Compressed pages are
+# decompressed once when they are loaded, and the cache holds the decompressed page.
+#
+# With the FLAG_CHECKSUM header flag, the header is followed by the CRC32 of the rest of the page file, as a uint32,
+# and the offsets start after it. The checksum is checked when the page is loaded, so a page damaged on disk is
+# never used. Every page written has a checksum, pages written by older versions have none.
+#
+# With the FLAG_BUILD header flag, the checksum is followed by the build id of the index, as a uint32, and the
+# offsets start after it. Every build of an index from scratch gets a new random build id, kept in its manifest and
+# in all its pages, also the pages written when the index is extended or repaired. A page is only used with the
+# manifest of its build, so a process still reading an index which was reloaded since, with the same fingerprint,
+# never reads the pages renamed over the old ones as pages of the old index.
+
+INDEX_PAGE_MAGIC = "LIDX"
+INDEX_PAGE_HEADER = struct.Struct("<4sHHI16sI")
+INDEX_OFFSET = struct.Struct("<Q")
+INDEX_LINE_RANGE = struct.Struct("<QQ")
+INDEX_RESTART = struct.Struct("<QI")
+INDEX_CHECKSUM = struct.Struct("<I")
+INDEX_BUILD = struct.Struct("<I")
+
+# The page format version of each encoding
+INDEX_PAGE_VERSIONS = {"fixed": 1, "delta": 2}
+INDEX_PAGE_VERSION = INDEX_PAGE_VERSIONS["fixed"]
+
+# The page compressions and their header flags
+INDEX_PAGE_COMPRESSIONS = {None: 0, "zlib": 1}
+FLAG_ZLIB = INDEX_PAGE_COMPRESSIONS["zlib"]
+FLAG_CHECKSUM = 2
+FLAG_BUILD = 4
+INDEX_PAGE_FLAGS = FLAG_ZLIB | FLAG_CHECKSUM | FLAG_BUILD
+
+# Number of offsets in a group of a delta page
+INDEX_RESTART_INTERVAL = 16
+
+# Number of bytes at the start of a text file used for its fingerprint
+FINGERPRINT_SIZE = 4096
+
+# The sampled content hash of a text file covers this many evenly spread blocks of SAMPLE_SIZE bytes
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 4096
+
+INDEX_MANIFEST_VERSION = 1
+
+
+class IndexPageError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        super(IndexPageError, self).__init__(msg)
+
+
+# An index page in the fixed binary format, backed by a read-only memory map of the page file or by the decompressed page.
+# The offsets start at body_start, after the header, the checksum and the build id.
+class BinaryIndexPage(object):
+
+    def __init__(self, page_number, buf, num_lines, fingerprint, body_start=INDEX_PAGE_HEADER.size, build_id=0):
+        self.page_number = page_number
+        self.buf = buf
+        self.num_lines = num_lines
+        self.fingerprint = fingerprint
+        self.build_id = build_id
+        self.body_start = body_start
+        self.size = len(buf)
+
+    def get_offset(self, i):
+        return INDEX_OFFSET.unpack_from(self.buf, self.body_start + INDEX_OFFSET.size * i)[0]
+
+    # Returns the start and end file offsets of line i of this page
+    def get_line_range(self, i):
+        return INDEX_LINE_RANGE.unpack_from(self.buf, self.body_start + INDEX_OFFSET.size * i)
+
+    # The start offsets of all the lines in this page
+    def line_offsets(self):
+        return list(struct.unpack_from("<%dQ" % self.num_lines, self.buf, self.body_start))
+
+    # The start offsets of all the lines in this page followed by the end offset of its last line
+    def all_offsets(self):
+        return list(struct.unpack_from("<%dQ" % (self.num_lines + 1), self.buf, self.body_start))
+
+    def close(self):
+        if not isinstance(self.buf, str):
+            self.buf.close()
+
+
+# Returns the varint at pos in buf and the position after it
+def read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = ord(buf[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+# An index page in the delta format, backed by a memory map of the page file or by the decompressed page
+class DeltaIndexPage(object):
+
+    def __init__(self, page_number, buf, num_lines, fingerprint, restart_interval, body_start=INDEX_PAGE_HEADER.size,
+                 build_id=0):
+        self.page_number = page_number
+        self.buf = buf
+        self.num_lines = num_lines
+        self.fingerprint = fingerprint
+        self.build_id = build_id
+        self.restart_interval = restart_interval
+        self.num_restarts = num_lines / restart_interval + 1
+        self.body_start = body_start
+        self.deltas_start = body_start + INDEX_RESTART.size * self.num_restarts
+        self.size = len(buf)
+
+    # Returns offset i and the position of the varint of offset i + 1
+    def __find(self, i):
+        group, count = divmod(i, self.restart_interval)
+        buf = self.buf
+        offset, pos = INDEX_RESTART.unpack_from(buf, self.body_start + INDEX_RESTART.size * group)
+        pos += self.deltas_start
+        for j in xrange(count):
+            delta, pos = read_varint(buf, pos)
+            offset += delta
+        return offset, pos
+
+    def get_offset(self, i):
+        return self.__find(i)[0]
+
+    def get_line_range(self, i):
+        if (i + 1) % self.restart_interval == 0:
+            return self.get_offset(i), self.get_offset(i + 1)
+        start, pos = self.__find(i)
+        return start, start + read_varint(self.buf, pos)[0]
+
+    def line_offsets(self):
+        return self.all_offsets()[:-1]
+
+    def all_offsets(self):
+        offsets = []
+        buf = self.buf
+        for group in xrange(self.num_restarts):
+            offset, pos = INDEX_RESTART.unpack_from(buf, self.body_start + INDEX_RESTART.size * group)
+            pos += self.deltas_start
+            offsets.append(offset)
+            for j in xrange(min(self.restart_interval, self.num_lines + 1 - group * self.restart_interval) - 1):
+                delta, pos = read_varint(buf, pos)
+                offset += delta
+                offsets.append(offset)
+        return offsets
+
+    def close(self):
+        if not isinstance(self.buf, str):
+            self.buf.close()
+
+
+# Reading and writing index page files
+class IndexPageFile(object):
+
+    # offsets has (number of lines + 1) entries, see the format description above.
+    # The page is written to a temporary file and renamed, so processes still mapping an older version of the page
+    # keep reading the old file, and a crash while writing never leaves a truncated page behind.
+    # A build_id of 0 writes no build id.
+    @classmethod
+    def write(cls, index_file_path, offsets, fingerprint, encoding="fixed", compression=None, build_id=0):
+        num_lines = len(offsets) - 1
+        if encoding == "delta":
+            body = cls.encode_deltas(offsets, INDEX_RESTART_INTERVAL)
+            reserved = INDEX_RESTART_INTERVAL
+        else:
+            body = struct.pack("<%dQ" % len(offsets), *offsets)
+            reserved = 0
+        if compression == "zlib":
+            body = zlib.compress(body)
+        flags = INDEX_PAGE_COMPRESSIONS[compression] | FLAG_CHECKSUM
+        if build_id:
+            flags |= FLAG_BUILD
+            body = INDEX_BUILD.pack(build_id) + body
+        header = INDEX_PAGE_HEADER.pack(INDEX_PAGE_MAGIC, INDEX_PAGE_VERSIONS[encoding], flags, num_lines, fingerprint,
+                                        reserved)
+        tmp_file_path = "%s.%d.tmp" % (index_file_path, os.getpid())
+        with open(tmp_file_path, "wb") as index_file:
+            index_file.write(header)
+            index_file.write(INDEX_CHECKSUM.pack(zlib.crc32(body) & 0xffffffff))
+            index_file.write(body)
+        os.rename(tmp_file_path, index_file_path)
+
+    # The restart table and the delta area of a delta page
+    @classmethod
+    def encode_deltas(cls, offsets, restart_interval):
+        restarts = []
+        deltas = bytearray()
+        for group_start in xrange(0, len(offsets), restart_interval):
+            group = offsets[group_start:group_start + restart_interval]
+            restarts.append(INDEX_RESTART.pack(group[0], len(deltas)))
+            previous = group[0]
+            for offset in group[1:]:
+                encode_varint(offset - previous, deltas)
+                previous = offset
+        return "".join(restarts) + str(deltas)
+
+    # Raises IndexPageError if the page file is missing, truncated or damaged
+    @classmethod
+    def load(cls, index_file_path, page_number):
+        try:
+            index_file = open(index_file_path, "rb")
+        except IOError:
+            raise IndexPageError("The index page file %s is missing" % index_file_path)
+        with index_file:
+            magic = index_file.read(len(INDEX_PAGE_MAGIC))
+            if magic != INDEX_PAGE_MAGIC:
+                raise IndexPageError("%s is not an index page file" % index_file_path)
+            buf = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buf) < INDEX_PAGE_HEADER.size:
+            buf.close()
+            raise IndexPageError("The index page file %s is truncated" % index_file_path)
+        magic, version, flags, num_lines, fingerprint, reserved = INDEX_PAGE_HEADER.unpack_from(buf, 0)
+        if version not in INDEX_PAGE_VERSIONS.values() or flags & ~INDEX_PAGE_FLAGS:
+            buf.close()
+            raise IndexPageError("Unsupported index page version %d: %s" % (version, index_file_path))
+        body_start = INDEX_PAGE_HEADER.size
+        if flags & FLAG_CHECKSUM:
+            body_start += INDEX_CHECKSUM.size
+            if len(buf) < body_start or INDEX_CHECKSUM.unpack_from(buf, INDEX_PAGE_HEADER.size)[0] != \
+                    zlib.crc32(buffer(buf, body_start)) & 0xffffffff:
+                buf.close()
+                raise IndexPageError("The index page file %s is corrupted" % index_file_path)
+        build_id = 0
+        if flags & FLAG_BUILD:
+            if len(buf) < body_start + INDEX_BUILD.size:
+                buf.close()
+                raise IndexPageError("The index page file %s is truncated" % index_file_path)
+            build_id = INDEX_BUILD.unpack_from(buf, body_start)[0]
+            body_start += INDEX_BUILD.size
+        if flags & FLAG_ZLIB:
+            compressed = buf[:]
+            buf.close()
+            try:
+                buf = compressed[:body_start] + zlib.decompress(compressed[body_start:])
+            except zlib.error:
+                raise IndexPageError("The index page file %s is corrupted" % index_file_path)
+        if version == INDEX_PAGE_VERSIONS["delta"]:
+            if reserved == 0 or len(buf) < body_start + INDEX_RESTART.size * (num_lines / reserved + 1):
+                cls.__close(buf)
+                raise IndexPageError("The index page file %s is truncated" % index_file_path)
+            return DeltaIndexPage(page_number, buf, num_lines, fingerprint, reserved, body_start, build_id)
+        if len(buf) < body_start + INDEX_OFFSET.size * (num_lines + 1):
+            cls.__close(buf)
+            raise IndexPageError("The index page file %s is truncated" % index_file_path)
+        return BinaryIndexPage(page_number, buf, num_lines, fingerprint, body_start, build_id)
+
+    @classmethod
+    def __close(cls, buf):
+        if not isinstance(buf, str):
+            buf.close()
+
+    # The fingerprint of a text file is the md5 digest of its first size bytes, at most FINGERPRINT_SIZE.
+    # It is stored in every index page so pages built from another file are never used.
+    # A file smaller than FINGERPRINT_SIZE is fingerprinted whole, and the number of bytes fingerprinted is kept in
+    # the manifest, so the fingerprint of a small file is still recognized when lines are appended to it.
+    @classmethod
+    def source_fingerprint(cls, file_path, size=FINGERPRINT_SIZE):
+        with open(file_path, "rb") as line_file:
+            return hashlib.md5(line_file.read(min(size, FINGERPRINT_SIZE))).digest()
+
+
+# The manifest is written next to the index pages once they are all built. It describes the text file the pages
+# were built from (size, mtime, inode, a hash of sampled blocks of content and its compression) and the index itself
+# (line count, page size and page format), so a restarted server can tell whether the existing index pages can be reused.
+class IndexManifest(object):
+
+    @classmethod
+    def describe_source(cls, file_path):
+        stat = os.stat(file_path)
+        return {
+            "file_size": stat.st_size,
+            "file_mtime": stat.st_mtime,
+            "file_inode": stat.st_ino,
+            "sampled_hash": cls.sampled_hash(file_path, stat.st_size),
+            "compression": CompressedSource.detect(file_path)
+        }
+
+    # md5 of SAMPLE_COUNT blocks evenly spread over the first file_size bytes of the file
+    @classmethod
+    def sampled_hash(cls, file_path, file_size):
+        digest = hashlib.md5(str(file_size))
+        with open(file_path, "rb") as line_file:
+            if file_size <= SAMPLE_COUNT * SAMPLE_SIZE:
+                digest.update(line_file.read(file_size))
+            else:
+                step = (file_size - SAMPLE_SIZE) / (SAMPLE_COUNT - 1)
+                for i in xrange(SAMPLE_COUNT):
+                    line_file.seek(i * step)
+                    digest.update(line_file.read(SAMPLE_SIZE))
+        return digest.hexdigest()
+
+    # Every manifest created gets a new random index version, which tells caches the index pages have changed.
+    # fingerprint_size is the number of bytes of the text file the fingerprint covers, by default the bytes
+    # source_fingerprint covers in the text file described by source. build_id is the build id of the index pages.
+    @classmethod
+    def create(cls, source, fingerprint, num_lines, num_of_lines_per_index_page, checkpoint_interval=1,
+               encoding="fixed", compression=None, fingerprint_size=None, build_id=0):
+        manifest = dict(source)
+        manifest.update({
+            "index_version": random.getrandbits(32),
+            "version": INDEX_MANIFEST_VERSION,
+            "index_page_version": INDEX_PAGE_VERSIONS[encoding],
+            "index_page_compression": compression,
+            "fingerprint": fingerprint.encode("hex"),
+            "fingerprint_size": fingerprint_size if fingerprint_size is not None else
+            min(source["file_size"], FINGERPRINT_SIZE),
+            "index_build": build_id,
+            "num_lines": num_lines,
+            "num_of_lines_per_index_page": num_of_lines_per_index_page,
+            "index_checkpoint_interval": checkpoint_interval
+        })
+        return manifest
+
+    # The manifest is written to a temporary file and renamed, so a reader never sees a partial manifest
+    @classmethod
+    def write(cls, manifest_file_path, manifest):
+        tmp_file_path = "%s.%d.tmp" % (manifest_file_path, os.getpid())
+        with open(tmp_file_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, sort_keys=True)
+        os.rename(tmp_file_path, manifest_file_path)
+
+    # The number of bytes of the text file the fingerprint of the manifest covers.
+    # Manifests written before it was recorded covered up to FINGERPRINT_SIZE bytes.
+    @classmethod
+    def fingerprint_size(cls, manifest):
+        return manifest.get("fingerprint_size", FINGERPRINT_SIZE)
+
+    # A new build id for the pages of an index built from scratch, never 0
+    @classmethod
+    def new_build_id(cls):
+        return random.randint(1, 0xffffffff)
+
+    # The build id of the index pages of the manifest. Pages written before build ids were introduced have none.
+    @classmethod
+    def build_id(cls, manifest):
+        return manifest.get("index_build", 0)
+
+    # Returns None if there is no readable manifest
+    @classmethod
+    def load(cls, manifest_file_path):
+        try:
+            with open(manifest_file_path, "r") as manifest_file:
+                return json.load(manifest_file)
+        except (IOError, ValueError):
+            return None
+
+    # Whether the index pages described by the manifest can be used with this page size, checkpoint interval and
+    # page encoding and compression.
+    # Manifests written before checkpoints and page encodings were introduced describe dense, fixed, uncompressed indexes.
+    @classmethod
+    def is_compatible(cls, manifest, num_of_lines_per_index_page, checkpoint_interval=1, encoding="fixed",
+                      compression=None):
+        if manifest is None:
+            return False
+        if manifest.get("version") != INDEX_MANIFEST_VERSION or \
+                manifest.get("index_page_version") != INDEX_PAGE_VERSIONS[encoding] or \
+                manifest.get("index_page_compression") != compression:
+            return False
+        return manifest.get("num_of_lines_per_index_page") == num_of_lines_per_index_page and \
+            manifest.get("index_checkpoint_interval", 1) == checkpoint_interval
+
+    @classmethod
+    def matches(cls, manifest, source, num_of_lines_per_index_page, checkpoint_interval=1, encoding="fixed",
+                compression=None):
+        if not cls.is_compatible(manifest, num_of_lines_per_index_page, checkpoint_interval, encoding, compression):
+            return False
+        for key, value in source.items():
+            if manifest.get(key) != value:
+                return False
+        return True
+
+    # Whether the manifest describes an index built from a text with the same content as the text file described by
+    # source, maybe on another host: the same size, compression, fingerprint and sampled content.
+    # fingerprint is the fingerprint of the text file over the bytes the fingerprint of the manifest covers.
+    # Unlike matches, the mtime and the inode of the file are not compared.
+    @classmethod
+    def has_same_text(cls, manifest, source, fingerprint):
+        for key in ("file_size", "sampled_hash", "compression"):
+            if manifest.get(key) != source[key]:
+                return False
+        return manifest.get("fingerprint") == fingerprint.encode("hex")
+
+    # Whether the text file only had bytes appended since the manifest was written:
+    # same inode, bigger, and the same fingerprint and sampled content over the bytes indexed before.
+    # The fingerprint is compared over the bytes it covered when the index was built.
+    # Compressed text files are indexed again when they grow.
+    @classmethod
+    def is_appended(cls, manifest, file_path, num_of_lines_per_index_page, checkpoint_interval=1, encoding="fixed",
+                    compression=None):
+        if not cls.is_compatible(manifest, num_of_lines_per_index_page, checkpoint_interval, encoding, compression) or \
+                manifest["num_lines"] == 0 or manifest.get("compression"):
+            return False
+        stat = os.stat(file_path)
+        if stat.st_ino != manifest["file_inode"] or stat.st_size <= manifest["file_size"]:
+            return False
+        if IndexPageFile.source_fingerprint(file_path, cls.fingerprint_size(manifest)).encode("hex") != \
+                manifest["fingerprint"]:
+            return False
+        return cls.sampled_hash(file_path, manifest["file_size"]) == manifest["sampled_hash"]
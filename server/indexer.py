@@ -0,0 +1,248 @@
+__author__ = 'white'
+import os
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Index builders scan a text file and hand the line offsets to an IndexPageBuilder, which cuts them into index pages.
+#
+# A text file is described by its line boundaries: 0, the offset after every newline and, if the last line has no
+# trailing newline, the file size. Line i starts at boundary i and ends at boundary i + 1,
+# so a page of m lines is m + 1 consecutive boundaries and neighbouring pages share one boundary.
+
+# Cuts a stream of line boundaries into index pages and writes each full page with write_page(page_number, offsets)
+class IndexPageBuilder(object):
+
+    def __init__(self, num_of_lines_per_index_page, write_page, page_number=0):
+        self.num_of_lines_per_index_page = num_of_lines_per_index_page
+        self.write_page = write_page
+        self.offsets = []
+        self.page_number = page_number
+        self.num_lines = 0
+
+    def add(self, boundaries):
+        page_size = self.num_of_lines_per_index_page
+        offsets = self.offsets
+        offsets.extend(boundaries)
+        start = 0
+        while len(offsets) - start > page_size:
+            self.write_page(self.page_number, offsets[start:start + page_size + 1])
+            self.page_number += 1
+            self.num_lines += page_size
+            start += page_size
+        if start:
+            del offsets[:start]
+
+    # Continues after pages written somewhere else. The builder must be holding only the first boundary of
+    # the first skipped page, and offsets start with the first boundary of page_number.
+    def skip_to(self, page_number, offsets):
+        self.num_lines += (page_number - self.page_number) * self.num_of_lines_per_index_page
+        self.page_number = page_number
+        self.offsets = []
+        self.add(offsets)
+
+    # Writes the last partial page and returns the number of lines in the file
+    def finish(self):
+        if len(self.offsets) > 1:
+            self.write_page(self.page_number, self.offsets)
+            self.num_lines += len(self.offsets) - 1
+        self.offsets = []
+        return self.num_lines
+
+
+# The original index builder: reads the file line by line and asks the file object for the offset of every line.
+# It is kept as a reference for benchmarks.
+class ReadlineIndexBuilder(object):
+
+    def __init__(self, file_path, num_of_lines_per_index_page, write_page):
+        self.file_path = file_path
+        self.num_of_lines_per_index_page = num_of_lines_per_index_page
+        self.write_page = write_page
+
+    def build(self):
+        page_builder = IndexPageBuilder(self.num_of_lines_per_index_page, self.write_page)
+        with open(self.file_path, "rb") as line_file:
+            boundaries = []
+            line = line_file.readline()
+            if line:
+                boundaries.append(0)
+            while line:
+                boundaries.append(line_file.tell())
+                if len(boundaries) >= self.num_of_lines_per_index_page:
+                    page_builder.add(boundaries)
+                    boundaries = []
+                line = line_file.readline()
+            page_builder.add(boundaries)
+        return page_builder.finish()
+
+
+# Reads the file in large chunks and finds all the newlines of a chunk in bulk,
+# with NumPy when it is installed and with str.find otherwise.
+class ChunkedIndexBuilder(object):
+
+    chunk_size = 8 * 1024 * 1024
+
+    def __init__(self, file_path, num_of_lines_per_index_page, write_page):
+        self.file_path = file_path
+        self.num_of_lines_per_index_page = num_of_lines_per_index_page
+        self.write_page = write_page
+
+    def build(self):
+        page_builder = IndexPageBuilder(self.num_of_lines_per_index_page, self.write_page)
+        file_size = os.path.getsize(self.file_path)
+        if file_size > 0:
+            page_builder.add([0])
+            self.scan(page_builder, 0, file_size)
+        return page_builder.finish()
+
+    # Continues an index after the file grew from old_size to new_size bytes and returns the new number of lines.
+    # offsets are the boundaries of the last index page (page_number). If the last line had no trailing newline,
+    # the appended bytes belong to it, so its end is dropped and it is scanned again.
+    def extend(self, page_number, offsets, old_size, new_size):
+        page_builder = IndexPageBuilder(self.num_of_lines_per_index_page, self.write_page, page_number)
+        page_builder.num_lines = page_number * self.num_of_lines_per_index_page
+        with open(self.file_path, "rb") as line_file:
+            line_file.seek(old_size - 1)
+            if line_file.read(1) != "\n":
+                offsets = offsets[:-1]
+        page_builder.add(offsets)
+        self.scan(page_builder, old_size, new_size)
+        return page_builder.finish()
+
+    # Adds the boundaries found in bytes [start, end) of the file, and end itself if the last line has no trailing newline
+    def scan(self, page_builder, start, end):
+        with open(self.file_path, "rb") as line_file:
+            line_file.seek(start)
+            base = start
+            while base < end:
+                chunk = line_file.read(min(self.chunk_size, end - base))
+                if not chunk:
+                    break
+                page_builder.add(self.find_boundaries(chunk, base))
+                base += len(chunk)
+        if page_builder.offsets[-1] != end:
+            page_builder.add([end])
+
+    # Returns the offsets right after every newline in chunk, which starts at file offset base
+    @classmethod
+    def find_boundaries(cls, chunk, base):
+        if numpy is not None:
+            positions = numpy.flatnonzero(numpy.frombuffer(chunk, dtype=numpy.uint8) == 10)
+            return (positions + (base + 1)).tolist()
+        boundaries = []
+        append = boundaries.append
+        find = chunk.find
+        pos = find("\n")
+        while pos != -1:
+            pos += 1
+            append(base + pos)
+            pos = find("\n", pos)
+        return boundaries
+
+
+# Splits the file into byte ranges and scans them in a multiprocessing pool.
+#
+# A first pass counts the newlines of every range, which gives the global boundary index of the first newline of each range.
+# In the second pass every worker writes the pages lying entirely inside its range and returns the boundaries
+# before its first page (head) and after its last page (tail). The head and tail of neighbouring ranges form the pages
+# crossing range boundaries, which are stitched and written here in range order.
+class ParallelIndexBuilder(object):
+
+    range_size = 64 * 1024 * 1024
+
+    def __init__(self, file_path, num_of_lines_per_index_page, write_page, num_workers):
+        self.file_path = file_path
+        self.num_of_lines_per_index_page = num_of_lines_per_index_page
+        self.write_page = write_page
+        self.num_workers = num_workers
+
+    def build(self):
+        page_builder = IndexPageBuilder(self.num_of_lines_per_index_page, self.write_page)
+        file_size = os.path.getsize(self.file_path)
+        if file_size == 0:
+            return page_builder.finish()
+
+        num_ranges = max(self.num_workers, (file_size + self.range_size - 1) / self.range_size)
+        range_size = (file_size + num_ranges - 1) / num_ranges
+        ranges = [(start, min(start + range_size, file_size)) for start in xrange(0, file_size, range_size)]
+
+        pool = multiprocessing.Pool(self.num_workers, initializer=_init_scan_worker,
+                                    initargs=(self.file_path, self.num_of_lines_per_index_page, self.write_page))
+        try:
+            counts = pool.map(_count_newlines, ranges)
+            tasks = []
+            first_index = 1
+            for (start, end), count in zip(ranges, counts):
+                tasks.append((start, end, first_index))
+                first_index += count
+
+            page_builder.add([0])
+            for head, page_number, tail in pool.imap(_scan_range, tasks):
+                page_builder.add(head)
+                if tail:
+                    page_builder.skip_to(page_number, tail)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if page_builder.offsets[-1] != file_size:
+            page_builder.add([file_size])
+        return page_builder.finish()
+
+
+# State of a scan worker process, set once by the pool initializer
+_scan_worker = {}
+
+
+def _init_scan_worker(file_path, num_of_lines_per_index_page, write_page):
+    _scan_worker["file_path"] = file_path
+    _scan_worker["num_of_lines_per_index_page"] = num_of_lines_per_index_page
+    _scan_worker["write_page"] = write_page
+
+
+# Reads the byte range [start, end) of the text file in chunks
+def _read_range(start, end):
+    chunk_size = ChunkedIndexBuilder.chunk_size
+    with open(_scan_worker["file_path"], "rb") as line_file:
+        line_file.seek(start)
+        pos = start
+        while pos < end:
+            chunk = line_file.read(min(chunk_size, end - pos))
+            if not chunk:
+                break
+            yield pos, chunk
+            pos += len(chunk)
+
+
+def _count_newlines(byte_range):
+    return sum(chunk.count("\n") for pos, chunk in _read_range(*byte_range))
+
+
+# Writes the pages of a range and returns (head, page number after the written pages, tail).
+# head ends with the first boundary of the first page of the range, tail starts with the first boundary after its last page.
+# If the range does not reach the first boundary of a page, every boundary is in head and tail is empty.
+def _scan_range(task):
+    start, end, first_index = task
+    page_size = _scan_worker["num_of_lines_per_index_page"]
+    first_page_number = (first_index + page_size - 1) / page_size
+    head_end = first_page_number * page_size + 1
+    head = []
+    page_builder = IndexPageBuilder(page_size, _scan_worker["write_page"], first_page_number)
+    index = first_index
+    for pos, chunk in _read_range(start, end):
+        boundaries = ChunkedIndexBuilder.find_boundaries(chunk, pos)
+        if index < head_end:
+            head.extend(boundaries[:head_end - index])
+            if index + len(boundaries) >= head_end:
+                page_builder.add(boundaries[head_end - index - 1:])
+        else:
+            page_builder.add(boundaries)
+        index += len(boundaries)
+    return head, page_builder.page_number, page_builder.offsets
@@ -0,0 +1,148 @@
+import os
+import errno
+import fcntl
+import signal
+import socket
+import threading
+import time
+
+
+# Graceful shutdown: on SIGTERM or SIGINT the server stops accepting connections and stops reading from the open ones.
+# A connection is closed once the commands already received on it are answered, so no client loses a reply to a command
+# the server has read. Connections still open after shutdown_drain_timeout seconds are closed anyway.
+#
+# Reading is stopped with shutdown(SHUT_RD): a handler waiting for commands sees the end of the input at once,
+# while the commands the client sent before are still read and answered first.
+
+# Keeps the client sockets served by a SocketServer server, in the forked child of a connection or in the threads of
+# a pre-fork worker, so reading from them can be stopped when the server stops. Servers call init_connections
+# in their constructor, and UserRequestHandler adds and removes its socket.
+class ConnectionDrainMixIn:
+
+    def init_connections(self):
+        self.connections = set()
+        # An RLock, as a signal handler may drain the connections while the main thread is adding one
+        self.connections_changed = threading.Condition()
+        self.draining = False
+
+    def add_connection(self, sock):
+        with self.connections_changed:
+            self.connections.add(sock)
+            if self.draining:
+                Lifecycle.stop_reading(sock)
+
+    def remove_connection(self, sock):
+        with self.connections_changed:
+            self.connections.discard(sock)
+            self.connections_changed.notify_all()
+
+    # Stops reading from every connection, and from the connections added from now on
+    def drain_connections(self):
+        with self.connections_changed:
+            self.draining = True
+            for sock in self.connections:
+                Lifecycle.stop_reading(sock)
+
+    # Waits until every connection has ended or until deadline, returns the number of connections still open
+    def wait_for_connections(self, deadline):
+        with self.connections_changed:
+            while self.connections:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self.connections_changed.wait(timeout)
+            return len(self.connections)
+
+
+# Runs the requests of signal handlers in a thread. A signal handler runs in the main thread between two statements,
+# so it must not log, start a thread or wait for a lock the interrupted code may hold: it only writes the request
+# to a pipe, and this thread reads it and calls its action. actions maps a request, one character, to its action.
+class SignalRequests(threading.Thread):
+
+    def __init__(self, actions):
+        self.actions = actions
+        self.read_fd, self.write_fd = os.pipe()
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        super(SignalRequests, self).__init__()
+        self.daemon = True
+
+    # Called by a signal handler. A request is dropped if the pipe is full of requests not read yet.
+    def request(self, request):
+        try:
+            os.write(self.write_fd, request)
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                requests = os.read(self.read_fd, 64)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            for request in requests:
+                self.actions[request]()
+
+
+class Lifecycle(object):
+
+    STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+    # Interval of polling child processes for their exit
+    poll_interval = 0.05
+
+    # Calls handler(signum, frame) on each of the signals. Returns False if signals can not be handled,
+    # which is the case outside the main thread
+    @classmethod
+    def handle_signals(cls, signums, handler):
+        try:
+            for signum in signums:
+                signal.signal(signum, handler)
+            return True
+        except ValueError:
+            return False
+
+    @classmethod
+    def stop_reading(cls, sock):
+        try:
+            sock.shutdown(socket.SHUT_RD)
+        except socket.error:
+            pass
+
+    # Sends SIGTERM to the child processes pids and reaps them until deadline, then kills the ones still running.
+    # pids is a set, emptied as the processes are reaped. Returns the number of processes killed.
+    @classmethod
+    def stop_child_processes(cls, pids, deadline):
+        for pid in list(pids):
+            cls.__kill(pids, pid, signal.SIGTERM)
+        while pids and time.time() < deadline:
+            cls.__reap(pids, os.WNOHANG)
+            if pids:
+                time.sleep(cls.poll_interval)
+        killed = len(pids)
+        for pid in list(pids):
+            cls.__kill(pids, pid, signal.SIGKILL)
+        while pids:
+            cls.__reap(pids, 0)
+        return killed
+
+    @classmethod
+    def __kill(cls, pids, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, err:
+            if err.errno == errno.ESRCH:
+                pids.discard(pid)
+
+    @classmethod
+    def __reap(cls, pids, options):
+        for pid in list(pids):
+            try:
+                if os.waitpid(pid, options)[0] == pid:
+                    pids.discard(pid)
+            except OSError, err:
+                if err.errno == errno.ECHILD:
+                    pids.discard(pid)
+                elif err.errno != errno.EINTR:
+                    raise
@@ -0,0 +1,209 @@
+__author__ = 'white'
+import os
+import mmap
+import math
+import struct
+import multiprocessing
+
+
+# Server metrics in an anonymous shared memory mapping, like SharedLineCache, so the counts of every process
+# forked after the metrics are created (connection children and pre-forked workers) add up, and are kept when
+# a process exits. The control port reports them with the STATS command, and in the Prometheus text format
+# with the METRICS command.
+#
+# The mapping holds one stripe of uint64 counters per lock, and a process always counts into the stripe picked by
+# its pid, so processes rarely wait for each other. A lock that can not be taken within a short time drops the count
+# instead of blocking the request.
+#
+# Request latencies are counted in a histogram per data command. Bucket i counts latencies up to 2 ** (i / 4)
+# microseconds, so percentiles read from the histogram are at most 19% above the real value.
+
+class ServerMetrics(object):
+
+    NUM_LOCKS = 16
+    LOCK_TIMEOUT = 0.1
+
+    COUNTERS = ("connections_opened", "connections_closed", "invalid_commands", "index_page_hits", "index_page_loads",
+                "index_page_load_us", "index_page_repairs")
+    COMMANDS = ("GET", "MGET", "STREAM")
+    # Replies are counted by their first line: "OK...", "ERR NOT READY", "ERR" and "Server error..."
+    OUTCOMES = ("ok", "not_ready", "err", "server_error")
+
+    BUCKETS_PER_OCTAVE = 4
+    NUM_BUCKETS = 27 * BUCKETS_PER_OCTAVE
+
+    PERCENTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+
+    COUNTER = struct.Struct("<Q")
+
+    def __init__(self):
+        # the slots of a command: requests, one per outcome, the sum of the latencies in microseconds, the histogram
+        self.command_size = 2 + len(self.OUTCOMES) + self.NUM_BUCKETS
+        self.stripe_size = len(self.COUNTERS) + len(self.COMMANDS) * self.command_size
+        self.buf = mmap.mmap(-1, self.stripe_size * self.COUNTER.size * self.NUM_LOCKS)
+        self.locks = [multiprocessing.Lock() for i in range(self.NUM_LOCKS)]
+
+    # Upper bound of bucket i, in microseconds
+    @classmethod
+    def bucket_bound(cls, i):
+        return 2 ** (float(i) / cls.BUCKETS_PER_OCTAVE)
+
+    @classmethod
+    def get_bucket(cls, latency_us):
+        if latency_us <= 1:
+            return 0
+        return min(cls.NUM_BUCKETS - 1, int(math.ceil(math.log(latency_us, 2) * cls.BUCKETS_PER_OCTAVE)))
+
+    @classmethod
+    def get_outcome(cls, reply):
+        if reply.startswith("OK"):
+            return "ok"
+        if reply.startswith("ERR NOT READY"):
+            return "not_ready"
+        if reply.startswith("ERR"):
+            return "err"
+        return "server_error"
+
+    # Adds counts to slots of the stripe of this process, given as {slot: count}
+    def __add(self, counts):
+        stripe = os.getpid() % self.NUM_LOCKS
+        lock = self.locks[stripe]
+        if not lock.acquire(True, self.LOCK_TIMEOUT):
+            return
+        try:
+            base = stripe * self.stripe_size
+            for slot, count in counts.items():
+                pos = (base + slot) * self.COUNTER.size
+                self.COUNTER.pack_into(self.buf, pos, self.COUNTER.unpack_from(self.buf, pos)[0] + count)
+        finally:
+            lock.release()
+
+    def count(self, name, count=1):
+        self.__add({self.COUNTERS.index(name): count})
+
+    # Counts a GET, MGET or STREAM command answered in seconds with reply, the reply or its first line
+    def request(self, cmd, seconds, reply):
+        latency_us = int(seconds * 1000000)
+        base = len(self.COUNTERS) + self.COMMANDS.index(cmd) * self.command_size
+        self.__add({
+            base: 1,
+            base + 1 + self.OUTCOMES.index(self.get_outcome(reply)): 1,
+            base + 1 + len(self.OUTCOMES): latency_us,
+            base + 2 + len(self.OUTCOMES) + self.get_bucket(latency_us): 1
+        })
+
+    def index_page_loaded(self, seconds):
+        self.__add({self.COUNTERS.index("index_page_loads"): 1,
+                    self.COUNTERS.index("index_page_load_us"): int(seconds * 1000000)})
+
+    # The sum of every slot over the stripes
+    def __totals(self):
+        totals = [0] * self.stripe_size
+        for stripe in range(self.NUM_LOCKS):
+            values = struct.unpack_from("<%dQ" % self.stripe_size, self.buf, stripe * self.stripe_size * self.COUNTER.size)
+            for i, value in enumerate(values):
+                totals[i] += value
+        return totals
+
+    # The latency in microseconds under which a fraction of the requests of a histogram were answered
+    @classmethod
+    def percentile(cls, histogram, fraction):
+        total = sum(histogram)
+        if total == 0:
+            return None
+        seen = 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if seen >= total * fraction:
+                return round(cls.bucket_bound(i), 1)
+
+    def to_dict(self):
+        totals = self.__totals()
+        metrics = dict(zip(self.COUNTERS, totals))
+        metrics["connections_active"] = metrics["connections_opened"] - metrics["connections_closed"]
+        metrics["index_page_hit_rate"] = float(metrics["index_page_hits"]) / \
+            (metrics["index_page_hits"] + metrics["index_page_loads"]) if metrics["index_page_loads"] else None
+        commands = {}
+        for i, cmd in enumerate(self.COMMANDS):
+            slots = totals[len(self.COUNTERS) + i * self.command_size:len(self.COUNTERS) + (i + 1) * self.command_size]
+            histogram = slots[2 + len(self.OUTCOMES):]
+            command = dict(zip(self.OUTCOMES, slots[1:1 + len(self.OUTCOMES)]))
+            command["requests"] = slots[0]
+            command["latency_us_sum"] = slots[1 + len(self.OUTCOMES)]
+            command["histogram"] = histogram
+            for name, fraction in self.PERCENTILES:
+                command["latency_us_%s" % name] = self.percentile(histogram, fraction)
+            commands[cmd] = command
+        metrics["commands"] = commands
+        return metrics
+
+
+# Formats the STATS of a server in the Prometheus text exposition format
+class PrometheusFormat(object):
+
+    prefix = "linesvr_"
+
+    @classmethod
+    def format(cls, stats):
+        lines = []
+        metrics = stats["metrics"]
+
+        def add(name, metric_type, samples, help_text):
+            lines.append("# HELP %s%s %s" % (cls.prefix, name, help_text))
+            lines.append("# TYPE %s%s %s" % (cls.prefix, name, metric_type))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ",".join('%s="%s"' % (key, labels[key]) for key in sorted(labels))
+                lines.append("%s%s%s %s" % (cls.prefix, name, "{%s}" % label_text if label_text else "", value))
+
+        add("connections_total", "counter", [({}, metrics["connections_opened"])], "Connections accepted.")
+        add("connections_active", "gauge", [({}, metrics["connections_active"])], "Connections open.")
+        add("invalid_commands_total", "counter", [({}, metrics["invalid_commands"])], "Invalid commands received.")
+        commands = metrics["commands"]
+        add("requests_total", "counter",
+            [({"command": cmd, "outcome": outcome}, commands[cmd][outcome])
+             for cmd in ServerMetrics.COMMANDS for outcome in ServerMetrics.OUTCOMES],
+            "Data commands answered, by command and outcome.")
+
+        # The histogram is reported at every power of two microseconds
+        samples = []
+        for cmd in ServerMetrics.COMMANDS:
+            histogram = commands[cmd]["histogram"]
+            for i in range(0, ServerMetrics.NUM_BUCKETS, ServerMetrics.BUCKETS_PER_OCTAVE):
+                bound = ServerMetrics.bucket_bound(i) / 1000000
+                samples.append(({"command": cmd, "le": repr(bound)}, sum(histogram[:i + 1])))
+            samples.append(({"command": cmd, "le": "+Inf"}, commands[cmd]["requests"]))
+        lines.append("# HELP %srequest_duration_seconds Time to answer a data command." % cls.prefix)
+        lines.append("# TYPE %srequest_duration_seconds histogram" % cls.prefix)
+        for labels, value in samples:
+            lines.append('%srequest_duration_seconds_bucket{command="%s",le="%s"} %d' %
+                         (cls.prefix, labels["command"], labels["le"], value))
+        for cmd in ServerMetrics.COMMANDS:
+            lines.append('%srequest_duration_seconds_sum{command="%s"} %r' %
+                         (cls.prefix, cmd, commands[cmd]["latency_us_sum"] / 1000000.0))
+            lines.append('%srequest_duration_seconds_count{command="%s"} %d' %
+                         (cls.prefix, cmd, commands[cmd]["requests"]))
+
+        add("index_page_hits_total", "counter", [({}, metrics["index_page_hits"])], "Index page lookups served from the cache.")
+        add("index_page_loads_total", "counter", [({}, metrics["index_page_loads"])], "Index pages loaded from disk.")
+        add("index_page_load_seconds_total", "counter", [({}, metrics["index_page_load_us"] / 1000000.0)],
+            "Time spent loading index pages.")
+        add("index_page_repairs_total", "counter", [({}, metrics["index_page_repairs"])],
+            "Damaged index pages rebuilt from the text file.")
+        line_cache = stats["line_cache"]
+        if line_cache is not None:
+            add("line_cache_hits_total", "counter", [({}, line_cache["hits"])], "Line cache hits.")
+            add("line_cache_misses_total", "counter", [({}, line_cache["misses"])], "Line cache misses.")
+        files = stats["files"]
+        add("index_lines_ready", "gauge", [({"file": name}, files[name]["index_progress"]["lines_ready"])
+                                           for name in sorted(files)], "Lines whose index page is written.")
+        add("index_ready", "gauge", [({"file": name}, int(files[name]["index_progress"]["state"] == "ready"))
+                                     for name in sorted(files)], "Whether the index of a file is ready.")
+        add("lines", "gauge", [({"file": name}, files[name]["num_lines"]) for name in sorted(files)],
+            "Lines of a file.")
+        server = stats.get("server") or {}
+        for name in sorted(server):
+            if isinstance(server[name], (int, long)):
+                add("server_%s" % name, "gauge", [({}, server[name])], "Server %s." % name.replace("_", " "))
+        return "\n".join(lines) + "\n"
@@ -1,9 +1,19 @@
-import sys
 import logging
 import json
 import os
+import mmap
 import hashlib
-from utils.tools import ErrorUtil, FileUtil
+import shutil
+import tempfile
+import time
+import threading
+import multiprocessing
+import ctypes
+from utils.tools import ErrorUtil, FileUtil, FileLock
+from index import IndexPageFile, IndexPageError, IndexManifest
+from indexer import ChunkedIndexBuilder, ParallelIndexBuilder
+from cache import LRUCache
+from compressed import CompressedIndexBuilder, CompressedTextBuffer, BlockTable
 
 
 # LineFile is the data model class which encapsulate text file pre-processing and accessing.
@@ -18,49 +28,457 @@ from utils.tools import ErrorUtil, FileUtil
 # If a text file has more than m lines, the system does n/m to determine which index file,
 # and use n % m to get the index(file offset) for line n from that index file.
 
+# Index pages are kept mapped in an LRU cache bounded by the size of the mapped pages. The mappings are backed by
+# the OS page cache, so forked child processes inherit the pages mapped by the parent and share their memory.
+# A cache can be shared by several LineFile objects.
+
+# The text file itself is mapped once and lines are sliced out of the mapping, using the next line's offset in the index
+# as the end of a line, so a GET needs neither open/seek/readline nor a file position shared between threads.
+# The read-only mapping stays valid in forked child processes.
+# Reading a mapped page past the end of a file which was truncated or rewritten shorter kills the process with SIGBUS,
+# so the size of the mapped file is checked before the mapping is read. Once the file is shorter than its mapping,
+# its lines are answered as missing until its index is rebuilt (by the IndexRefresher or a reload on SIGHUP).
+
+# An optional SharedLineCache in front of the index keeps the contents of frequently requested lines.
+# Cached lines are tagged with the index version from the manifest, so they are invalidated when the index changes.
+
+# Text files compressed with gzip or zstd are served from their decompressed text, a block of the compressed file at
+# a time (see compressed.py). Their index pages hold offsets in the decompressed text, and a block table written next
+# to the index pages finds the compressed block of an offset. Their lines can be read once the whole index is built.
+
+# Index pages are written in the fixed format, or in the smaller delta format with index_page_encoding "delta",
+# and may be compressed with zlib (see index.py).
+
+# In the sparse index mode (index_checkpoint_interval K > 1), the index records only the offset of every K-th line,
+# a checkpoint. Each index page entry is then a checkpoint, so an index page covers K times more lines and the index
+# is K times smaller. A GET finds the checkpoint before its line and the next one, and searches for the line
+# between them in the mapped text file with mmap.find, which scans for newlines in C. Larger K means a smaller index
+# and longer scans.
+
+# An index can be built while lines are being served. Its progress is kept in shared memory (IndexProgress), so every
+# process sees which lines already have their index page written. A GET for a line not indexed yet waits up to
+# index_wait_timeout seconds and then gets a "not ready" status (503). A GET never builds an index itself:
+# it asks for the index, and the index is built by a background thread.
+
+# Index pages carry a checksum which is checked when a page is loaded. A page found missing or damaged is rebuilt by
+# a background thread, which scans again only the lines of that page in the text file (repair_index_page).
+# Meanwhile the GETs of its lines wait like GETs of lines not indexed yet.
+
+# On a replica server, an index which has to be built is copied from the primary server instead (see replica.py),
+# and only used if it fits the local text file.
+
+# When a text file is replaced or rewritten while it is served, reload_index builds its new index next to the old one,
+# which keeps serving the old text until the new index pages are renamed over it. Other processes switch to
+# the new index when they read its manifest, or when they load one of its pages.
+
+class IndexNotReadyError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        super(IndexNotReadyError, self).__init__(msg)
+
+
+# The text file is shorter than the mapping the lines are read from
+class TextFileChangedError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        super(TextFileChangedError, self).__init__(msg)
+
+
+# The progress of building the index of a LineFile, in shared memory so processes forked before or while the index
+# is built follow it. Index pages are built in line order, and lines_ready counts the lines whose pages are written.
+# Pages written out of order by the parallel index builder only become readable when the whole index is ready.
+class IndexProgress(object):
+
+    PENDING, BUILDING, READY, FAILED = range(4)
+    STATE_NAMES = ("pending", "building", "ready", "failed")
+
+    def __init__(self):
+        self.state = multiprocessing.Value("i", self.PENDING, lock=False)
+        self.requested = multiprocessing.Value("i", 0, lock=False)
+        self.lines_ready = multiprocessing.Value(ctypes.c_longlong, 0, lock=False)
+        self.bytes_ready = multiprocessing.Value(ctypes.c_longlong, 0, lock=False)
+        self.file_size = multiprocessing.Value(ctypes.c_longlong, 0, lock=False)
+        self.fingerprint = multiprocessing.Array("c", hashlib.md5().digest_size, lock=False)
+        self.build_id = multiprocessing.Value(ctypes.c_uint32, 0, lock=False)
+
+    def start(self, file_size, fingerprint, build_id):
+        self.lines_ready.value = 0
+        self.bytes_ready.value = 0
+        self.file_size.value = file_size
+        self.fingerprint.raw = fingerprint
+        self.build_id.value = build_id
+        self.state.value = self.BUILDING
+
+    # offsets are the offsets written to index page page_number
+    def page_written(self, page_number, num_of_lines_per_index_page, offsets):
+        if self.state.value == self.BUILDING and page_number * num_of_lines_per_index_page == self.lines_ready.value:
+            self.bytes_ready.value = offsets[-1]
+            self.lines_ready.value += len(offsets) - 1
+
+    def ready(self, num_lines, file_size, fingerprint):
+        self.lines_ready.value = num_lines
+        self.bytes_ready.value = file_size
+        self.file_size.value = file_size
+        self.fingerprint.raw = fingerprint
+        self.state.value = self.READY
+        self.requested.value = 0
+
+    def failed(self):
+        self.state.value = self.FAILED
+
+    def to_dict(self):
+        file_size = self.file_size.value
+        return {
+            "state": self.STATE_NAMES[self.state.value],
+            "lines_ready": self.lines_ready.value,
+            "bytes_ready": self.bytes_ready.value,
+            "file_size": file_size,
+            "percent": round(100.0 * self.bytes_ready.value / file_size, 1) if file_size else None
+        }
+
+
 class LineFile(object):
 
-    def __init__(self, file_path, num_of_lines_per_index_page):
+    default_index_cache_max_bytes = 64 * 1024 * 1024
+    default_block_cache_max_bytes = 16 * 1024 * 1024
+
+    # Number of bytes of the text file scanned at a time when repairing an index page
+    repair_chunk_size = 1024 * 1024
+
+    def __init__(self, file_path, num_of_lines_per_index_page, num_of_index_workers=1, index_cache=None, line_cache=None,
+                 index_checkpoint_interval=1, index_page_encoding="fixed", index_page_compression=None):
         self.file_path = file_path
         self.file_dir = os.path.dirname(os.path.abspath(file_path))
         self.file_path_hash = hashlib.sha256(self.file_path).hexdigest()
-        self.index_page = []
         self.indexing_completed = False
         self.num_lines = 0
         self.num_of_lines_per_index_page = num_of_lines_per_index_page
-        self.current_index_page = -1
+        self.index_checkpoint_interval = index_checkpoint_interval
+        self.index_page_encoding = index_page_encoding
+        self.index_page_compression = index_page_compression
+        self.index_cache = index_cache if index_cache is not None else LRUCache(self.default_index_cache_max_bytes)
+        self.text_buffer = None
+        self.line_cache = line_cache
+        self.file_key = int(self.file_path_hash[:16], 16)
+        self.index_version = 0
+        self.fingerprint = None
+        # The build id of the index pages in use, see index.py
+        self.index_build = 0
+        self.index_builder = ChunkedIndexBuilder
+        self.num_of_index_workers = num_of_index_workers
+        self.file_size = 0
+        self.index_lock = FileLock(self.__get_lock_file_path())
+        self.progress = IndexProgress()
+        # Whether a GET for a file never indexed starts building its index in a thread of the calling process.
+        # A LineFileCatalog turns this off, as it builds the indexes itself.
+        self.build_index_on_request = True
+        self.index_wait_timeout = 2.0
+        self.index_wait_interval = 0.01
+        self.index_build_thread = None
+        # The compression of the text file, and the cache of its decompressed blocks, which a LineFileCatalog shares
+        # between its files
+        self.compression = None
+        self.block_cache = None
+        # The ServerMetrics counting index page loads, set by a LineFileCatalog
+        self.metrics = None
+        # The threads repairing damaged index pages, by page number
+        self.page_repairs = {}
+        self.page_repairs_lock = threading.Lock()
+        # The IndexReplica fetching the index from a primary server, set by a LineFileCatalog on a replica
+        self.replica = None
 
-    # The method for building index before starting the server
-    def buildIndex(self):
-        index_page_size = self.num_of_lines_per_index_page
-        with open(self.file_path, "r") as line_file:
+    # The method for preparing index before starting the server, also used to bring the index up to date
+    # when the text file has changed.
+    # The index pages left by a previous run (or by another process) are reused if the manifest shows they were built
+    # from the same text file. If the file only grew, the appended bytes are indexed, otherwise the index is rebuilt.
+    # A lock file makes sure only one process at a time updates the index.
+    # If rebuild is False, an index which has to be built again from scratch is left as it is.
+    def prepare_index(self, rebuild=True):
+        with self.index_lock.hold():
+            if self.__reuse_index() or not rebuild:
+                return
+            if self.replica is None:
+                self.buildIndex()
+                return
+        # The primary may take long to send its index, so it is copied outside the index lock,
+        # which is only taken again to check and install it
+        folder = tempfile.mkdtemp(prefix="%s.replica." % self.file_path_hash,
+                                  dir=os.path.dirname(self.__get_manifest_file_path()))
+        try:
+            manifest = self.replica.fetch(folder)
+            with self.index_lock.hold():
+                # Another process may have prepared the index meanwhile
+                if not self.__reuse_index() and not self.__install_fetched_index(folder, manifest):
+                    self.buildIndex()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    # Uses the index left by a previous run or another process, extending it if the text file only grew.
+    # Returns False if the index has to be built again from scratch.
+    def __reuse_index(self):
+        logger = logging.getLogger(__name__)
+        manifest = IndexManifest.load(self.__get_manifest_file_path())
+        if IndexManifest.matches(manifest, IndexManifest.describe_source(self.file_path), self.num_of_lines_per_index_page,
+                                 self.index_checkpoint_interval, self.index_page_encoding, self.index_page_compression):
+            if manifest["num_lines"] != self.num_lines or not self.indexing_completed:
+                logger.info("Reusing indexes: %s, # of lines: %d" % (str(self.file_path), manifest["num_lines"]))
+            self.__use_manifest(manifest)
+            return True
+        if IndexManifest.is_appended(manifest, self.file_path, self.num_of_lines_per_index_page,
+                                     self.index_checkpoint_interval, self.index_page_encoding,
+                                     self.index_page_compression):
+            self.__use_manifest(manifest)
+            self.__extend_index(manifest)
+            return True
+        return False
 
+    # Starts preparing the index in a thread of this process, unless it is being prepared already
+    def start_index_build(self):
+        with self.index_lock.thread_lock:
+            if self.index_build_thread is None or not self.index_build_thread.is_alive():
+                self.index_build_thread = threading.Thread(target=self.__build_in_background)
+                self.index_build_thread.daemon = True
+                self.index_build_thread.start()
+
+    def __build_in_background(self):
+        try:
+            self.prepare_index()
+        except Exception, arg:
+            self.progress.failed()
+            error = ErrorUtil.get_error(arg)
             logger = logging.getLogger(__name__)
-            logger.info("Building indexes: %s" % str(self.file_path))
-            self.__delete_index_files()
-
-            last_pos = 0
-            i = 0
-            line = line_file.readline()
-            while line:
-                self.index_page.append(last_pos)
-                last_pos = line_file.tell()
-                if (i + 1) % index_page_size == 0:
-                    self.__write_to_index_page(i/index_page_size)
-                    del self.index_page[:]
-                i += 1
-                line = line_file.readline()
-            if len(self.index_page) > 0:
-                self.__write_to_index_page((i - 1)/index_page_size)
-                del self.index_page[:]
-            self.num_lines = i
-            self.indexing_completed = True
-            logger.info("Building indexes is completed: %s" % str(self.file_path))
-
-    # Delete index files before building
+            logger.error(json.dumps(error, indent=4, sort_keys=True))
+
+    # Whether the text file size differs from the size the index was built for
+    def is_file_changed(self):
+        return os.path.getsize(self.file_path) != self.file_size
+
+    # The method for building index from scratch
+    def buildIndex(self):
+        logger = logging.getLogger(__name__)
+        logger.info("Building indexes: %s" % str(self.file_path))
+        self.indexing_completed = False
+        self.__delete_index_files()
+        self.__discard_index_pages()
+        self.text_buffer = None
+        source = IndexManifest.describe_source(self.file_path)
+        self.fingerprint = IndexPageFile.source_fingerprint(self.file_path, source["file_size"])
+        self.index_build = IndexManifest.new_build_id()
+        self.progress.start(source["file_size"], self.fingerprint, self.index_build)
+        self.compression = source["compression"]
+
+        builder = self.__get_index_builder(self.compression, self.__write_to_index_page)
+        try:
+            num_lines = builder.build()
+            if self.compression:
+                builder.block_table.write(self.__get_block_table_file_path())
+        except:
+            self.progress.failed()
+            raise
+        manifest = IndexManifest.create(source, self.fingerprint, num_lines, self.num_of_lines_per_index_page,
+                                        self.index_checkpoint_interval, self.index_page_encoding,
+                                        self.index_page_compression, build_id=self.index_build)
+        IndexManifest.write(self.__get_manifest_file_path(), manifest)
+        self.__use_manifest(manifest)
+        logger.info("Building indexes is completed: %s, # of lines: %d" % (str(self.file_path), self.num_lines))
+
+    # The builder scanning the text file for its index, writing the index pages with write_page
+    def __get_index_builder(self, compression, write_page):
+        if compression:
+            return CompressedIndexBuilder(self.file_path, self.get_lines_per_index_page(), write_page, compression)
+        if self.num_of_index_workers > 1:
+            return ParallelIndexBuilder(self.file_path, self.get_lines_per_index_page(), write_page,
+                                        self.num_of_index_workers)
+        return self.index_builder(self.file_path, self.get_lines_per_index_page(), write_page)
+
+    # Brings a complete index up to date with its text file while its lines keep being served. A file which only grew
+    # is extended like by prepare_index. The index of a file which was replaced or rewritten is built again in
+    # a folder next to the index, and installed once it is complete, so the old index serves the old text meanwhile.
+    # Returns True if the index was built again.
+    def reload_index(self):
+        logger = logging.getLogger(__name__)
+        with self.index_lock.hold():
+            manifest = IndexManifest.load(self.__get_manifest_file_path())
+            rebuild = self.indexing_completed and \
+                not IndexManifest.matches(manifest, IndexManifest.describe_source(self.file_path),
+                                          self.num_of_lines_per_index_page, self.index_checkpoint_interval,
+                                          self.index_page_encoding, self.index_page_compression) and \
+                not IndexManifest.is_appended(manifest, self.file_path, self.num_of_lines_per_index_page,
+                                              self.index_checkpoint_interval, self.index_page_encoding,
+                                              self.index_page_compression)
+        if not rebuild:
+            self.prepare_index()
+            return False
+
+        logger.info("Rebuilding indexes: %s" % str(self.file_path))
+        folder = tempfile.mkdtemp(prefix="%s.reload." % self.file_path_hash,
+                                  dir=os.path.dirname(self.__get_manifest_file_path()))
+        try:
+            source = IndexManifest.describe_source(self.file_path)
+            fingerprint = IndexPageFile.source_fingerprint(self.file_path, source["file_size"])
+            build_id = IndexManifest.new_build_id()
+            write_page = lambda index_page_number, offsets: self.__write_index_page_file(
+                os.path.join(folder, "%d.idx" % index_page_number), offsets, fingerprint, build_id)
+            builder = self.__get_index_builder(source["compression"], write_page)
+            num_lines = builder.build()
+            block_table_file_path = None
+            if source["compression"]:
+                block_table_file_path = os.path.join(folder, "blocks")
+                builder.block_table.write(block_table_file_path)
+            page_file_paths = [os.path.join(folder, "%d.idx" % i) for i in xrange(self.__get_num_index_pages(num_lines))]
+            with self.index_lock.hold():
+                if IndexManifest.describe_source(self.file_path) != source:
+                    logger.warning("%s changed while its index was rebuilt, it is reloaded again later", self.file_path)
+                    return False
+                self.__install_index(page_file_paths, block_table_file_path, source, fingerprint, num_lines,
+                                     build_id=build_id)
+            logger.info("Rebuilding indexes is completed: %s, # of lines: %d" % (str(self.file_path), self.num_lines))
+            return True
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    # Replaces the index with the index pages page_file_paths and the block table block_table_file_path, built from
+    # the text file described by source. The manifest is deleted first and written last, so a partly replaced index
+    # is never reused. The pages are renamed over the old pages, which can be read until they are replaced.
+    # Processes still reading the old index tell the new pages from the old ones by their build id.
+    def __install_index(self, page_file_paths, block_table_file_path, source, fingerprint, num_lines,
+                        fingerprint_size=None, build_id=0):
+        manifest_file_path = self.__get_manifest_file_path()
+        if os.path.exists(manifest_file_path):
+            os.remove(manifest_file_path)
+        for i, page_file_path in enumerate(page_file_paths):
+            os.rename(page_file_path, self.__get_index_file_path(i))
+        # The pages of the old index past the last page of the new one
+        page_number = len(page_file_paths)
+        while os.path.exists(self.__get_index_file_path(page_number)):
+            os.remove(self.__get_index_file_path(page_number))
+            page_number += 1
+        if block_table_file_path:
+            os.rename(block_table_file_path, self.__get_block_table_file_path())
+        elif os.path.exists(self.__get_block_table_file_path()):
+            os.remove(self.__get_block_table_file_path())
+        manifest = IndexManifest.create(source, fingerprint, num_lines, self.num_of_lines_per_index_page,
+                                        self.index_checkpoint_interval, self.index_page_encoding,
+                                        self.index_page_compression, fingerprint_size, build_id)
+        IndexManifest.write(manifest_file_path, manifest)
+        self.__use_manifest(manifest)
+
+    # Installs the index copied from the primary server into folder, described by manifest, if it was built from the same
+    # text, with the same page size, checkpoint interval and page format, and its pages pass verify_index_pages.
+    # Returns False if there is no such index.
+    def __install_fetched_index(self, folder, manifest):
+        logger = logging.getLogger(__name__)
+        if manifest is None:
+            logger.warning("The primary server has no index of %s", self.file_path)
+            return False
+        source = IndexManifest.describe_source(self.file_path)
+        fingerprint_size = IndexManifest.fingerprint_size(manifest)
+        fingerprint = IndexPageFile.source_fingerprint(self.file_path, fingerprint_size)
+        if not IndexManifest.is_compatible(manifest, self.num_of_lines_per_index_page, self.index_checkpoint_interval,
+                                           self.index_page_encoding, self.index_page_compression) or \
+                not IndexManifest.has_same_text(manifest, source, fingerprint):
+            logger.warning("The index of the primary server does not fit %s", self.file_path)
+            return False
+        num_pages = self.__get_num_index_pages(manifest["num_lines"])
+        page_file_paths = [os.path.join(folder, "%d.idx" % i) for i in xrange(num_pages)]
+        block_table_file_path = os.path.join(folder, "blocks") if source["compression"] else None
+        build_id = IndexManifest.build_id(manifest)
+        try:
+            self.verify_index_pages(page_file_paths, block_table_file_path, source, fingerprint, build_id)
+        except (IndexPageError, IOError, ValueError), err:
+            logger.warning("The index of the primary server does not fit %s: %s", self.file_path, err)
+            return False
+
+        self.__install_index(page_file_paths, block_table_file_path, source, fingerprint, manifest["num_lines"],
+                             fingerprint_size, build_id)
+        logger.info("Fetched indexes of %s from the primary server, # of lines: %d", self.file_path, self.num_lines)
+        return True
+
+    # Checks index pages copied from another server against the text file, without scanning it: every page must pass
+    # its checksum, carry the fingerprint of the text file and the build id of the index, and start where the page before
+    # it ends, and its lines must end on a newline. The last page must end at the end of the text. The pages of
+    # a compressed file are checked against its block table, which must end at the end of the compressed file.
+    # Raises IndexPageError if they do not fit.
+    def verify_index_pages(self, page_file_paths, block_table_file_path, source, fingerprint, build_id=0):
+        if block_table_file_path:
+            block_table = BlockTable.load(block_table_file_path)
+            if block_table.compressed_starts[-1] != source["file_size"]:
+                raise IndexPageError("The block table does not end at the end of %s" % self.file_path)
+            text_buffer = None
+            end_of_text = block_table.starts[-1]
+        else:
+            text_buffer = self.__get_text_buffer(source["file_size"]) if source["file_size"] else ""
+            end_of_text = source["file_size"]
+        start = 0
+        for i, page_file_path in enumerate(page_file_paths):
+            index_page = IndexPageFile.load(page_file_path, i)
+            try:
+                if index_page.fingerprint != fingerprint:
+                    raise IndexPageError("The index page %d was not built from %s" % (i, self.file_path))
+                if index_page.build_id != build_id:
+                    raise IndexPageError("The index page %d belongs to another build of the index" % i)
+                if index_page.get_offset(0) != start:
+                    raise IndexPageError("The index page %d does not start where the page before ends" % i)
+                end = index_page.get_offset(index_page.num_lines)
+            finally:
+                index_page.close()
+            if end > end_of_text or (text_buffer and end < end_of_text and text_buffer[end - 1] != "\n"):
+                raise IndexPageError("The index page %d does not end on a line of %s" % (i, self.file_path))
+            start = end
+        if start != end_of_text:
+            raise IndexPageError("The index pages do not cover %s" % self.file_path)
+
+    # Adopts an index described by a manifest, which may have been written by another process
+    def __use_manifest(self, manifest):
+        if manifest["num_lines"] != self.num_lines or manifest["file_size"] != self.file_size or \
+                manifest.get("index_version", 0) != self.index_version:
+            self.__discard_index_pages()
+            self.text_buffer = None
+        self.compression = manifest.get("compression")
+        self.fingerprint = manifest["fingerprint"].decode("hex")
+        self.index_build = IndexManifest.build_id(manifest)
+        self.num_lines = manifest["num_lines"]
+        self.file_size = manifest["file_size"]
+        self.index_version = manifest.get("index_version", 0)
+        self.indexing_completed = True
+        self.progress.ready(self.num_lines, self.file_size, self.fingerprint)
+
+    # Indexes the bytes appended to the text file since the manifest was written.
+    # The last index page is rewritten with the lines added to it and new pages are written after it.
+    # The new lines become visible once all their pages are written.
+    def __extend_index(self, manifest):
+        logger = logging.getLogger(__name__)
+        source = IndexManifest.describe_source(self.file_path)
+        last_page_number = (manifest["num_lines"] - 1) / self.get_lines_per_index_page()
+        last_page = IndexPageFile.load(self.__get_index_file_path(last_page_number), last_page_number)
+        offsets = last_page.all_offsets()
+        last_page.close()
+        if self.index_checkpoint_interval > 1:
+            # The builder continues from the offsets of every line of the last page, which are found again in the text
+            start = offsets[0]
+            text_buffer = self.__get_text_buffer(manifest["file_size"])
+            offsets = [start] + ChunkedIndexBuilder.find_boundaries(text_buffer[start:manifest["file_size"]], start)
+            if offsets[-1] != manifest["file_size"]:
+                offsets.append(manifest["file_size"])
+
+        builder = ChunkedIndexBuilder(self.file_path, self.get_lines_per_index_page(), self.__write_to_index_page)
+        num_lines = builder.extend(last_page_number, offsets, manifest["file_size"], source["file_size"])
+        manifest = IndexManifest.create(source, self.fingerprint, num_lines, self.num_of_lines_per_index_page,
+                                        self.index_checkpoint_interval, self.index_page_encoding,
+                                        self.index_page_compression, IndexManifest.fingerprint_size(manifest),
+                                        self.index_build)
+        IndexManifest.write(self.__get_manifest_file_path(), manifest)
+        self.__use_manifest(manifest)
+        logger.info("Extending indexes is completed: %s, # of lines: %d" % (str(self.file_path), self.num_lines))
+
+    # Delete index files before building. The manifest goes first, so the index is never reused if building fails.
     def __delete_index_files(self):
         file_prefix = self.file_path_hash
-        FileUtil.delete_files(self.file_dir, "{0}_[0-9]+\.idx".format(file_prefix))
+        folder = os.path.join(self.file_dir, "index")
+        if os.path.exists(folder):
+            FileUtil.delete_files(folder, "^{0}\.manifest$".format(file_prefix))
+            FileUtil.delete_files(folder, "^{0}_[0-9]+\.idx$".format(file_prefix))
+            FileUtil.delete_files(folder, "^{0}\.blocks$".format(file_prefix))
 
     # All index files are stored in a sub-folder called index under where the text file is located to support multiple files at the same time
     # For example, automated unit tests could use multiple text files for testing and we don't want index file name collision.
@@ -74,44 +492,454 @@ class LineFile(object):
         index_file_path = os.path.join(folder, "{0}_{1}.idx".format(file_prefix, index_page_number))
         return index_file_path
 
-    def __write_to_index_page(self, index_page_number):
-        index_file_path = self.__get_index_file_path(index_page_number)
-        with open(index_file_path, "w") as index_file:
-            json.dump(self.index_page, index_file)
+    # The manifest describing the index pages of the text file is stored next to them
+    def __get_manifest_file_path(self):
+        folder = os.path.join(self.file_dir, "index")
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return os.path.join(folder, "{0}.manifest".format(self.file_path_hash))
+
+    # The block table of a compressed text file is stored next to its index pages
+    def __get_block_table_file_path(self):
+        return os.path.join(self.file_dir, "index", "{0}.blocks".format(self.file_path_hash))
+
+    # The lock file serializes index updates between processes
+    def __get_lock_file_path(self):
+        folder = os.path.join(self.file_dir, "index")
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return os.path.join(folder, "{0}.lock".format(self.file_path_hash))
 
-    # If an index page file is not in memory, load it
+    # The number of lines covered by an index page: the number of index entries per page times the checkpoint interval
+    def get_lines_per_index_page(self):
+        return self.num_of_lines_per_index_page * self.index_checkpoint_interval
+
+    def __get_num_index_pages(self, num_lines):
+        lines_per_index_page = self.get_lines_per_index_page()
+        return (num_lines + lines_per_index_page - 1) / lines_per_index_page
+
+    # The files of the index in use, as (name, path): the manifest, the index pages, named by their page number,
+    # and the block table of a compressed file. Returns None if the manifest describes another index.
+    # Used to send the index to a replica server, under the index lock.
+    def index_files(self):
+        manifest_file_path = self.__get_manifest_file_path()
+        manifest = IndexManifest.load(manifest_file_path)
+        if manifest is None or manifest.get("index_version", 0) != self.index_version:
+            return None
+        files = [("manifest", manifest_file_path)]
+        for i in xrange(self.__get_num_index_pages(manifest["num_lines"])):
+            files.append(("%d.idx" % i, self.__get_index_file_path(i)))
+        if manifest.get("compression"):
+            files.append(("blocks", self.__get_block_table_file_path()))
+        return files
+
+    # offsets are the start offsets of the lines in the page followed by the end offset of its last line.
+    def __write_to_index_page(self, index_page_number, offsets):
+        self.__write_index_page_file(self.__get_index_file_path(index_page_number), offsets, self.fingerprint,
+                                     self.index_build)
+        # The lines of a compressed file can not be read before its block table is written
+        if not self.compression:
+            self.progress.page_written(index_page_number, self.get_lines_per_index_page(), offsets)
+
+    # In the sparse index mode, only the offsets of the checkpoints and the end offset are written.
+    def __write_index_page_file(self, index_file_path, offsets, fingerprint, build_id):
+        checkpoint_interval = self.index_checkpoint_interval
+        entries = offsets
+        if checkpoint_interval > 1:
+            entries = offsets[::checkpoint_interval]
+            if (len(offsets) - 1) % checkpoint_interval:
+                entries.append(offsets[-1])
+        IndexPageFile.write(index_file_path, entries, fingerprint, self.index_page_encoding,
+                            self.index_page_compression, build_id)
+
+    # Returns an index page, from the cache if it is there
+    def get_index_page(self, index_page_number):
+        key = (self.file_path_hash, index_page_number)
+        index_page = self.index_cache.get(key)
+        if index_page is None:
+            started = time.time()
+            try:
+                index_page = self.__load_index_page(index_page_number)
+            except IndexPageError, err:
+                index_page = self.__wait_for_page_repair(index_page_number, err)
+            self.index_cache.put(key, index_page, index_page.size)
+            if self.metrics is not None:
+                self.metrics.index_page_loaded(time.time() - started)
+        elif self.metrics is not None:
+            self.metrics.count("index_page_hits")
+        return index_page
+
+    # If an index page file is not in memory, map it.
+    # A page of another build of the index, renamed over the page of the index in use by a reload, is not used.
     def __load_index_page(self, index_page_number):
         index_file_path = self.__get_index_file_path(index_page_number)
-        with open(index_file_path, "r") as index_file:
-            self.index_page = json.load(index_file)
-            self.current_index_page = index_page_number
+        index_page = IndexPageFile.load(index_file_path, index_page_number)
+        if index_page.fingerprint != self.fingerprint:
+            index_page.close()
+            raise IndexPageError("The index page %s was not built from %s" % (index_file_path, self.file_path))
+        if index_page.build_id != self.index_build:
+            index_page.close()
+            raise IndexPageError("The index page %s belongs to another build of the index" % index_file_path)
+        logger = logging.getLogger(__name__)
+        logger.info("Index page %d is loaded, # of lines: %d", index_page_number, self.num_lines)
+        return index_page
+
+    # Starts repairing a damaged index page in a thread, unless it is being repaired already,
+    # and waits up to index_wait_timeout seconds for the page. Raises IndexNotReadyError if it is not repaired by then.
+    def __wait_for_page_repair(self, index_page_number, error):
+        # The lines of a page are only known from a complete index
+        if not self.indexing_completed:
+            raise error
+        # The page may belong to an index another process has reloaded since this one read the manifest
+        if self.__is_index_replaced():
+            self.prepare_index(rebuild=False)
+            return self.__load_index_page(index_page_number)
+        logger = logging.getLogger(__name__)
+        logger.warning("%s, repairing it", error.msg)
+        with self.page_repairs_lock:
+            repair_thread = self.page_repairs.get(index_page_number)
+            if repair_thread is None or not repair_thread.is_alive():
+                repair_thread = threading.Thread(target=self.__repair_in_background, args=(index_page_number,))
+                repair_thread.daemon = True
+                self.page_repairs[index_page_number] = repair_thread
+                repair_thread.start()
+        repair_thread.join(self.index_wait_timeout)
+        if repair_thread.is_alive():
+            raise IndexNotReadyError("The index page %d of %s is being repaired" % (index_page_number, self.file_path))
+        return self.__load_index_page(index_page_number)
+
+    # Whether the manifest describes another index than the one in use. Read under the index lock, as the index pages
+    # of a reloaded index are renamed in place before its manifest is written
+    def __is_index_replaced(self):
+        with self.index_lock.hold():
+            manifest = IndexManifest.load(self.__get_manifest_file_path())
+        return manifest is not None and manifest.get("index_version", 0) != self.index_version
+
+    def __repair_in_background(self, index_page_number):
+        try:
+            self.repair_index_page(index_page_number)
+        except Exception:
             logger = logging.getLogger(__name__)
-            logger.info("The size of the index page {0}: {1}, # of lines: {2}".format(index_page_number, sys.getsizeof(self.index_page), self.num_lines))
+            logger.error("Repairing index page %d of %s failed", index_page_number, self.file_path, exc_info=True)
+        finally:
+            with self.page_repairs_lock:
+                self.page_repairs.pop(index_page_number, None)
+
+    # Rebuilds a missing or damaged index page of a complete index, from the lines it covers in the text file.
+    # The first line of a page starts where the last line of the page before it ends. If the page before is damaged
+    # too, it is repaired first, and so on, so only the bytes of the damaged pages are scanned.
+    # Returns False if the page did not need repairing, for example because another process repaired it first.
+    def repair_index_page(self, index_page_number):
+        logger = logging.getLogger(__name__)
+        with self.index_lock.hold():
+            if self.is_file_changed():
+                raise IndexPageError("%s has changed since it was indexed" % self.file_path)
+            manifest = IndexManifest.load(self.__get_manifest_file_path())
+            if manifest is not None and manifest.get("index_version", 0) != self.index_version:
+                raise IndexPageError("The index of %s has been reloaded" % self.file_path)
+            try:
+                self.__load_index_page(index_page_number).close()
+                return False
+            except IndexPageError:
+                pass
+            first_page_number = index_page_number
+            start = 0
+            while first_page_number > 0:
+                try:
+                    index_page = self.__load_index_page(first_page_number - 1)
+                except IndexPageError:
+                    first_page_number -= 1
+                    continue
+                start = index_page.all_offsets()[-1]
+                index_page.close()
+                break
+            lines_per_index_page = self.get_lines_per_index_page()
+            text_buffer = self.__get_text_buffer(self.file_size)
+            for page_number in xrange(first_page_number, index_page_number + 1):
+                num_lines = min(lines_per_index_page, self.num_lines - page_number * lines_per_index_page)
+                offsets = self.__scan_lines(text_buffer, start, num_lines)
+                self.__write_to_index_page(page_number, offsets)
+                start = offsets[-1]
+                if self.metrics is not None:
+                    self.metrics.count("index_page_repairs")
+        logger.info("Index pages %d to %d of %s are repaired", first_page_number, index_page_number, self.file_path)
+        return True
+
+    # The start offsets of num_lines lines of the text from start, followed by the end offset of the last one
+    def __scan_lines(self, text_buffer, start, num_lines):
+        offsets = [start]
+        pos = start
+        end_of_text = len(text_buffer)
+        while len(offsets) <= num_lines and pos < end_of_text:
+            chunk_end = min(pos + self.repair_chunk_size, end_of_text)
+            offsets.extend(ChunkedIndexBuilder.find_boundaries(text_buffer[pos:chunk_end], pos))
+            pos = chunk_end
+        del offsets[num_lines + 1:]
+        # The last line of the text may have no newline
+        if len(offsets) == num_lines and offsets[-1] < end_of_text:
+            offsets.append(end_of_text)
+        if len(offsets) != num_lines + 1:
+            raise IndexPageError("%s has fewer lines than its index" % self.file_path)
+        return offsets
+
+    # Drops the cached index pages of this file after the pages were rewritten
+    def __discard_index_pages(self):
+        file_path_hash = self.file_path_hash
+        self.index_cache.discard(lambda key: key[0] == file_path_hash)
+
+    # Counters of the caches in front of the index and the text file
+    def stats(self):
+        return {
+            "num_lines": self.num_lines,
+            "index_progress": self.progress.to_dict(),
+            "index_cache": self.index_cache.stats(),
+            "line_cache": self.line_cache.stats() if self.line_cache is not None else None,
+            "block_cache": self.block_cache.stats() if self.block_cache is not None else None
+        }
+
+    # Returns the mapping of the text file, mapping it again if it is shorter than end because the file has grown.
+    # The text of a compressed file is read through a CompressedTextBuffer instead.
+    # text_buffer holds the mapping together with the file it maps, which stays open to check its size.
+    # Raises TextFileChangedError if the file has become shorter than the mapping.
+    def __get_text_buffer(self, end):
+        text_buffer = self.text_buffer
+        if text_buffer is None or len(text_buffer[0]) < end:
+            if self.compression:
+                if self.block_cache is None:
+                    self.block_cache = LRUCache(self.default_block_cache_max_bytes)
+                block_table = BlockTable.load(self.__get_block_table_file_path())
+                text_buffer = (CompressedTextBuffer(self.file_path, self.compression, block_table, self.block_cache,
+                                                    (self.file_path_hash, self.index_version)), None)
+            else:
+                line_file = open(self.file_path, "rb")
+                try:
+                    text_buffer = (mmap.mmap(line_file.fileno(), 0, access=mmap.ACCESS_READ), line_file)
+                except:
+                    line_file.close()
+                    raise
+            self.text_buffer = text_buffer
+        mapping, line_file = text_buffer
+        if line_file is not None and os.fstat(line_file.fileno()).st_size < len(mapping):
+            raise TextFileChangedError("%s is shorter than when it was indexed" % self.file_path)
+        return mapping
+
+    # Brings the index up to date before reading lines up to line_no and returns the number of lines which can be read
+    def __prepare_lines(self, line_no):
+        if not self.indexing_completed:
+            return self.__wait_for_index(line_no)
+        # The text file may have grown since the index was built, or another process may have extended the index
+        if line_no > self.num_lines and self.is_file_changed():
+            self.prepare_index(rebuild=False)
+        return self.num_lines
+
+    # Waits until the index page of line_no is written, or the whole index is ready,
+    # for up to index_wait_timeout seconds. Raises IndexNotReadyError if it is not, at once if building the index failed,
+    # as it is only built again later (see CatalogIndexBuilder).
+    def __wait_for_index(self, line_no):
+        progress = self.progress
+        progress.requested.value = 1
+        if progress.state.value == IndexProgress.PENDING and self.build_index_on_request:
+            self.start_index_build()
+        deadline = time.time() + self.index_wait_timeout
+        while True:
+            state = progress.state.value
+            if state == IndexProgress.READY:
+                # The index was built by another process, or by another thread which has not finished yet
+                if not self.indexing_completed:
+                    self.prepare_index(rebuild=False)
+                if self.indexing_completed:
+                    return self.num_lines
+            elif state == IndexProgress.BUILDING:
+                lines_ready = progress.lines_ready.value
+                if lines_ready >= line_no:
+                    self.fingerprint = progress.fingerprint.raw
+                    self.index_build = progress.build_id.value
+                    return lines_ready
+            elif state == IndexProgress.FAILED:
+                raise IndexNotReadyError("Building the index of %s failed" % self.file_path)
+            if time.time() >= deadline:
+                raise IndexNotReadyError("The index of %s is not ready" % self.file_path)
+            time.sleep(self.index_wait_interval)
+
+    # The number of the index page holding the offsets of a line (0-based), or of the checkpoint before it
+    # in the sparse index mode
+    def __get_index_page_number(self, line_number0):
+        return line_number0 / self.index_checkpoint_interval / self.num_of_lines_per_index_page
+
+    # Returns the text buffer and the start and end offsets of an indexed line (0-based).
+    # index_page is the page of the line if it is already loaded.
+    def __get_line_range(self, line_number0, index_page=None):
+        if self.index_checkpoint_interval > 1:
+            return self.__find_line_range(line_number0, index_page)
+        if index_page is None:
+            index_page = self.get_index_page(self.__get_index_page_number(line_number0))
+        start, end = index_page.get_line_range(line_number0 % self.num_of_lines_per_index_page)
+        return self.__get_text_buffer(end), start, end
+
+    # In the sparse index mode, finds a line by skipping newlines from the checkpoint before it.
+    # The next checkpoint bounds the search.
+    def __find_line_range(self, line_number0, index_page=None):
+        checkpoint, skip = divmod(line_number0, self.index_checkpoint_interval)
+        if index_page is None:
+            index_page = self.get_index_page(self.__get_index_page_number(line_number0))
+        start, window_end = index_page.get_line_range(checkpoint % self.num_of_lines_per_index_page)
+        text_buffer = self.__get_text_buffer(window_end)
+        find = text_buffer.find
+        for i in xrange(skip):
+            start = find("\n", start, window_end) + 1
+        end = find("\n", start, window_end)
+        end = end + 1 if end != -1 else window_end
+        return text_buffer, start, end
 
     # GetLine is the method for retrieving a line. It first finds which index page file,
-    # then get the file offset of the line, and then open the text file, seek to that offset and read the entire line
+    # then get the start and end file offsets of the line, and then slice the line out of the mapped text file
     def get_line(self, line_no):
         try:
-            if not self.indexing_completed:
-                self.buildIndex()
             line_number0 = int(line_no) - 1
-            if line_number0 >=0 and line_number0 < self.num_lines:
-                index_page_number = line_number0 / self.num_of_lines_per_index_page
-                if index_page_number != self.current_index_page:
-                    self.__load_index_page(index_page_number)
-                line_address = self.index_page[line_number0 % self.num_of_lines_per_index_page]
-                with open(self.file_path, "r") as line_file:
-                    line_file.seek(line_address)
-                    line = line_file.readline()
-                    if line:
-                        line = line.strip()
+            num_lines = self.__prepare_lines(line_number0 + 1)
+            if line_number0 >=0 and line_number0 < num_lines:
+                # Lines are cached with the version of a complete index only
+                line_cache = self.line_cache if self.indexing_completed else None
+                if line_cache is not None:
+                    line = line_cache.get(self.file_key, line_number0 + 1, self.index_version)
+                    if line is not None:
                         return 200, line
+                text_buffer, start, end = self.__get_line_range(line_number0)
+                line = text_buffer[start:end].strip()
+                if line_cache is not None:
+                    line_cache.put(self.file_key, line_number0 + 1, self.index_version, line)
+                return 200, line
             return 404, None
-        except Exception, arg:
-            error = ErrorUtil.get_error(arg)
+        except IndexNotReadyError:
+            return 503, None
+        except TextFileChangedError, err:
+            self.__warn_text_file_changed(err)
+            return 404, None
+        except Exception:
             logger = logging.getLogger(__name__)
-            logger.error(json.dumps(error, indent=4, sort_keys=True))
+            logger.error("Error reading %s", self.file_path, exc_info=True)
             return 500, "Woops! Something went wrong. Please try again"
 
+    # Returns the number of lines and the start and end file offsets of the lines first to last (inclusive),
+    # cut at the last line of the file
+    def get_byte_range(self, first, last):
+        try:
+            last = min(last, self.__prepare_lines(last))
+            if first < 1 or first > last:
+                return 404, None
+            start = self.__get_line_range(first - 1)[1]
+            end = self.__get_line_range(last - 1)[2]
+            return 200, (last - first + 1, start, end)
+        except IndexNotReadyError:
+            return 503, None
+        except TextFileChangedError, err:
+            self.__warn_text_file_changed(err)
+            return 404, None
+        except Exception:
+            logger = logging.getLogger(__name__)
+            logger.error("Error reading %s", self.file_path, exc_info=True)
+            return 500, "Woops! Something went wrong. Please try again"
+
+    # Returns the lines first to last (inclusive), cut at the last line of the file.
+    # Lines of a range are contiguous in the text file, so they are read with one slice of the text buffer.
+    def get_lines(self, first, last):
+        status, byte_range = self.get_byte_range(first, last)
+        if status != 200:
+            return status, byte_range
+        num_lines, start, end = byte_range
+        try:
+            text = self.read_bytes(start, end)
+        except TextFileChangedError, err:
+            self.__warn_text_file_changed(err)
+            return 404, None
+        lines = text.split("\n", num_lines - 1)
+        return 200, [line.strip() for line in lines]
+
+    def __warn_text_file_changed(self, err):
+        logger = logging.getLogger(__name__)
+        logger.warning("%s, its lines are not served until it is indexed again", err.msg)
+
+    # Returns the bytes [start, end) of the text file
+    def read_bytes(self, start, end):
+        return self.__get_text_buffer(end)[start:end]
 
+    # Sends the bytes [start, end) of the text file to a blocking socket without copying them into Python strings:
+    # with os.sendfile where the os module has it, otherwise by sending a buffer over the mapped text file.
+    # The decompressed text of a compressed file is copied.
+    def send_bytes(self, sock, start, end):
+        if self.compression:
+            sock.sendall(self.read_bytes(start, end))
+        elif hasattr(os, "sendfile"):
+            with open(self.file_path, "rb") as line_file:
+                while start < end:
+                    sent = os.sendfile(sock.fileno(), line_file.fileno(), start, end - start)
+                    if sent == 0:
+                        raise IOError("The text file %s is shorter than the index" % self.file_path)
+                    start += sent
+        else:
+            sock.sendall(buffer(self.__get_text_buffer(end), start, end - start))
 
+    # Returns get_line of every line number, in order. The line numbers are sorted and grouped by index page, so
+    # every index page is looked up once, and lines next to each other in the text file are read with one slice.
+    def get_many(self, line_nos):
+        lines = {}
+        # The line numbers (0-based) to read, by index page number
+        pages = {}
+        line_cache = None
+        for line_no in sorted(set(line_nos)):
+            try:
+                line_number0 = int(line_no) - 1
+                num_lines = self.__prepare_lines(line_number0 + 1)
+                if line_number0 < 0 or line_number0 >= num_lines:
+                    lines[line_no] = 404, None
+                    continue
+                line_cache = self.line_cache if self.indexing_completed else None
+                line = line_cache.get(self.file_key, line_number0 + 1, self.index_version) if line_cache is not None else None
+                if line is not None:
+                    lines[line_no] = 200, line
+                else:
+                    pages.setdefault(self.__get_index_page_number(line_number0), []).append(line_number0)
+            except Exception, err:
+                lines[line_no] = self.__failed_read(err)
+        for index_page_number in sorted(pages):
+            line_numbers0 = pages[index_page_number]
+            try:
+                for line_number0, line in self.__read_page_lines(index_page_number, line_numbers0):
+                    lines[line_number0 + 1] = 200, line
+                    if line_cache is not None:
+                        line_cache.put(self.file_key, line_number0 + 1, self.index_version, line)
+            except Exception, err:
+                status = self.__failed_read(err)
+                for line_number0 in line_numbers0:
+                    lines[line_number0 + 1] = status
+        return [lines[line_no] for line_no in line_nos]
+
+    # Returns the line numbers (0-based, sorted) of one index page with their lines. Runs of lines next to each other
+    # in the text file are read with one slice of the text buffer, like get_lines.
+    def __read_page_lines(self, index_page_number, line_numbers0):
+        index_page = self.get_index_page(index_page_number)
+        # The text buffer, start and end offsets and line numbers of every run of lines
+        runs = []
+        for line_number0 in line_numbers0:
+            text_buffer, start, end = self.__get_line_range(line_number0, index_page)
+            if runs and runs[-1][2] == start:
+                runs[-1][0], runs[-1][2] = text_buffer, end
+                runs[-1][3].append(line_number0)
+            else:
+                runs.append([text_buffer, start, end, [line_number0]])
+        lines = []
+        for text_buffer, start, end, run in runs:
+            text = text_buffer[start:end].split("\n", len(run) - 1)
+            lines.extend(zip(run, [line.strip() for line in text]))
+        return lines
+
+    # The status and line get_line returns when reading a line failed with err
+    def __failed_read(self, err):
+        if isinstance(err, IndexNotReadyError):
+            return 503, None
+        if isinstance(err, TextFileChangedError):
+            self.__warn_text_file_changed(err)
+            return 404, None
+        logger = logging.getLogger(__name__)
+        logger.error("Error reading %s", self.file_path, exc_info=True)
+        return 500, "Woops! Something went wrong. Please try again"
@@ -0,0 +1,214 @@
+import os
+import signal
+import socket
+import errno
+import time
+import logging
+import json
+import threading
+from SocketServer import TCPServer, ThreadingMixIn
+from lifecycle import ConnectionDrainMixIn, Lifecycle
+from utils.tools import ErrorUtil, LoggingUtil
+
+
+# The pre-fork server mode is the "process + thread" model: the main process builds the index once, then forks
+# a fixed number of long-lived worker processes. Every worker inherits the mapped index and text file and runs its own
+# accept loop, handling each connection in a thread, so no process is created per connection.
+#
+# Workers either share the listening socket created by the main process, or, with prefork_reuse_port,
+# each bind their own socket with SO_REUSEPORT and let the kernel balance connections between them.
+#
+# The main process supervises the workers and forks a new one when a worker dies.
+#
+# To stop, the main process sends SIGTERM to the workers. A worker stops accepting connections, stops reading from its
+# connections and exits once they have answered the commands received, or at the drain deadline.
+# After reloading the indexes, the main process sends SIGHUP to the workers, which then switch to the new indexes.
+
+# SO_REUSEPORT is not exposed by the Python 2 socket module, this is its value on Linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+
+# The server running in each worker process
+class PreForkWorkerServer(ConnectionDrainMixIn, ThreadingMixIn, TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, catalog, settings, *args, **kwargs):
+        self.catalog = catalog
+        self.settings = settings
+        self.init_connections()
+        TCPServer.__init__(self, *args, **kwargs)
+
+
+# Ends a worker process when the main process is gone, so killed servers do not leave workers serving behind
+class ParentWatcher(threading.Thread):
+
+    interval = 1.0
+
+    def __init__(self, parent_pid):
+        super(ParentWatcher, self).__init__()
+        self.daemon = True
+        self.parent_pid = parent_pid
+
+    def run(self):
+        while os.getppid() == self.parent_pid:
+            time.sleep(self.interval)
+        os._exit(0)
+
+
+class PreForkServer(object):
+
+    # A worker dying sooner than this after being forked is restarted after a delay, to avoid a crash loop
+    min_worker_lifetime = 1.0
+
+    # Interval of the main thread of a worker checking whether a signal has asked it to stop or to refresh its indexes
+    signal_poll_interval = 0.5
+
+    def __init__(self, catalog, settings, server_address, RequestHandlerClass):
+        self.catalog = catalog
+        self.settings = settings
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.request_queue_size = settings["num_of_connections_max"]
+        self.num_workers = settings["num_of_worker_processes"]
+        self.reuse_port = settings["prefork_reuse_port"]
+        self.socket = None
+        self.workers = {}
+        self.stop_requested = False
+        self.stopped = threading.Event()
+
+    def server_bind(self):
+        if not self.reuse_port:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(self.server_address)
+            self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        if self.socket is not None:
+            self.socket.listen(self.request_queue_size)
+
+    # Forks the workers and restarts the ones that die until shutdown is called
+    def serve_forever(self):
+        logger = logging.getLogger(__name__)
+        self.stopped.clear()
+        try:
+            for i in range(self.num_workers):
+                self.__start_worker()
+            while self.workers:
+                try:
+                    pid, status = os.wait()
+                except OSError, err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    if err.errno == errno.ECHILD:
+                        break
+                    raise
+                started = self.workers.pop(pid, None)
+                if started is None or self.stop_requested:
+                    continue
+                logger.warning("Worker %d exited with status %d, starting a new worker" % (pid, status))
+                if time.time() - started < self.min_worker_lifetime:
+                    time.sleep(self.min_worker_lifetime)
+                if not self.stop_requested:
+                    self.__start_worker()
+        finally:
+            self.stopped.set()
+
+    # Stops the workers and waits until serve_forever has exited
+    def shutdown(self):
+        self.stop_requested = True
+        self.__signal_workers(signal.SIGTERM)
+        self.stopped.wait()
+
+    # Lets the workers drain their connections until deadline, then kills the ones still running
+    def drain(self, deadline):
+        self.stop_requested = True
+        self.__signal_workers(signal.SIGTERM)
+        if not self.stopped.wait(max(deadline - time.time(), 0)):
+            logger = logging.getLogger(__name__)
+            logger.warning("%d workers were still draining their connections when the server stopped",
+                           len(self.workers))
+            self.__signal_workers(signal.SIGKILL)
+            self.stopped.wait()
+        self.server_close()
+
+    # Has the workers switch to the indexes reloaded by the main process
+    def reload(self):
+        self.__signal_workers(signal.SIGHUP)
+
+    def __signal_workers(self, signum):
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    # Reported by the STATS command of the control port
+    def process_stats(self):
+        return {"server_mode": "prefork", "workers": len(self.workers)}
+
+    def server_close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+    def __start_worker(self):
+        parent_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            # The handlers inherited from the main process would stop the whole server from the worker,
+            # so they are replaced before anything else
+            self.__handle_worker_signals()
+            LoggingUtil.after_fork()
+            status = 0
+            try:
+                ParentWatcher(parent_pid).start()
+                self.__run_worker()
+            except Exception, arg:
+                error = ErrorUtil.get_error(arg)
+                logger = logging.getLogger(__name__)
+                logger.error(json.dumps(error, indent=4, sort_keys=True))
+                status = 1
+            finally:
+                os._exit(status)
+        self.workers[pid] = time.time()
+
+    # In a worker, stop_requested and refresh_requested are set by its signal handlers.
+    # The handlers only set flags, as a handler must not wait for a lock the interrupted code may hold
+    def __handle_worker_signals(self):
+        self.stop_requested = False
+        self.refresh_requested = False
+        Lifecycle.handle_signals(Lifecycle.STOP_SIGNALS, lambda signum, frame: setattr(self, "stop_requested", True))
+        Lifecycle.handle_signals([signal.SIGHUP], lambda signum, frame: setattr(self, "refresh_requested", True))
+
+    def __run_worker(self):
+        worker_server = PreForkWorkerServer(self.catalog, self.settings, self.server_address, self.RequestHandlerClass,
+                                            bind_and_activate=False)
+        worker_server.request_queue_size = self.request_queue_size
+        if self.reuse_port:
+            worker_server.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            worker_server.server_bind()
+            worker_server.server_activate()
+        else:
+            worker_server.socket.close()
+            worker_server.socket = self.socket
+        logger = logging.getLogger(__name__)
+        logger.info("Worker %d is accepting connections" % os.getpid())
+        # Connections are accepted by a thread, while the main thread, which runs the signal handlers, acts on the signals
+        accept_thread = threading.Thread(target=worker_server.serve_forever)
+        accept_thread.daemon = True
+        accept_thread.start()
+        while not self.stop_requested:
+            time.sleep(self.signal_poll_interval)
+            if self.refresh_requested:
+                self.refresh_requested = False
+                self.catalog.refresh()
+
+        deadline = time.time() + self.settings["shutdown_drain_timeout"]
+        worker_server.shutdown()
+        worker_server.drain_connections()
+        worker_server.wait_for_connections(deadline)
+        LoggingUtil.flush()
+        if self.catalog.access_log is not None:
+            self.catalog.access_log.flush()
@@ -0,0 +1,188 @@
+import socket
+
+
+# The line protocol spoken by every server mode.
+# A client sends one command per line:
+#   "GET n"           answered with "OK\n<line>\n", or "ERR\n" if there is no such line
+#   "GET a-b"         lines a to b, answered with "OK <count>\n" followed by count lines, or "ERR\n" if there is no line a.
+#                     The range is cut at the last line of the file, so count may be smaller than b - a + 1.
+#   "MGET n1 n2 ..."  answered with one GET reply per line number, in the order requested
+#   "STREAM a-b"      lines a to b as they are in the text file, answered with "OK <count> <size>\n" followed by
+#                     size bytes holding count lines with their line endings, or "ERR\n" if there is no line a.
+#                     The range is cut at the last line of the file like GET a-b.
+#   "USE name"        makes the text file named name the file read by the next commands, answered with "OK\n",
+#                     or "ERR\n" if the server has no such file
+#   "QUIT" or "SHUTDOWN"
+# GET, MGET and STREAM can also name the file to read before the line numbers, as in "GET name n".
+# Commands naming no file read the file chosen with USE, or the server's default file.
+# GET, MGET and STREAM are answered with "ERR NOT READY\n" instead of a line while the index of the line is being built.
+# An error of the server is answered with "Server error: <message>\n" instead of a reply, on one line: backslashes,
+# carriage returns and newlines in the message are escaped as \\, \r and \n.
+# A client may send several commands without waiting for the replies, they are answered in order.
+class LineProtocol(object):
+
+    # Commands longer than this are cut, as a client command is read with readline(MAX_COMMAND_LENGTH)
+    MAX_COMMAND_LENGTH = 1024
+
+    # The largest number of lines a GET range may ask for
+    MAX_RANGE_LINES = 100000
+
+    INVALID_COMMAND = 'INVALID COMMAND!\n'
+
+    # The reply when the index page of a line is not built yet
+    NOT_READY = 'ERR NOT READY\n'
+
+    SERVER_ERROR = 'Server error: '
+
+    # Commands answered from the text file, the other commands are answered by the connection handler
+    DATA_COMMANDS = ("GET", "MGET", "STREAM")
+
+    # This is a helper method to process user command input.
+    # The parameters of GET, MGET and STREAM start with the name of the file to read, None if the command names no file.
+    @classmethod
+    def validate_command(cls, cmd_string):
+        if not cmd_string:
+            return False, None, None
+        args = cmd_string.strip().split()
+        if not args:
+            return False, None, None
+        cmd = args[0].upper()
+        if cmd == "QUIT":
+            return True, "QUIT", []
+        if cmd == "SHUTDOWN":
+            return True, "SHUTDOWN", []
+        if cmd == "USE" and len(args) == 2:
+            return True, "USE", [args[1]]
+        if cmd in cls.DATA_COMMANDS and len(args) >= 2:
+            file_name = None
+            if len(args) >= 3 and not args[1].isdigit() and not cls.parse_range(args[1]):
+                file_name = args.pop(1)
+            if cmd == "GET":
+                line = args[1]
+                if line.isdigit():
+                    line_no = int(line)
+                    return True, "GET", [file_name, line_no]
+                line_range = cls.parse_range(line)
+                if line_range:
+                    return True, "GET", [file_name] + line_range
+            if cmd == "STREAM":
+                line_range = cls.parse_range(args[1])
+                if line_range:
+                    return True, "STREAM", [file_name] + line_range
+            if cmd == "MGET":
+                if all(line.isdigit() for line in args[1:]):
+                    return True, "MGET", [file_name] + [int(line) for line in args[1:]]
+        return False, None, None
+
+    # Returns [first, last] for a line range "first-last", or None if it is not a valid range
+    @classmethod
+    def parse_range(cls, line_range):
+        first, sep, last = line_range.partition("-")
+        if sep and first.isdigit() and last.isdigit():
+            first, last = int(first), int(last)
+            if first <= last and last - first < cls.MAX_RANGE_LINES:
+                return [first, last]
+        return None
+
+    # Splits the complete commands off the front of data received from a client.
+    # Returns the commands and the bytes left for the next read. Like readline(MAX_COMMAND_LENGTH),
+    # a command longer than MAX_COMMAND_LENGTH is cut and the rest of it is read as the next command.
+    @classmethod
+    def split_commands(cls, data):
+        commands = []
+        start = 0
+        while True:
+            pos = data.find("\n", start, start + cls.MAX_COMMAND_LENGTH)
+            if pos == -1:
+                if len(data) - start < cls.MAX_COMMAND_LENGTH:
+                    break
+                pos = start + cls.MAX_COMMAND_LENGTH - 1
+            commands.append(data[start:pos + 1])
+            start = pos + 1
+        return commands, data[start:]
+
+    # The reply to a GET
+    @classmethod
+    def get_response(cls, line_file, line_no):
+        status, line = line_file.get_line(line_no)
+        return cls.format_line(status, line)
+
+    # The reply for an error of the server
+    @classmethod
+    def format_error(cls, message):
+        return '%s%s\n' % (cls.SERVER_ERROR, message.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n'))
+
+    # The reply for a line returned by get_line. An empty line is answered like the empty lines of a range.
+    @classmethod
+    def format_line(cls, status, line):
+        if status == 500 and line:
+            return cls.format_error(line)
+        elif status == 200 and line is not None:
+            return 'OK\n%s\n' % line
+        elif status == 503:
+            return cls.NOT_READY
+        return 'ERR\n'
+
+    # The reply to a GET of the lines first to last
+    @classmethod
+    def get_range_response(cls, line_file, first, last):
+        status, lines = line_file.get_lines(first, last)
+        if status == 500 and lines:
+            return cls.format_error(lines)
+        elif status == 200:
+            return 'OK %d\n%s\n' % (len(lines), "\n".join(lines))
+        elif status == 503:
+            return cls.NOT_READY
+        return 'ERR\n'
+
+    # The first line of the reply to a STREAM, and the file offsets of the bytes following it (None for an error reply)
+    @classmethod
+    def get_stream_header(cls, line_file, first, last):
+        status, byte_range = line_file.get_byte_range(first, last)
+        if status == 500 and byte_range:
+            return cls.format_error(byte_range), None
+        elif status == 200:
+            num_lines, start, end = byte_range
+            return 'OK %d %d\n' % (num_lines, end - start), (start, end)
+        elif status == 503:
+            return cls.NOT_READY, None
+        return 'ERR\n', None
+
+    # Sends the reply to a STREAM to a blocking socket and returns its first line. The lines are sent straight
+    # from the text file.
+    @classmethod
+    def send_stream_response(cls, sock, line_file, first, last):
+        if line_file is None:
+            sock.sendall('ERR\n')
+            return 'ERR\n'
+        header, byte_range = cls.get_stream_header(line_file, first, last)
+        sock.sendall(header)
+        if byte_range:
+            line_file.send_bytes(sock, *byte_range)
+        return header
+
+    # The reply to a GET, MGET or STREAM command reading line_file, as a string
+    @classmethod
+    def get_data_response(cls, line_file, cmd, params):
+        if line_file is None:
+            return 'ERR\n'
+        if cmd == "STREAM":
+            header, byte_range = cls.get_stream_header(line_file, params[1], params[2])
+            return header + line_file.read_bytes(*byte_range) if byte_range else header
+        if cmd == "MGET":
+            return "".join(cls.format_line(status, line) for status, line in line_file.get_many(params[1:]))
+        if len(params) == 3:
+            return cls.get_range_response(line_file, params[1], params[2])
+        return cls.get_response(line_file, params[1])
+
+    # The reply to USE
+    @classmethod
+    def get_use_response(cls, catalog, file_name):
+        return 'OK\n' if catalog.get(file_name) is not None else 'ERR\n'
+
+    # if a user enters SHUTDOWN, the server notifies the main process by the server control port
+    @classmethod
+    def notify_main_server_shutdown(cls, settings):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((settings["host"], settings["control_port"]))
+        s.sendall(b'shutdown\n')
@@ -0,0 +1,164 @@
+__author__ = 'white'
+import os
+import re
+import errno
+import json
+import shutil
+import socket
+import tempfile
+import time
+import logging
+
+
+# Index shipping lets replica servers copy the index of a text file from a primary server instead of scanning
+# their own copy of the file. The primary sends its index on the control port for the command "INDEX name":
+#   "OK <count>\n"            followed by count files, each as "<file name> <size>\n" and size bytes,
+#                             the manifest first, then the index pages "<page number>.idx" and, for a compressed text
+#                             file, its block table "blocks"
+#   "ERR NOT READY\n"         while the index is being built
+#   "ERR\n"                   if the server has no such file
+# A snapshot of the files is taken under the index lock and sent after the lock is released, so a slow replica
+# never holds up the index updates of the primary. Index files are only ever replaced by renaming a new file over them,
+# so the snapshot is a folder of hard links to the files, which keep their content when the index is updated.
+#
+# A replica (replica_of set to the control port of the primary) fetches the index when it has no index of its own
+# for a file, and checks it against its local copy of the text file before using it (see LineFile).
+# If the primary can not send an index which fits, the replica builds the index itself.
+
+class IndexShipping(object):
+
+    NOT_READY = "ERR NOT READY\n"
+
+    copy_size = 1024 * 1024
+
+    # Sends the index of a LineFile to a replica
+    @classmethod
+    def send(cls, wfile, line_file):
+        if line_file is None:
+            wfile.write("ERR\n")
+            return
+        if not line_file.indexing_completed:
+            wfile.write(cls.NOT_READY)
+            return
+        with line_file.index_lock.hold():
+            files = line_file.index_files()
+            if files is None:
+                wfile.write(cls.NOT_READY)
+                return
+            folder = tempfile.mkdtemp(prefix="%s.send." % line_file.file_path_hash, dir=os.path.dirname(files[0][1]))
+            try:
+                snapshot = [(name, cls.__snapshot(file_path, os.path.join(folder, name))) for name, file_path in files]
+            except:
+                shutil.rmtree(folder, ignore_errors=True)
+                raise
+        try:
+            wfile.write("OK %d\n" % len(snapshot))
+            for name, file_path in snapshot:
+                with open(file_path, "rb") as index_file:
+                    wfile.write("%s %d\n" % (name, os.fstat(index_file.fileno()).st_size))
+                    data = index_file.read(cls.copy_size)
+                    while data:
+                        wfile.write(data)
+                        data = index_file.read(cls.copy_size)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    # Links snapshot_path to the file at file_path, or copies the file where hard links are not supported
+    @classmethod
+    def __snapshot(cls, file_path, snapshot_path):
+        try:
+            os.link(file_path, snapshot_path)
+        except OSError, err:
+            if err.errno not in (errno.EPERM, errno.EXDEV, errno.EMLINK, errno.ENOTSUP):
+                raise
+            shutil.copyfile(file_path, snapshot_path)
+        return snapshot_path
+
+
+class IndexReplicaError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        super(IndexReplicaError, self).__init__(msg)
+
+
+# Fetches the index of the text file named name from the primary server at primary_address, the (host, control port)
+# of its control port
+class IndexReplica(object):
+
+    # The names of the files a primary may send
+    file_name_pattern = re.compile(r"^(manifest|blocks|[0-9]+\.idx)$")
+
+    copy_size = 1024 * 1024
+
+    def __init__(self, primary_address, name, wait_timeout=600, timeout=30.0, retry_interval=1.0):
+        self.primary_address = primary_address
+        self.name = name
+        self.wait_timeout = wait_timeout
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+
+    # Parses the replica_of setting, "host:port"
+    @classmethod
+    def parse_address(cls, address):
+        host, sep, port = address.rpartition(":")
+        if not sep or not port.isdigit():
+            raise IndexReplicaError("Invalid primary server address %s, please enter host:port" % address)
+        return host or "localhost", int(port)
+
+    # Copies the index files of the primary into folder. Returns the manifest of the index, or None if the primary has
+    # no such file, or has not sent its index within wait_timeout seconds because it is not ready, not reachable
+    # or sent a damaged manifest.
+    def fetch(self, folder):
+        logger = logging.getLogger(__name__)
+        deadline = time.time() + self.wait_timeout
+        while True:
+            try:
+                reply = self.__fetch(folder)
+                if reply != IndexShipping.NOT_READY:
+                    return reply
+            except (socket.error, IOError, ValueError, IndexReplicaError), err:
+                logger.warning("Fetching the index of %s from %s:%d failed: %s", self.name, self.primary_address[0],
+                               self.primary_address[1], err)
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.retry_interval)
+
+    def __fetch(self, folder):
+        s = socket.create_connection(self.primary_address, self.timeout)
+        try:
+            s.sendall("INDEX %s\n" % self.name)
+            rfile = s.makefile("rb")
+            reply = rfile.readline()
+            if reply == IndexShipping.NOT_READY:
+                return reply
+            if reply == "ERR\n":
+                return None
+            if not reply.startswith("OK "):
+                raise IndexReplicaError("Unexpected reply %r" % reply[:100])
+            manifest = None
+            for i in xrange(int(reply.split()[1])):
+                name, size = self.__read_file(rfile, folder)
+                if name == "manifest":
+                    with open(os.path.join(folder, name), "rb") as manifest_file:
+                        manifest = json.load(manifest_file)
+            if not isinstance(manifest, dict):
+                raise IndexReplicaError("The primary sent no manifest")
+            return manifest
+        finally:
+            s.close()
+
+    # Copies one file of the reply to folder, returns its name and size
+    def __read_file(self, rfile, folder):
+        fields = rfile.readline().split()
+        if len(fields) != 2 or not self.file_name_pattern.match(fields[0]) or not fields[1].isdigit():
+            raise IndexReplicaError("Unexpected file header %r" % " ".join(fields)[:100])
+        name, size = fields[0], int(fields[1])
+        left = size
+        with open(os.path.join(folder, name), "wb") as index_file:
+            while left > 0:
+                data = rfile.read(min(left, self.copy_size))
+                if not data:
+                    raise IndexReplicaError("The primary closed the connection while sending %s" % name)
+                index_file.write(data)
+                left -= len(data)
+        return name, size
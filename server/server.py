@@ -1,88 +1,199 @@
 
+import os
 import socket
+import errno
+import signal
 import logging
 import json
+import threading
+import time
 from SocketServer import ForkingTCPServer, StreamRequestHandler
 from server_control import ServerController
-from models import LineFile
-from utils.tools import ErrorUtil
+from catalog import LineFileCatalog
+from protocol import LineProtocol
+from event_server import EventLoopServer
+from prefork import PreForkServer
+from cache import LRUCache, SharedLineCache
+from metrics import ServerMetrics
+from access_log import AccessLog
+from lifecycle import ConnectionDrainMixIn, Lifecycle, SignalRequests
+from utils.tools import ErrorUtil, LoggingUtil
 
 
-# This is main user request handler. It receives data from client connection and then process commands (GET, QUIT and SHUTDOWN).
-# this handler always runs in a forked child process, because Python uses PIL lock and It doesn't provide real threading concurrency.
+# This is main user request handler. It receives data from client connection and then process commands (GET, MGET, STREAM, USE, QUIT and SHUTDOWN).
+# this handler runs in a forked child process, because Python uses PIL lock and It doesn't provide real threading concurrency.
+# In the pre-fork mode it runs in a thread of a long-lived worker process.
 
 # If user enters shutdown command, it sends the shutdown command to the server control port so that the main process can terminate the entire program
+# When the server stops, it stops reading from the connection (see lifecycle.py): the handler answers the commands
+# received before and ends.
 class UserRequestHandler(StreamRequestHandler):
 
+    # Size of the blocks read from the client connection
+    recv_size = 65536
+
+    def setup(self):
+        StreamRequestHandler.setup(self)
+        self.server.add_connection(self.request)
+
+    def finish(self):
+        try:
+            StreamRequestHandler.finish(self)
+        finally:
+            self.server.remove_connection(self.request)
+
+    # Reads the next block of commands. A signal stopping the server interrupts a blocking recv in a forked child
+    def receive(self):
+        while True:
+            try:
+                return self.request.recv(self.recv_size)
+            except socket.error, err:
+                if err.errno != errno.EINTR:
+                    raise
+
     # This is a helper method to process user command input
     def validate_command(self, cmd_string):
-        if not cmd_string:
-            return False, None, None
-        cmd_string = cmd_string.strip().upper()
-        args = cmd_string.split()
-        if args[0] == "QUIT":
-            return True, "QUIT", []
-        if args[0] == "SHUTDOWN":
-            return True, "SHUTDOWN", []
-        if args[0] == "GET" and len(args) >= 2:
-            line = args[1]
-            if line.isdigit():
-                line_no = int(line)
-                return True, "GET", [line_no]
-        return False, None, None
-
-    # The actual method for responding user commands
+        return LineProtocol.validate_command(cmd_string)
+
+    # The actual method for responding user commands.
+    # Commands are read in blocks: every command already received is answered and the replies are sent together,
+    # so a client pipelining many commands does not pay a round trip for each.
     def handle(self):
+        metrics = self.server.catalog.metrics
+        metrics.count("connections_opened")
+        logger = logging.getLogger(__name__)
         try:
-            logger = logging.getLogger(__name__)
-            logger.info("User connection from: %s" % str(self.client_address))
-            request_msg = self.rfile.readline(1024)
-            while request_msg:
-                logger.info("Message from user: %s" % request_msg)
-                is_validate, cmd, params = self.validate_command(request_msg)
-                if is_validate:
-                    if cmd == "SHUTDOWN":
-                        self.notify_main_server_shutdown()
-                        break
-                    if cmd == "QUIT":
-                        break
-                    if cmd == "GET":
-                        line_no = params[0]
-                        status, line = self.server.line_file.get_line(line_no)
-                        if status == 500 and line:
-                            self.wfile.write('Server error: %s' % line)
-                        elif status == 200 and line:
-                            self.wfile.write('OK\n%s\n' % line)
-                        else:
-                            self.wfile.write('ERR\n')
-                        self.wfile.flush()
-                        request_msg = self.rfile.readline(1024)
-                        continue
-
-                self.wfile.write('INVALID COMMAND!\n')
-                self.wfile.flush()
-                request_msg = self.rfile.readline(1024)
+            logger.info("User connection from: %s", self.client_address)
+            # Every message is only logged at the DEBUG level, the access log records the answered commands
+            log_messages = logger.isEnabledFor(logging.DEBUG)
+            pending = ""
+            file_name = None
+            data = self.receive()
+            while data:
+                request_msgs, pending = LineProtocol.split_commands(pending + data)
+                replies = []
+                for request_msg in request_msgs:
+                    if log_messages:
+                        logger.debug("Message from user: %s", request_msg)
+                    is_validate, cmd, params = self.validate_command(request_msg)
+                    if is_validate:
+                        if cmd == "SHUTDOWN":
+                            self.wfile.write("".join(replies))
+                            self.notify_main_server_shutdown()
+                            return
+                        if cmd == "QUIT":
+                            self.wfile.write("".join(replies))
+                            return
+                        if cmd == "USE":
+                            replies.append(LineProtocol.get_use_response(self.server.catalog, params[0]))
+                            if replies[-1].startswith("OK"):
+                                file_name = params[0]
+                            continue
+                        line_file = self.server.catalog.get(params[0] or file_name)
+                        started = time.time()
+                        if cmd == "STREAM":
+                            self.wfile.write("".join(replies))
+                            replies = []
+                            header = LineProtocol.send_stream_response(self.request, line_file, params[1], params[2])
+                            self.record_request(cmd, params, started, header)
+                            continue
+                        if cmd in LineProtocol.DATA_COMMANDS:
+                            replies.append(LineProtocol.get_data_response(line_file, cmd, params))
+                            self.record_request(cmd, params, started, replies[-1])
+                            continue
 
-        except Exception, arg:
-            error = ErrorUtil.get_error(arg)
-            logger = logging.getLogger(__name__)
-            logger.error(json.dumps(error, indent=4, sort_keys=True))
+                    metrics.count("invalid_commands")
+                    replies.append(LineProtocol.INVALID_COMMAND)
+                if replies:
+                    self.wfile.write("".join(replies))
+                data = self.receive()
+
+        except Exception:
+            logger.error("Error serving %s", self.client_address, exc_info=True)
+        finally:
+            metrics.count("connections_closed")
+
+    # Counts a data command answered with reply in the metrics and writes it to the access log
+    def record_request(self, cmd, params, started, reply):
+        seconds = time.time() - started
+        catalog = self.server.catalog
+        catalog.metrics.request(cmd, seconds, reply)
+        if catalog.access_log is not None:
+            catalog.access_log.log(self.client_address, cmd, params, seconds, reply)
 
     # if a user enters SHUTDOWN, it will call this method to notify the main process by a TCP port
     def notify_main_server_shutdown(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.server.settings["host"], self.server.settings["control_port"]))
-        s.sendall(b'shutdown\n')
+        LineProtocol.notify_main_server_shutdown(self.server.settings)
 
 
 # This code uses Python SocketServer module - ForkingTCPServer for forking new processes for new connections.
-class CustomForkTCPServer(ForkingTCPServer):
+class CustomForkTCPServer(ConnectionDrainMixIn, ForkingTCPServer):
 
-    def __init__(self, line_file, settings, *args, **kwargs):
-        self.line_file = line_file
+    def __init__(self, catalog, settings, *args, **kwargs):
+        self.catalog = catalog
         self.settings = settings
+        self.init_connections()
         ForkingTCPServer.__init__(self, *args, **kwargs)
 
+    # Stops accepting connections and asks the children to end their connections once the commands they have received
+    # are answered. Children still running at deadline are killed.
+    def drain(self, deadline):
+        self.shutdown()
+        self.server_close()
+        killed = Lifecycle.stop_child_processes(self.active_children or set(), deadline)
+        if killed:
+            logger = logging.getLogger(__name__)
+            logger.warning("%d connections were still open when the server stopped", killed)
+
+    # Children keep the index they were forked with, new children get the reloaded one
+    def reload(self):
+        pass
+
+    # Reported by the STATS command of the control port
+    def process_stats(self):
+        return {"server_mode": "fork", "children": len(self.active_children or ())}
+
+    # Runs in the child process forked for a connection, which exits right after it,
+    # so the logs of the connection are written first.
+    # The child stops reading from its connection when it gets SIGTERM or SIGINT, and leaves reloading to the parent.
+    def finish_request(self, request, client_address):
+        Lifecycle.handle_signals(Lifecycle.STOP_SIGNALS, lambda signum, frame: self.drain_connections())
+        Lifecycle.handle_signals([signal.SIGHUP], signal.SIG_IGN)
+        LoggingUtil.after_fork()
+        try:
+            ForkingTCPServer.finish_request(self, request, client_address)
+        finally:
+            LoggingUtil.flush()
+            if self.catalog.access_log is not None:
+                self.catalog.access_log.flush()
+
+
+# A thread in the main process which polls the text files and brings their indexes up to date when a file has grown
+# or was replaced (see LineFile.reload_index), so child processes forked afterwards start with the new lines.
+# Children also catch up by themselves when they get a GET past the last indexed line.
+class IndexRefresher(threading.Thread):
+
+    def __init__(self, catalog, interval):
+        self.catalog = catalog
+        self.interval = interval
+        self.stopped = threading.Event()
+        super(IndexRefresher, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for line_file in self.catalog.line_files.values():
+                try:
+                    if line_file.indexing_completed and line_file.is_file_changed():
+                        line_file.reload_index()
+                except Exception, arg:
+                    error = ErrorUtil.get_error(arg)
+                    logger = logging.getLogger(__name__)
+                    logger.error(json.dumps(error, indent=4, sort_keys=True))
+
+    def stop(self):
+        self.stopped.set()
+
 
 # This is the server class responsible for listening and fork a child process to handle user requests for each TCP connection.
 # It uses Python SocketServer package
@@ -92,39 +203,106 @@ class Server(object):
         "host": "localhost",
         "port": 10497,
         "num_of_child_process_max": 40,
-        "num_of_connections_max": socket.SOMAXCONN
+        "num_of_connections_max": socket.SOMAXCONN,
+        "num_of_index_workers": 1,
+        "index_refresh_interval": 0,
+        "index_cache_max_bytes": 64 * 1024 * 1024,
+        "line_cache_max_bytes": 0,
+        "line_cache_max_line_length": 256,
+        "server_mode": "fork",
+        "num_of_io_threads": 4,
+        "num_of_worker_processes": 4,
+        "output_buffer_max_bytes": 1024 * 1024,
+        "prefork_reuse_port": False,
+        "index_build_mode": "background",
+        "index_wait_timeout": 2.0,
+        "index_checkpoint_interval": 1,
+        "index_page_encoding": "fixed",
+        "index_page_compression": None,
+        "block_cache_max_bytes": 16 * 1024 * 1024,
+        "access_log_path": None,
+        "access_log_sample_rate": 1.0,
+        "access_log_max_per_second": 0,
+        "replica_of": None,
+        "replica_wait_timeout": 600,
+        "shutdown_drain_timeout": 10.0
     }
 
-    def __init__(self, settings, text_file_path):
+    # text_file_paths is the path of the text file to serve, or a list of paths when serving several files
+    def __init__(self, settings, text_file_paths):
+        self.settings = dict(Server.settings)
         self.settings.update(settings)
-        self.line_file = LineFile(text_file_path, self.settings["num_of_lines_per_index_page"])
+        self.index_cache = LRUCache(self.settings["index_cache_max_bytes"])
+        self.line_cache = None
+        if self.settings["line_cache_max_bytes"] > 0:
+            self.line_cache = SharedLineCache(self.settings["line_cache_max_bytes"], self.settings["line_cache_max_line_length"])
+        self.block_cache = LRUCache(self.settings["block_cache_max_bytes"])
+        self.metrics = ServerMetrics()
+        self.access_log = None
+        if self.settings["access_log_path"]:
+            self.access_log = AccessLog(self.settings["access_log_path"], self.settings["access_log_sample_rate"],
+                                        self.settings["access_log_max_per_second"])
+        if isinstance(text_file_paths, basestring):
+            text_file_paths = [text_file_paths]
+        self.catalog = LineFileCatalog(self.settings, self.index_cache, self.line_cache, self.block_cache, self.metrics,
+                                       self.access_log)
+        for text_file_path in text_file_paths:
+            self.catalog.add(text_file_path)
         self.server_controller = None
         self.tcp_server = None
+        self.index_refresher = None
+        self.stopper = None
+        self.reloader = None
+        self.stop_signalled = False
+        self.signal_requests = None
 
     def start(self):
         try:
-            # First, build indexes for line file
-            self.line_file.buildIndex()
+            # First, start building indexes for the line files, or reuse them if the files have not changed since they were built.
+            # Unless index_build_mode is "start", indexes are built by a background thread while the server is listening
+            self.catalog.prepare_indexes()
+            if self.settings["index_refresh_interval"] > 0:
+                self.index_refresher = IndexRefresher(self.catalog, self.settings["index_refresh_interval"])
+                self.index_refresher.start()
 
-            # Prepare and start TCP socket server, which fork a new process when a user connects to the server
-            tcp_server = CustomForkTCPServer(self.line_file, self.settings,
-                (self.settings["host"], self.settings["port"]),
-                RequestHandlerClass=UserRequestHandler,
-                bind_and_activate=False)
+            # Prepare and start TCP socket server. By default it forks a new process when a user connects to the server,
+            # in the event loop mode one process serves every connection,
+            # and in the pre-fork mode a fixed number of worker processes serve connections in threads
+            if self.settings["server_mode"] == "event":
+                tcp_server = EventLoopServer(self.catalog, self.settings, (self.settings["host"], self.settings["port"]))
+            elif self.settings["server_mode"] == "prefork":
+                tcp_server = PreForkServer(self.catalog, self.settings, (self.settings["host"], self.settings["port"]),
+                                           UserRequestHandler)
+            else:
+                tcp_server = CustomForkTCPServer(self.catalog, self.settings,
+                    (self.settings["host"], self.settings["port"]),
+                    RequestHandlerClass=UserRequestHandler,
+                    bind_and_activate=False)
 
-            tcp_server.request_queue_size = self.settings["num_of_connections_max"]
-            tcp_server.max_children = self.settings["num_of_child_process_max"]
+                tcp_server.request_queue_size = self.settings["num_of_connections_max"]
+                tcp_server.max_children = self.settings["num_of_child_process_max"]
 
-            tcp_server.allow_reuse_address = True
+                tcp_server.allow_reuse_address = True
             tcp_server.server_bind()
             tcp_server.server_activate()
 
             self.tcp_server = tcp_server
-            self.server_controller = ServerController(self.tcp_server, self.settings)
+            self.server_controller = ServerController(self.tcp_server, self.settings, self.request_stop)
             self.server_controller.start()
 
+            # SIGTERM and SIGINT stop the server gracefully, SIGHUP reloads the indexes of changed text files
+            self.signal_requests = SignalRequests({"s": self.request_stop, "r": self.request_reload})
+            self.signal_requests.start()
+            Lifecycle.handle_signals(Lifecycle.STOP_SIGNALS, self.__handle_stop_signal)
+            Lifecycle.handle_signals([signal.SIGHUP], lambda signum, frame: self.signal_requests.request("r"))
+
             self.tcp_server.serve_forever()
 
+            # The server is being stopped, wait until the connections are drained and the logs are written.
+            # join with a timeout, so a second signal is still handled
+            while self.stopper is not None and self.stopper.is_alive():
+                self.stopper.join(0.5)
+
             logger = logging.getLogger(__name__)
             logger.info("The server is stopped!")
 
@@ -134,7 +312,74 @@ class Server(object):
             logger.error(json.dumps(error, indent=4, sort_keys=True))
             logging.error("Server starting failed!")
 
+    # Starts stopping the server gracefully in a thread (see stop), unless it is being stopped already.
+    # Called for a stop signal (see SignalRequests) or by the SHUTDOWN command
+    def request_stop(self):
+        if self.stopper is None:
+            self.stopper = threading.Thread(target=self.stop)
+            self.stopper.daemon = True
+            self.stopper.start()
+
+    # Signal handlers run in the main thread between two statements, so the stop is started by SignalRequests
+    def __handle_stop_signal(self, signum, frame):
+        if self.stop_signalled or self.stopper is not None:
+            # Asked again while draining, for example by a second Ctrl-C
+            os._exit(1)
+        self.stop_signalled = True
+        self.signal_requests.request("s")
+
+    # Stops accepting connections, lets the open connections finish the commands already received for up to
+    # shutdown_drain_timeout seconds, and then stops the control port. The index being built or reloaded has until
+    # the same deadline to be written with its manifest. Last the logs are flushed.
+    def stop(self):
+        logger = logging.getLogger(__name__)
+        logger.info("Stopping the server, draining connections for up to %s seconds",
+                    self.settings["shutdown_drain_timeout"])
+        deadline = time.time() + self.settings["shutdown_drain_timeout"]
+        try:
+            self.catalog.stop()
+            if self.index_refresher:
+                self.index_refresher.stop()
+            if self.tcp_server:
+                self.tcp_server.drain(deadline)
+            if self.server_controller and self.server_controller.tcp_server:
+                self.server_controller.tcp_server.shutdown()
+                self.server_controller.tcp_server.server_close()
+            for thread in (self.catalog.index_builder, self.index_refresher, self.reloader):
+                if thread is not None and thread.is_alive():
+                    thread.join(max(deadline - time.time(), 0))
+                    if thread.is_alive():
+                        logger.warning("The index was still being built when the server stopped")
+        except Exception:
+            logger.error("Stopping the server failed", exc_info=True)
+        finally:
+            LoggingUtil.flush()
+            if self.access_log is not None:
+                self.access_log.flush()
+
+    # Starts reloading the indexes in a thread (see reload), unless they are being reloaded already
+    def request_reload(self):
+        if self.stopper is None and (self.reloader is None or not self.reloader.is_alive()):
+            self.reloader = threading.Thread(target=self.reload)
+            self.reloader.daemon = True
+            self.reloader.start()
+
+    # Rebuilds the indexes of the text files which have changed while the old indexes keep serving,
+    # then has the server processes switch to the new indexes
+    def reload(self):
+        logger = logging.getLogger(__name__)
+        logger.info("Reloading the indexes of changed text files")
+        try:
+            self.catalog.reload()
+            if self.tcp_server:
+                self.tcp_server.reload()
+        except Exception:
+            logger.error("Reloading the indexes failed", exc_info=True)
+
     def cleanup(self):
+        self.catalog.stop()
+        if self.index_refresher:
+            self.index_refresher.stop()
         if self.tcp_server:
             self.tcp_server.shutdown()
         if self.server_controller and self.server_controller.tcp_server:
@@ -3,17 +3,23 @@ import threading
 import json
 import logging
 from SocketServer import ThreadingTCPServer, StreamRequestHandler
+from metrics import PrometheusFormat
+from replica import IndexShipping
 from utils.tools import ErrorUtil
 
 
 # When the LineServer starts, it will start ServerControlThread as a thread to listen any control command on a TCP port (server control port)
-# such as "shutdown" command from any user.
+# such as "shutdown" command from any user, reports statistics of the line files, their caches and the server metrics
+# for the "stats" command (in the Prometheus text format for the "metrics" command)
+# and the progress of building their indexes for the "progress" command.
+# The "index <name>" command sends the index of a file to a replica server (see replica.py).
 # This thread runs inside the same process as the main thread.
 
 # When Line Server receives a user connection, it forks a new process to handle that user request (GET, QUIT, SHUTDOWN commands) so not to block other users from connecting.
 # If a user enters "shutdown" command, the forked process will send "shutdown" command to the server control port,
 # so that the main process can start to shutdown and terminate the Line Server.
 # Basically it uses a TCP port for child processes to communicate back to the main process.
+# The server is then stopped gracefully like on SIGTERM (see Server.stop), when the controller has a stop function.
 
 # This code uses Python SocketServer module - ThreadingTCPServer
 
@@ -26,20 +32,39 @@ class ServerControlCommandHandler(StreamRequestHandler):
             logger.info("control port connection from: %s" % str(self.client_address))
             request_msg = self.rfile.readline(1024)
             if request_msg and request_msg.upper().startswith("SHUTDOWN"):
-                self.server.server_be_controlled.shutdown()
-                self.server.shutdown()
+                if self.server.stop is not None:
+                    self.server.stop()
+                else:
+                    self.server.server_be_controlled.shutdown()
+                    self.server.shutdown()
+            elif request_msg and request_msg.upper().startswith("STATS"):
+                self.wfile.write("%s\n" % json.dumps(self.get_stats(), sort_keys=True))
+            elif request_msg and request_msg.upper().startswith("METRICS"):
+                self.wfile.write(PrometheusFormat.format(self.get_stats()))
+            elif request_msg and request_msg.upper().startswith("PROGRESS"):
+                progress = self.server.server_be_controlled.catalog.progress()
+                self.wfile.write("%s\n" % json.dumps(progress, sort_keys=True))
+            elif request_msg and request_msg.upper().startswith("INDEX") and len(request_msg.split()) == 2:
+                catalog = self.server.server_be_controlled.catalog
+                IndexShipping.send(self.wfile, catalog.get(request_msg.split()[1]))
         except Exception, arg:
             error = ErrorUtil.get_error(arg)
             logger = logging.getLogger(__name__)
             logger.error(json.dumps(error, indent=4, sort_keys=True))
             logging.error("An error occurred when processing request at control port!")
 
+    def get_stats(self):
+        stats = self.server.server_be_controlled.catalog.stats()
+        stats["server"] = self.server.server_be_controlled.process_stats()
+        return stats
+
 
 class CustomThreadingTCPServer(ThreadingTCPServer):
 
-    def __init__(self, server_be_controlled, settings, *args, **kwargs):
+    def __init__(self, server_be_controlled, settings, stop, *args, **kwargs):
         self.server_be_controlled = server_be_controlled
         self.settings = settings
+        self.stop = stop
         ThreadingTCPServer.__init__(self, *args, **kwargs)
 
 
@@ -51,23 +76,26 @@ class ServerController(threading.Thread):
         "control_port": 8080
     }
 
-    def __init__(self, server, settings):
+    # stop is called for the SHUTDOWN command, without it the controlled server and the control port are shut down
+    def __init__(self, server, settings, stop=None):
         self.server_be_controlled = server
+        self.stop = stop
         self.tcp_server = None
+        self.settings = dict(ServerController.settings)
         self.settings.update(settings)
         super(ServerController, self).__init__()
 
     def run(self):
         try:
-            tcp_server = CustomThreadingTCPServer(self.server_be_controlled, self.settings,
+            tcp_server = CustomThreadingTCPServer(self.server_be_controlled, self.settings, self.stop,
                 (self.settings["host"], self.settings["control_port"]),
                 RequestHandlerClass=ServerControlCommandHandler,
                 bind_and_activate=False)
             tcp_server.allow_reuse_address = True
             tcp_server.server_bind()
             tcp_server.server_activate()
-            tcp_server.serve_forever()
             self.tcp_server = tcp_server
+            tcp_server.serve_forever()
             logger = logging.getLogger(__name__)
             logger.info("control port is stopped!")
         except Exception, arg:
@@ -4,7 +4,16 @@ import datetime
 import multiprocessing
 import json
 import os
+import shutil
+import socket
+import tempfile
+import time
+import pytest
 from server.models import LineFile
+from server.indexer import ChunkedIndexBuilder
+from server.index import IndexPageFile, IndexPageError, DeltaIndexPage, BinaryIndexPage
+from server.cache import SharedLineCache
+from utils.tools import FileLock
 
 
 # One of tests is to find the performance of getting a line when multiple clients are requesting at the same time.as
@@ -51,7 +60,8 @@ class TestLineFile():
 
     def test_indexes_small_file(self):
         self.test_data_small.get_line(1)
-        assert self.test_data_small.index_page == [0, 2, 4, 6, 8]
+        assert self.test_data_small.get_index_page(0).line_offsets() == [0, 2, 4, 6, 8]
+        assert self.test_data_small.get_index_page(0).get_line_range(4) == (8, 10)
 
     def test_get_line_from_small_file(self):
         assert self.test_data_small.get_line(5) == (200, "e")
@@ -60,6 +70,58 @@ class TestLineFile():
         assert self.test_data_small.get_line(1) == (200, "a")
         assert self.test_data_small.get_line("abc") == (500, "Woops! Something went wrong. Please try again")
 
+    def test_get_lines_from_small_file(self):
+        assert self.test_data_small.get_lines(2, 4) == (200, ["b", "c", "d"])
+        assert self.test_data_small.get_lines(5, 5) == (200, ["e"])
+        assert self.test_data_small.get_lines(4, 10) == (200, ["d", "e"])
+        assert self.test_data_small.get_lines(6, 7) == (404, None)
+        assert self.test_data_small.get_lines(0, 2) == (404, None)
+
+    def test_get_lines_across_index_pages(self):
+        status, lines = self.test_data_big.get_lines(995, 2010)
+        assert status == 200
+        assert lines == [self.test_data_big.get_line(line_no)[1] for line_no in range(995, 2011)]
+
+    def test_send_byte_range(self):
+        status, (num_lines, start, end) = self.test_data_big.get_byte_range(999, 3001)
+        assert status == 200 and num_lines == 2003
+        client, server = socket.socketpair()
+
+        def send():
+            self.test_data_big.send_bytes(server, start, end)
+            server.close()
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        try:
+            received = []
+            chunk = client.recv(65536)
+            while chunk:
+                received.append(chunk)
+                chunk = client.recv(65536)
+        finally:
+            sender.join()
+            client.close()
+        assert "".join(received) == self.test_data_big.read_bytes(start, end)
+        assert "".join(received).split("\n")[:-1] == self.test_data_big.get_lines(999, 3001)[1]
+
+    def test_get_many_keeps_request_order(self):
+        assert self.test_data_small.get_many([5, 1, 6, 5]) == [(200, "e"), (200, "a"), (404, None), (200, "e")]
+
+    def test_get_many_looks_up_every_index_page_once(self):
+        line_nos = [5003, 4001, 5002, 4001, 5999, 4500, 5001, 1000001]
+        lookups = self.test_data_big.index_cache.hits + self.test_data_big.index_cache.misses
+        lines = self.test_data_big.get_many(line_nos)
+        assert self.test_data_big.index_cache.hits + self.test_data_big.index_cache.misses == lookups + 2
+        assert lines == [self.test_data_big.get_line(line_no) for line_no in line_nos]
+
+    def test_index_pages_are_cached(self):
+        self.test_data_big.get_line(1)
+        hits = self.test_data_big.index_cache.hits
+        self.test_data_big.get_line(1000000)
+        self.test_data_big.get_line(2)
+        assert self.test_data_big.index_cache.hits == hits + 1
+
     def test_indexes_big_file(self):
         assert self.test_data_big.indexing_completed == True
 
@@ -90,4 +152,495 @@ class TestLineFile():
         for t in threads:
             t.join()
         t2 = datetime.datetime.now()
-        return num_of_concurrent_get_line, (t2-t1).microseconds/1000/num_of_concurrent_get_line
+        return num_of_concurrent_get_line, (t2-t1).total_seconds()*1000/num_of_concurrent_get_line
+
+
+# Tests for reusing the index pages built by a previous run
+class TestLineFileIndexReuse():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        with open(self.file_path, "w") as f:
+            f.write("a\nb\nc\n")
+        LineFile(self.file_path, 2).buildIndex()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def index_file_mtimes(self):
+        folder = os.path.join(self.folder, "index")
+        return dict((name, os.stat(os.path.join(folder, name)).st_mtime) for name in os.listdir(folder)
+                    if name.endswith(".idx") or name.endswith(".manifest"))
+
+    def test_unchanged_file_reuses_index(self):
+        mtimes = self.index_file_mtimes()
+        line_file = LineFile(self.file_path, 2)
+        line_file.prepare_index()
+        assert self.index_file_mtimes() == mtimes
+        assert line_file.num_lines == 3
+        assert line_file.get_line(3) == (200, "c")
+
+    def test_changed_file_rebuilds_index(self):
+        with open(self.file_path, "w") as f:
+            f.write("x\ny\nz\nw\n")
+        line_file = LineFile(self.file_path, 2)
+        line_file.prepare_index()
+        assert line_file.num_lines == 4
+        assert line_file.get_line(4) == (200, "w")
+
+    def test_line_cache_is_invalidated_by_new_index(self):
+        line_file = LineFile(self.file_path, 2, line_cache=SharedLineCache(64 * 1024, 16))
+        line_file.prepare_index()
+        assert line_file.get_line(2) == (200, "b")
+        assert line_file.get_line(2) == (200, "b")
+        assert line_file.line_cache.stats()["hits"] == 1
+        with open(self.file_path, "w") as f:
+            f.write("x\ny\n")
+        line_file.prepare_index()
+        assert line_file.get_line(2) == (200, "y")
+
+    def test_index_of_older_versions_is_rebuilt(self):
+        # An index folder of older versions holds JSON pages and no manifest
+        shutil.rmtree(os.path.join(self.folder, "index"))
+        os.makedirs(os.path.join(self.folder, "index"))
+        line_file = LineFile(self.file_path, 2)
+        index_file_path = os.path.join(self.folder, "index", "%s_0.idx" % line_file.file_path_hash)
+        with open(index_file_path, "w") as index_file:
+            json.dump([2, 0], index_file)
+        line_file.prepare_index()
+        assert line_file.get_line(1) == (200, "a")
+        assert line_file.get_line(2) == (200, "b")
+        assert IndexPageFile.load(index_file_path, 0).line_offsets() == [0, 2]
+
+    def test_changed_page_size_rebuilds_index(self):
+        line_file = LineFile(self.file_path, 1)
+        line_file.prepare_index()
+        assert line_file.get_line(2) == (200, "b")
+        assert len(self.index_file_mtimes()) == 4
+
+    def test_no_lock_file_is_left(self):
+        LineFile(self.file_path, 2).prepare_index()
+        assert not [name for name in os.listdir(os.path.join(self.folder, "index")) if name.endswith(".lock")]
+
+    def test_lock_of_removed_lock_file_is_still_exclusive(self):
+        lock_file_path = os.path.join(self.folder, "index", "test.lock")
+        entered_file_path = os.path.join(self.folder, "entered")
+        with FileLock(lock_file_path).hold():
+            pid = os.fork()
+            if pid == 0:
+                with FileLock(lock_file_path).hold():
+                    open(entered_file_path, "w").close()
+                os._exit(0)
+            time.sleep(0.2)
+            assert not os.path.exists(entered_file_path)
+        # The lock file is removed, and the waiting process locks the file it creates again
+        os.waitpid(pid, 0)
+        assert os.path.exists(entered_file_path)
+        assert not os.path.exists(lock_file_path)
+
+
+# Tests for indexing lines appended to the text file
+class TestLineFileAppend():
+
+    first_line = "a"
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        self.write(self.first_line + "\nb\nc\n")
+        self.line_file = LineFile(self.file_path, 2)
+        self.line_file.buildIndex()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def write(self, content, mode="w"):
+        with open(self.file_path, mode) as f:
+            f.write(content)
+
+    def test_get_past_end_indexes_appended_lines(self):
+        first_page = os.path.join(self.folder, "index", "%s_0.idx" % self.line_file.file_path_hash)
+        mtime = os.stat(first_page).st_mtime
+        assert self.line_file.get_line(3) == (200, "c")
+        self.write("d\ne\nf\n", "a")
+        assert self.line_file.get_line(6) == (200, "f")
+        assert self.line_file.get_line(3) == (200, "c")
+        assert self.line_file.get_line(4) == (200, "d")
+        assert self.line_file.num_lines == 6
+        assert os.stat(first_page).st_mtime == mtime
+
+    # The fingerprint of a file smaller than FINGERPRINT_SIZE covers the whole file, and still matches when it grows
+    def test_lines_appended_to_small_file_are_indexed(self):
+        self.write("a\nb\n")
+        self.line_file.buildIndex()
+        self.write("c\n", "a")
+        assert self.line_file.get_line(3) == (200, "c")
+        assert self.line_file.num_lines == 3
+        self.write("".join("line %d\n" % i for i in range(4, 1001)), "a")
+        assert self.line_file.get_line(1000) == (200, "line 1000")
+        self.write("d\n", "a")
+        assert self.line_file.get_line(1001) == (200, "d")
+        assert self.line_file.get_line(1) == (200, "a")
+
+    def test_unterminated_last_line_is_scanned_again(self):
+        self.write(self.first_line + "\nb")
+        self.line_file.buildIndex()
+        assert self.line_file.get_line(2) == (200, "b")
+        self.write("c\nd", "a")
+        assert self.line_file.get_line(3) == (200, "d")
+        assert self.line_file.get_line(2) == (200, "bc")
+        assert self.line_file.num_lines == 3
+
+    def test_other_line_file_uses_extended_index(self):
+        other_line_file = LineFile(self.file_path, 2)
+        other_line_file.prepare_index()
+        self.write("d\n", "a")
+        assert self.line_file.get_line(4) == (200, "d")
+        assert other_line_file.get_line(4) == (200, "d")
+        assert other_line_file.num_lines == 4
+
+    # A GET never rebuilds an index, the rewritten file is indexed again by prepare_index
+    def test_rewritten_file_is_indexed_again(self):
+        self.write("x\ny\nz\nw\n")
+        assert self.line_file.get_line(4) == (404, None)
+        self.line_file.prepare_index()
+        assert self.line_file.get_line(4) == (200, "w")
+        assert self.line_file.get_line(1) == (200, "x")
+
+    # Reading the mapping past the end of a truncated file would kill the process with SIGBUS
+    def test_truncated_file_is_not_read(self):
+        self.write("".join("%05d%s\n" % (i, "x" * 994) for i in range(1, 21)))
+        self.line_file.prepare_index()
+        assert self.line_file.get_line(20)[1].startswith("00020")
+        self.write("0")
+        assert self.line_file.get_line(20) == (404, None)
+        assert self.line_file.get_lines(1, 20) == (404, None)
+        self.line_file.prepare_index()
+        assert self.line_file.get_line(1) == (200, "0")
+
+
+class TestLineFileSparseIndex():
+
+    lines = ["first line"] + ["line %d" % i * (i % 5) for i in range(1, 50)]
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        with open(self.file_path, "w") as f:
+            f.write("\n".join(self.lines))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def test_lines_are_found_from_checkpoints(self):
+        for checkpoint_interval in (2, 3, 7, 64):
+            line_file = LineFile(self.file_path, 2, index_checkpoint_interval=checkpoint_interval)
+            line_file.prepare_index()
+            assert line_file.num_lines == 50
+            for line_no, line in enumerate(self.lines, 1):
+                assert line_file.get_line(line_no) == (200, line)
+            assert line_file.get_line(51) == (404, None)
+            assert line_file.get_lines(5, 60) == (200, self.lines[4:])
+            line_nos = [50, 3, 1, 2, 51, 17, 18, 20, 49, 3]
+            assert line_file.get_many(line_nos) == [line_file.get_line(line_no) for line_no in line_nos]
+
+    def test_index_is_smaller(self):
+        def index_size(line_file):
+            line_file.prepare_index()
+            folder = os.path.join(self.folder, "index")
+            return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+                       if name.startswith(line_file.file_path_hash) and name.endswith(".idx"))
+
+        dense_size = index_size(LineFile(self.file_path, 10))
+        assert index_size(LineFile(self.file_path, 10, index_checkpoint_interval=5)) < dense_size / 2
+
+    def test_appended_lines_are_indexed(self):
+        line_file = LineFile(self.file_path, 2, index_checkpoint_interval=3)
+        line_file.prepare_index()
+        with open(self.file_path, "a") as f:
+            f.write("x\ny\n")
+        assert line_file.get_line(51) == (200, "y")
+        assert line_file.get_line(50) == (200, self.lines[-1] + "x")
+        assert line_file.get_line(49) == (200, self.lines[-2])
+
+    def test_changed_checkpoint_interval_rebuilds_index(self):
+        LineFile(self.file_path, 2, index_checkpoint_interval=3).prepare_index()
+        line_file = LineFile(self.file_path, 2, index_checkpoint_interval=4)
+        line_file.prepare_index()
+        assert line_file.get_line(10) == (200, self.lines[9])
+
+
+class TestIndexPageEncoding():
+
+    # Offsets with deltas of one to nine varint bytes, and a group boundary every 16 offsets
+    offsets = [0, 1, 2, 130, 20000, 3000000, 2 ** 33, 2 ** 62] + [2 ** 62 + i * 7 for i in range(1, 40)]
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        self.lines = ["first line"] + ["line %d" % i * (i % 7) for i in range(1, 200)]
+        with open(self.file_path, "w") as f:
+            f.write("\n".join(self.lines))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def test_pages_are_read_back(self):
+        index_file_path = os.path.join(self.folder, "page_0.idx")
+        for encoding, page_class in (("fixed", BinaryIndexPage), ("delta", DeltaIndexPage)):
+            for compression in (None, "zlib"):
+                IndexPageFile.write(index_file_path, self.offsets, "f" * 16, encoding, compression)
+                index_page = IndexPageFile.load(index_file_path, 0)
+                assert isinstance(index_page, page_class)
+                assert index_page.num_lines == len(self.offsets) - 1
+                assert index_page.all_offsets() == self.offsets
+                assert index_page.line_offsets() == self.offsets[:-1]
+                for i in range(len(self.offsets) - 1):
+                    assert index_page.get_offset(i) == self.offsets[i]
+                    assert index_page.get_line_range(i) == (self.offsets[i], self.offsets[i + 1])
+                index_page.close()
+
+    def test_lines_are_read_with_every_page_format(self):
+        for checkpoint_interval in (1, 3):
+            for compression in (None, "zlib"):
+                line_file = LineFile(self.file_path, 20, index_checkpoint_interval=checkpoint_interval,
+                                     index_page_encoding="delta", index_page_compression=compression)
+                line_file.prepare_index()
+                for line_no, line in enumerate(self.lines, 1):
+                    assert line_file.get_line(line_no) == (200, line)
+                assert line_file.get_line(201) == (404, None)
+
+    def test_delta_pages_are_smaller(self):
+        def index_size(line_file):
+            line_file.prepare_index()
+            folder = os.path.join(self.folder, "index")
+            return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+                       if name.startswith(line_file.file_path_hash) and name.endswith(".idx"))
+
+        fixed_size = index_size(LineFile(self.file_path, 100))
+        delta_size = index_size(LineFile(self.file_path, 100, index_page_encoding="delta"))
+        assert delta_size < fixed_size / 3
+        assert index_size(LineFile(self.file_path, 100, index_page_encoding="delta", index_page_compression="zlib")) < \
+            delta_size
+
+    def test_appended_lines_are_indexed(self):
+        line_file = LineFile(self.file_path, 20, index_page_encoding="delta", index_page_compression="zlib")
+        line_file.prepare_index()
+        with open(self.file_path, "a") as f:
+            f.write("x\ny\n")
+        assert line_file.get_line(201) == (200, "y")
+        assert line_file.get_line(200) == (200, self.lines[-1] + "x")
+
+    def test_changed_page_encoding_rebuilds_index(self):
+        LineFile(self.file_path, 20).prepare_index()
+        line_file = LineFile(self.file_path, 20, index_page_encoding="delta")
+        line_file.prepare_index()
+        assert isinstance(line_file.get_index_page(0), DeltaIndexPage)
+        assert line_file.get_line(30) == (200, self.lines[29])
+
+
+# An index builder which stops after writing the first index page until it is released
+class PausingIndexBuilder(ChunkedIndexBuilder):
+
+    released = threading.Event()
+
+    def __init__(self, file_path, num_of_lines_per_index_page, write_page):
+        def write_paused_page(page_number, offsets):
+            if page_number > 0:
+                self.released.wait()
+            write_page(page_number, offsets)
+        super(PausingIndexBuilder, self).__init__(file_path, num_of_lines_per_index_page, write_paused_page)
+
+
+class TestLineFileBackgroundBuild():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        with open(self.file_path, "w") as f:
+            f.write("a\nb\nc\nd\ne\n")
+        PausingIndexBuilder.released.clear()
+        self.line_file = LineFile(self.file_path, 2)
+        self.line_file.index_builder = PausingIndexBuilder
+        self.line_file.index_wait_timeout = 0.1
+
+    def teardown_method(self, method):
+        PausingIndexBuilder.released.set()
+        shutil.rmtree(self.folder)
+
+    def test_lines_are_served_while_indexing(self):
+        assert self.line_file.get_line(2) == (200, "b")
+        assert self.line_file.progress.to_dict()["state"] == "building"
+        assert self.line_file.get_lines(1, 2) == (200, ["a", "b"])
+        assert self.line_file.get_line(3) == (503, None)
+        PausingIndexBuilder.released.set()
+        self.line_file.index_wait_timeout = 5.0
+        assert self.line_file.get_line(5) == (200, "e")
+        assert self.line_file.get_line(6) == (404, None)
+        assert self.line_file.progress.to_dict()["lines_ready"] == 5
+
+    def test_forked_process_follows_progress(self):
+        assert self.line_file.get_line(1) == (200, "a")
+        self.line_file.build_index_on_request = False
+        result = multiprocessing.Queue()
+
+        def get_lines():
+            result.put(self.line_file.get_line(2))
+            self.line_file.index_wait_timeout = 5.0
+            result.put(self.line_file.get_line(4))
+
+        process = multiprocessing.Process(target=get_lines)
+        process.start()
+        assert result.get(timeout=5) == (200, "b")
+        PausingIndexBuilder.released.set()
+        assert result.get(timeout=5) == (200, "d")
+        process.join()
+
+
+# Tests for the checksums of index pages and the repair of damaged pages
+class TestIndexPageRepair():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        self.lines = ["line %d:" % i + "x" * (i % 11) for i in range(1, 51)]
+        with open(self.file_path, "w") as f:
+            f.write("\n".join(self.lines))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def index_file_path(self, line_file, index_page_number):
+        return os.path.join(self.folder, "index", "%s_%d.idx" % (line_file.file_path_hash, index_page_number))
+
+    def damage_page(self, line_file, index_page_number):
+        with open(self.index_file_path(line_file, index_page_number), "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last_byte = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(chr(ord(last_byte) ^ 1))
+
+    def read_all_lines(self, line_file):
+        line_file.index_cache.discard(lambda key: True)
+        for line_no, line in enumerate(self.lines, 1):
+            assert line_file.get_line(line_no) == (200, line)
+
+    def test_damaged_page_is_detected(self):
+        index_file_path = os.path.join(self.folder, "page_0.idx")
+        for compression in (None, "zlib"):
+            IndexPageFile.write(index_file_path, range(0, 1000, 10), "f" * 16, "delta", compression)
+            with open(index_file_path, "r+b") as f:
+                f.seek(50)
+                f.write("\xff")
+            with pytest.raises(IndexPageError):
+                IndexPageFile.load(index_file_path, 0)
+        with open(index_file_path, "w") as f:
+            f.write("[0, 10")
+        with pytest.raises(IndexPageError):
+            IndexPageFile.load(index_file_path, 0)
+
+    def test_damaged_pages_are_repaired(self):
+        for checkpoint_interval, encoding in ((1, "fixed"), (1, "delta"), (3, "delta")):
+            line_file = LineFile(self.file_path, 4, index_checkpoint_interval=checkpoint_interval,
+                                 index_page_encoding=encoding)
+            line_file.prepare_index()
+            num_pages = (len(self.lines) - 1) / line_file.get_lines_per_index_page() + 1
+            index_files = [open(self.index_file_path(line_file, i), "rb").read() for i in range(num_pages)]
+            self.damage_page(line_file, 1)
+            os.remove(self.index_file_path(line_file, 2))
+            with open(self.index_file_path(line_file, num_pages - 1), "r+b") as f:
+                f.truncate(40)
+            self.read_all_lines(line_file)
+            assert [open(self.index_file_path(line_file, i), "rb").read() for i in range(num_pages)] == index_files
+
+    def test_repair_rescans_only_damaged_pages(self):
+        line_file = LineFile(self.file_path, 4)
+        line_file.prepare_index()
+        os.remove(self.index_file_path(line_file, 5))
+        os.remove(self.index_file_path(line_file, 6))
+        mtimes = dict((name, os.path.getmtime(os.path.join(self.folder, "index", name)))
+                      for name in os.listdir(os.path.join(self.folder, "index")) if name.endswith(".idx"))
+        assert line_file.repair_index_page(6)
+        assert not line_file.repair_index_page(6)
+        for name, mtime in mtimes.items():
+            assert os.path.getmtime(os.path.join(self.folder, "index", name)) == mtime
+        self.read_all_lines(line_file)
+
+
+# An index builder reading a line of the old index of line_file before it scans the text file
+class ServingIndexBuilder(ChunkedIndexBuilder):
+
+    line_file = None
+    lines_read = []
+
+    def build(self):
+        self.lines_read.append(self.line_file.get_line(2))
+        return super(ServingIndexBuilder, self).build()
+
+
+# Tests for reloading the index of a text file replaced while it is served
+class TestLineFileReload():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        self.write_lines(["line %d" % i for i in range(1, 21)])
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    # Replaces the text file by a new file, like a deployment would
+    def write_lines(self, lines):
+        tmp_file_path = self.file_path + ".tmp"
+        with open(tmp_file_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmp_file_path, self.file_path)
+
+    def test_old_index_serves_while_rebuilding(self):
+        line_file = LineFile(self.file_path, 3)
+        line_file.prepare_index()
+        assert line_file.get_line(20) == (200, "line 20")
+        self.write_lines(["new %d" % i for i in range(1, 11)])
+        ServingIndexBuilder.line_file = line_file
+        ServingIndexBuilder.lines_read = []
+        line_file.index_builder = ServingIndexBuilder
+        assert line_file.reload_index()
+        assert ServingIndexBuilder.lines_read == [(200, "line 2")]
+        assert line_file.get_line(10) == (200, "new 10")
+        assert line_file.get_line(11) == (404, None)
+        assert sorted(name for name in os.listdir(os.path.join(self.folder, "index")) if name.endswith(".idx")) == \
+            ["%s_%d.idx" % (line_file.file_path_hash, i) for i in range(4)]
+        assert not line_file.reload_index()
+
+    def test_appended_file_is_extended(self):
+        line_file = LineFile(self.file_path, 3)
+        line_file.prepare_index()
+        with open(self.file_path, "a") as f:
+            f.write("line 21\n")
+        assert not line_file.reload_index()
+        assert line_file.get_line(21) == (200, "line 21")
+
+    def test_other_process_switches_to_the_reloaded_index(self):
+        line_file = LineFile(self.file_path, 3)
+        line_file.prepare_index()
+        other_line_file = LineFile(self.file_path, 3)
+        other_line_file.prepare_index()
+        assert other_line_file.get_line(2) == (200, "line 2")
+        self.write_lines(["new %d" % i for i in range(1, 21)])
+        assert line_file.reload_index()
+        assert other_line_file.get_line(20) == (200, "new 20")
+        assert other_line_file.get_line(1) == (200, "new 1")
+
+    def test_other_process_does_not_read_pages_of_the_reloaded_index(self):
+        lines = ["line %04d" % i for i in range(1, 601)]
+        self.write_lines(lines)
+        line_file = LineFile(self.file_path, 100)
+        line_file.prepare_index()
+        other_line_file = LineFile(self.file_path, 100)
+        other_line_file.prepare_index()
+        assert other_line_file.get_line(1) == (200, "line 0001")
+        # The first 4 KB of the text are the same, so the pages of both indexes have the same fingerprint
+        self.write_lines(lines[:500] + ["new %d" % i for i in range(501, 601)])
+        assert line_file.reload_index()
+        assert other_line_file.get_line(600) == (200, "new 600")
@@ -0,0 +1,102 @@
+__author__ = 'white'
+import collections
+import os
+import random
+import shutil
+import tempfile
+from benchmarks.generate_text_file import TextFileGenerator
+from benchmarks.load_generator import LoadGenerator, ZipfPattern, SequentialPattern, percentile
+from tests.test_server import ServerProcess
+
+
+class TestTextFileGenerator():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def read_lines(self):
+        with open(self.file_path) as f:
+            return f.read().split("\n")[:-1]
+
+    def test_number_of_lines(self):
+        assert TextFileGenerator(5, 20, seed=1).write(self.file_path, num_of_lines=1000)[0] == 1000
+        lines = self.read_lines()
+        assert len(lines) == 1000
+        assert all(5 <= len(line) <= 20 and line.isalpha() for line in lines)
+
+    def test_size_in_bytes(self):
+        num_lines, num_bytes = TextFileGenerator(1, 50, distribution="exponential", mean_line_length=8).\
+            write(self.file_path, size=3 * 1024 * 1024 + 7)
+        assert num_bytes == os.path.getsize(self.file_path) == 3 * 1024 * 1024 + 7
+        assert num_lines == len(self.read_lines())
+        assert sum(len(line) for line in self.read_lines()) / float(num_lines) < 12
+
+    def test_fixed_line_length(self):
+        TextFileGenerator(max_line_length=7, distribution="fixed").write(self.file_path, num_of_lines=50)
+        assert set(len(line) for line in self.read_lines()) == set([7])
+
+
+class TestAccessPatterns():
+
+    def test_zipf_ranks(self):
+        pattern = ZipfPattern(1000, random.Random(1), 1.0)
+        counts = collections.Counter(pattern.rank() for i in range(100000))
+        assert min(counts) >= 1 and max(counts) <= 1000
+        # the probability of rank r is proportional to 1 / r
+        assert 1.8 < float(counts[1]) / counts[2] < 2.2
+        assert 0.12 < counts[1] / 100000.0 < 0.15
+
+    def test_zipf_lines_cover_the_file(self):
+        pattern = ZipfPattern(10, random.Random(1), 0.5)
+        assert sorted(set(pattern.next() for i in range(10000))) == range(1, 11)
+
+    def test_sequential_lines_wrap_around(self):
+        pattern = SequentialPattern(3, random.Random(1))
+        line_nos = [pattern.next() for i in range(6)]
+        assert sorted(line_nos) == [1, 1, 2, 2, 3, 3]
+        assert line_nos[3:] == line_nos[:3]
+
+    def test_percentile(self):
+        latencies = range(1, 1001)
+        assert percentile(latencies, 0.5) == 500
+        assert percentile(latencies, 0.999) == 999
+        assert percentile([], 0.5) is None
+
+
+class TestLoadGenerator():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        with open(self.file_path, "w") as f:
+            f.write("".join("line %d\n" % i for i in range(1, 101)))
+        self.server = ServerProcess(self.file_path, server_mode="event", num_of_lines_per_index_page=10)
+
+    def teardown_method(self, method):
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def run(self, **settings):
+        load_settings = {"host": self.server.settings["host"], "port": self.server.settings["port"],
+                         "control_port": self.server.settings["control_port"], "connections": 2, "processes": 2,
+                         "duration": 0.3}
+        load_settings.update(settings)
+        return LoadGenerator(load_settings).run()
+
+    def test_report(self):
+        report = self.run(pattern="zipf", pipeline=4)
+        assert report["num_lines"] == 100
+        assert report["requests"] > 0
+        assert report["outcomes"]["ok"] == report["requests"]
+        assert report["connection_errors"] == 0
+        assert 0 < report["latency_ms_p50"] <= report["latency_ms_p99"] <= report["latency_ms_p999"]
+
+    def test_commands(self):
+        for command in ("MGET", "STREAM", "GET"):
+            report = self.run(command=command, lines_per_request=5, pattern="sequential", processes=1)
+            assert report["requests"] > 0
+            assert report["outcomes"]["ok"] == report["requests"]
@@ -0,0 +1,72 @@
+__author__ = 'white'
+import os
+from server.cache import LRUCache, SharedLineCache
+
+
+class TestLRUCache():
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(10)
+        cache.put("a", 1, 4)
+        cache.put("b", 2, 4)
+        assert cache.get("a") == 1
+        cache.put("c", 3, 4)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.size == 8
+
+    def test_stats_count_hits_and_misses(self):
+        cache = LRUCache(10)
+        cache.put("a", 1, 1)
+        cache.get("a")
+        cache.get("b")
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+    def test_discard_removes_matching_entries(self):
+        cache = LRUCache(10)
+        cache.put(("x", 0), 1, 1)
+        cache.put(("y", 0), 2, 1)
+        cache.discard(lambda key: key[0] == "x")
+        assert cache.get(("x", 0)) is None
+        assert cache.get(("y", 0)) == 2
+        assert cache.size == 1
+
+
+class TestSharedLineCache():
+
+    def test_cached_line_is_returned_for_same_index_version(self):
+        cache = SharedLineCache(64 * 1024, 16)
+        cache.put(1, 10, 7, "line ten")
+        assert cache.get(1, 10, 7) == "line ten"
+        assert cache.get(1, 10, 8) is None
+        assert cache.get(2, 10, 7) is None
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 2
+
+    def test_long_lines_are_not_cached(self):
+        cache = SharedLineCache(64 * 1024, 4)
+        cache.put(1, 1, 0, "12345")
+        assert cache.get(1, 1, 0) is None
+
+    def test_least_frequently_used_line_is_replaced(self):
+        cache = SharedLineCache(1, 8)
+        assert cache.num_sets == 1
+        for line_no in range(1, cache.WAYS + 1):
+            cache.put(1, line_no, 0, str(line_no))
+            cache.get(1, line_no, 0)
+        cache.get(1, 1, 0)
+        cache.put(1, 100, 0, "100")
+        assert cache.get(1, 100, 0) == "100"
+        assert cache.get(1, 1, 0) == "1"
+        assert cache.stats()["evictions"] == 1
+
+    def test_lines_are_shared_with_forked_processes(self):
+        cache = SharedLineCache(64 * 1024, 16)
+        pid = os.fork()
+        if pid == 0:
+            cache.put(1, 5, 0, "from child")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert cache.get(1, 5, 0) == "from child"
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import time
+from server.catalog import LineFileCatalog, CatalogError, CatalogIndexBuilder
+from server.cache import LRUCache
+from server.indexer import ChunkedIndexBuilder
+
+
+# An index builder failing the first failures builds
+class FailingIndexBuilder(ChunkedIndexBuilder):
+
+    failures = 0
+
+    def build(self):
+        if FailingIndexBuilder.failures > 0:
+            FailingIndexBuilder.failures -= 1
+            raise IOError("The disk is gone")
+        return super(FailingIndexBuilder, self).build()
+
+
+class TestLineFileCatalog():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.settings = {"num_of_lines_per_index_page": 2, "num_of_index_workers": 1, "index_build_mode": "lazy",
+                         "index_wait_timeout": 5.0, "index_checkpoint_interval": 1,
+                         "index_page_encoding": "fixed", "index_page_compression": None, "replica_of": None,
+                         "replica_wait_timeout": 600}
+        self.catalog = LineFileCatalog(self.settings, LRUCache(1024 * 1024))
+        for name, lines in (("first.txt", "a\nb\nc\n"), ("second.txt", "x\ny\n")):
+            with open(os.path.join(self.folder, name), "w") as f:
+                f.write(lines)
+            self.catalog.add(os.path.join(self.folder, name))
+        self.catalog.prepare_indexes()
+
+    def teardown_method(self, method):
+        self.catalog.stop()
+        shutil.rmtree(self.folder)
+
+    # Waits until the index of the file named name is in state
+    def wait_for_state(self, name, state):
+        for i in range(500):
+            if self.catalog.progress()[name]["state"] == state:
+                return
+            time.sleep(0.01)
+        assert self.catalog.progress()[name]["state"] == state
+
+    def test_files_are_found_by_name(self):
+        assert self.catalog.get().get_line(1) == (200, "a")
+        assert self.catalog.get("second.txt").get_line(1) == (200, "x")
+        assert self.catalog.get("third.txt") is None
+
+    def test_files_share_the_index_cache(self):
+        self.catalog.get("first.txt").get_line(3)
+        self.catalog.get("second.txt").get_line(1)
+        assert len(self.catalog.index_cache.entries) == 2
+
+    def test_lazy_build_prepares_requested_indexes_only(self):
+        assert self.catalog.get("second.txt").get_line(2) == (200, "y")
+        # The lines can be read before the index is complete
+        self.wait_for_state("second.txt", "ready")
+        assert self.catalog.stats()["files"]["first.txt"]["index_progress"]["state"] == "pending"
+
+    def test_failed_build_is_not_waited_for_and_retried(self, monkeypatch):
+        monkeypatch.setattr(CatalogIndexBuilder, "retry_interval", 0.5)
+        FailingIndexBuilder.failures = 2
+        line_file = self.catalog.get("second.txt")
+        line_file.index_builder = FailingIndexBuilder
+        assert line_file.get_line(1) == (503, None)
+        started = time.time()
+        assert line_file.get_line(1) == (503, None)
+        assert time.time() - started < 1
+        # retried after 0.5 seconds, and after 1 second more
+        self.wait_for_state("second.txt", "ready")
+        assert FailingIndexBuilder.failures == 0
+        assert line_file.get_line(1) == (200, "x")
+
+    def test_background_build_prepares_every_index(self):
+        self.catalog.stop()
+        self.settings["index_build_mode"] = "background"
+        self.catalog.prepare_indexes()
+        for i in range(500):
+            if all(progress["state"] == "ready" for progress in self.catalog.progress().values()):
+                break
+            time.sleep(0.01)
+        files = self.catalog.stats()["files"]
+        assert (files["first.txt"]["num_lines"], files["second.txt"]["num_lines"]) == (3, 2)
+        assert files["first.txt"]["index_progress"]["lines_ready"] == 3
+
+    def test_file_names_are_unique(self):
+        os.mkdir(os.path.join(self.folder, "other"))
+        with open(os.path.join(self.folder, "other", "first.txt"), "w") as f:
+            f.write("z\n")
+        try:
+            self.catalog.add(os.path.join(self.folder, "other", "first.txt"))
+            assert False
+        except CatalogError:
+            pass
@@ -0,0 +1,156 @@
+__author__ = 'white'
+import os
+import shutil
+import tempfile
+import threading
+import pytest
+from client.line_client import LineRequest, LineReplyParser, LineClient, MultiplexLineClient, LineClientError, \
+    LineNotReadyError
+from server.protocol import LineProtocol
+from tests.test_server import ServerProcess
+
+
+class TestLineReplyParser():
+
+    def parse(self, requests, data, chunk_size=1):
+        parser = LineReplyParser()
+        pending = list(requests)
+        for i in range(0, len(data), chunk_size):
+            parser.feed(data[i:i + chunk_size])
+            while pending and parser.parse(pending[0]):
+                pending.pop(0)
+        assert not pending
+        return [request.result() for request in requests]
+
+    def test_replies_split_anywhere(self):
+        requests = [LineRequest.get(1), LineRequest.get(9), LineRequest.get_range(1, 2), LineRequest.mget([2, 9, 1]),
+                    LineRequest.stream(1, 2), LineRequest.get_range(5, 6)]
+        data = "OK\na\nERR\nOK 2\na\nb\nOK\nb\nERR\nOK\na\nOK 2 4\na\nb\nERR\n"
+        for chunk_size in (1, 3, len(data)):
+            assert self.parse(requests, data, chunk_size) == ["a", None, ["a", "b"], ["b", None, "a"], "a\nb\n", None]
+
+    def test_not_ready(self):
+        request = LineRequest.mget([1, 2])
+        assert self.parse([request], "OK\na\n" + LineProtocol.NOT_READY) == [["a", None]]
+        assert request.not_ready
+
+    def test_server_error(self):
+        requests = [LineRequest.get(1), LineRequest.get(2)]
+        message = "Woops!\nline \\2"
+        assert self.parse(requests, LineProtocol.format_error(message) + "OK\nb\n") == [None, "b"]
+        assert requests[0].server_error == message
+        assert requests[1].server_error is None
+
+    def test_empty_lines(self):
+        requests = [LineRequest.get(1), LineRequest.get_range(1, 2)]
+        assert self.parse(requests, LineProtocol.format_line(200, "") + "OK 2\n\nb\n") == ["", ["", "b"]]
+
+    def test_errors(self):
+        parser = LineReplyParser()
+        parser.feed(LineProtocol.INVALID_COMMAND)
+        with pytest.raises(LineClientError):
+            parser.parse(LineRequest.get(1))
+
+
+# The tests of both clients, against a server of 300 lines
+class ClientTests(object):
+
+    server_mode = "fork"
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        with open(self.file_path, "w") as f:
+            f.write("".join("line %d\n" % i for i in range(1, 301)))
+        self.server = ServerProcess(self.file_path, server_mode=self.server_mode, num_of_lines_per_index_page=10)
+        self.client = self.client_class("127.0.0.1", self.server.settings["port"], timeout=5.0, retries=8,
+                                        retry_interval=0.01)
+
+    def teardown_method(self, method):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def test_get(self):
+        assert self.client.get(1) == "line 1"
+        assert self.client.get(300, "lines.txt") == "line 300"
+        assert self.client.get(301) is None
+
+    def test_get_range_and_stream(self):
+        assert self.client.get_range(298, 305) == ["line 298", "line 299", "line 300"]
+        assert self.client.get_range(301, 305) is None
+        assert self.client.stream(299, 400) == "line 299\nline 300\n"
+        with pytest.raises(ValueError):
+            self.client.get_range(3, 2)
+
+    def test_long_ranges_are_split(self, monkeypatch):
+        monkeypatch.setattr(LineProtocol, "MAX_RANGE_LINES", 7)
+        assert self.client.get_range(1, 1000) == ["line %d" % i for i in range(1, 301)]
+        assert self.client.stream(5, 20) == "".join("line %d\n" % i for i in range(5, 21))
+
+    def test_get_many_pipelined(self):
+        line_nos = [i % 310 + 1 for i in range(5000)]
+        assert self.client.get_many(line_nos) == ["line %d" % i if i <= 300 else None for i in line_nos]
+
+    def test_broken_connection_is_retried(self):
+        assert self.client.get(1) == "line 1"
+        for connection in self.connections():
+            connection.sock.close()
+        assert self.client.get(2) == "line 2"
+
+    def test_retries_give_up(self):
+        self.client.retries = 1
+        self.server.stop()
+        for connection in self.connections():
+            connection.sock.close()
+        with pytest.raises(LineClientError) as err:
+            self.client.get(1)
+        assert not isinstance(err.value, LineNotReadyError)
+
+
+class TestLineClient(ClientTests):
+
+    client_class = LineClient
+
+    def test_concurrent_threads(self):
+        results = []
+
+        def read(first):
+            results.append(self.client.get_range(first, first + 9) == ["line %d" % i for i in range(first, first + 10)])
+
+        threads = [threading.Thread(target=read, args=(i * 10 + 1,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [True] * 20
+
+    def connections(self):
+        return self.client.pool.idle
+
+    def test_pool_limit(self):
+        self.client.pool.max_connections = 1
+        self.client.pool.acquire_timeout = 0.1
+        with self.client.pool.connection():
+            with pytest.raises(LineClientError):
+                self.client.get(1)
+        assert self.client.get(1) == "line 1"
+        assert self.client.pool.num_connections == 1
+
+
+class TestLineClientEventMode(TestLineClient):
+
+    server_mode = "event"
+
+
+class TestMultiplexLineClient(ClientTests):
+
+    client_class = MultiplexLineClient
+
+    def connections(self):
+        return self.client.connections
+
+    def test_batch_is_spread_over_connections(self):
+        line_nos = range(1, 301) * 3
+        assert self.client.get_many(line_nos) == ["line %d" % i for i in line_nos]
+        assert len(self.client.connections) == self.client.num_connections
@@ -0,0 +1,111 @@
+__author__ = 'white'
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+import pytest
+from server.models import LineFile
+from server.compressed import CompressedSource, BlockTable, zstandard
+
+
+# A zstd frame holding data in one raw (stored) block, which needs no zstd library to write
+def raw_zstd_frame(data):
+    return "\x28\xb5\x2f\xfd" + chr(0x20) + chr(len(data)) + struct.pack("<I", 1 | len(data) << 3)[:3] + data
+
+
+def gzip_member(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestCompressedLineFile():
+
+    lines = ["line %d:" % i + "x" * (i % 13) for i in range(1, 501)]
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.text_file_path = os.path.join(self.folder, "lines.txt")
+        with open(self.text_file_path, "w") as f:
+            f.write("\n".join(self.lines) + "\n")
+        self.file_path = os.path.join(self.folder, "lines.txt.gz")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def block_table(self, line_file):
+        return BlockTable.load(os.path.join(self.folder, "index", "%s.blocks" % line_file.file_path_hash))
+
+    def test_lines_are_read_from_blocks(self):
+        CompressedSource.write_blocks(self.text_file_path, self.file_path, "gzip", 500)
+        for checkpoint_interval in (1, 4):
+            line_file = LineFile(self.file_path, 20, index_checkpoint_interval=checkpoint_interval,
+                                 index_page_encoding="delta")
+            line_file.prepare_index()
+            assert line_file.num_lines == 500
+            assert self.block_table(line_file).num_blocks() > 10
+            for line_no, line in enumerate(self.lines, 1):
+                assert line_file.get_line(line_no) == (200, line)
+            assert line_file.get_line(501) == (404, None)
+            assert line_file.get_lines(30, 90) == (200, self.lines[29:90])
+
+    def test_nearby_lines_are_read_from_cached_blocks(self):
+        CompressedSource.write_blocks(self.text_file_path, self.file_path, "gzip", 4096)
+        line_file = LineFile(self.file_path, 20)
+        line_file.prepare_index()
+        for line_no in range(100, 120):
+            assert line_file.get_line(line_no) == (200, self.lines[line_no - 1])
+        assert line_file.stats()["block_cache"]["misses"] == 1
+
+    # Members of a gzip file cut anywhere, so lines span blocks
+    def test_lines_spanning_blocks(self):
+        text = "\n".join(self.lines)
+        with open(self.file_path, "wb") as f:
+            for start in range(0, len(text), 777):
+                f.write(gzip_member(text[start:start + 777]))
+            f.write(gzip_member(""))
+        line_file = LineFile(self.file_path, 20)
+        line_file.prepare_index()
+        assert line_file.num_lines == 500
+        for line_no, line in enumerate(self.lines, 1):
+            assert line_file.get_line(line_no) == (200, line)
+        num_lines, start, end = line_file.get_byte_range(1, 500)[1]
+        assert line_file.read_bytes(start, end) == text
+
+    def test_single_member_gzip_file(self):
+        f = gzip.open(self.file_path, "wb")
+        f.write("\n".join(self.lines))
+        f.close()
+        line_file = LineFile(self.file_path, 50)
+        line_file.prepare_index()
+        assert self.block_table(line_file).num_blocks() == 1
+        assert line_file.get_line(500) == (200, self.lines[499])
+
+    def test_rewritten_file_is_indexed_again(self):
+        CompressedSource.write_blocks(self.text_file_path, self.file_path, "gzip", 500)
+        line_file = LineFile(self.file_path, 20)
+        line_file.prepare_index()
+        assert line_file.get_line(2) == (200, self.lines[1])
+        with open(self.file_path, "wb") as f:
+            f.write(gzip_member("a\nb\n") + gzip_member("c\nd\ne\n"))
+        line_file.prepare_index()
+        assert line_file.num_lines == 5
+        assert line_file.get_line(2) == (200, "b")
+        assert line_file.get_line(4) == (200, "d")
+
+    def test_zstd_frames_are_found(self):
+        skippable = struct.pack("<II", 0x184D2A5E, 3) + "abc"
+        buf = raw_zstd_frame("a\nb\n") + skippable + raw_zstd_frame("c\n")
+        assert CompressedSource.zstd_frame_end(buf, 0) == (13, True)
+        assert CompressedSource.zstd_frame_end(buf, 13) == (24, False)
+        assert CompressedSource.zstd_frame_end(buf, 24) == (35, True)
+
+    @pytest.mark.skipif(zstandard is None, reason="zstandard is not installed")
+    def test_zstd_file(self):
+        CompressedSource.write_blocks(self.text_file_path, self.file_path, "zstd", 500)
+        line_file = LineFile(self.file_path, 20)
+        line_file.prepare_index()
+        assert self.block_table(line_file).num_blocks() > 10
+        for line_no, line in enumerate(self.lines, 1):
+            assert line_file.get_line(line_no) == (200, line)
@@ -0,0 +1,60 @@
+__author__ = 'white'
+import os
+import shutil
+import tempfile
+from server.indexer import ReadlineIndexBuilder, ChunkedIndexBuilder, ParallelIndexBuilder
+
+
+# Builds the index of some content with a builder and returns (number of lines, {page number: offsets})
+def build(builder_class, content, num_of_lines_per_index_page=3, *args, **attrs):
+    folder = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(folder, "lines.txt")
+        with open(file_path, "wb") as f:
+            f.write(content)
+
+        # pages are recorded in files, so pages written by pool workers are seen here too
+        def write_page(page_number, offsets):
+            with open(os.path.join(folder, "%d.page" % page_number), "w") as page_file:
+                page_file.write(" ".join(str(offset) for offset in offsets))
+
+        builder = builder_class(file_path, num_of_lines_per_index_page, write_page, *args)
+        for name, value in attrs.items():
+            setattr(builder, name, value)
+        num_lines = builder.build()
+        pages = {}
+        for name in os.listdir(folder):
+            if name.endswith(".page"):
+                with open(os.path.join(folder, name)) as page_file:
+                    pages[int(name.split(".")[0])] = [int(offset) for offset in page_file.read().split()]
+        return num_lines, pages
+    finally:
+        shutil.rmtree(folder)
+
+
+class TestIndexBuilders():
+
+    contents = ["", "\n", "a", "a\n", "a\nbb\nccc\ndddd\n", "a\nbb\nccc\ndddd\neeeee\nffffff", "\n\n\n\n\n\n\nx\n"]
+
+    def test_chunked_builder_matches_readline_builder(self):
+        for content in self.contents:
+            expected = build(ReadlineIndexBuilder, content)
+            assert build(ChunkedIndexBuilder, content) == expected
+            assert build(ChunkedIndexBuilder, content, chunk_size=2) == expected
+
+    def test_pages_share_boundaries(self):
+        num_lines, pages = build(ChunkedIndexBuilder, "a\nbb\nccc\ndddd\neeeee\nffffff", chunk_size=4)
+        assert num_lines == 6
+        assert pages == {0: [0, 2, 5, 9], 1: [9, 14, 20, 26]}
+
+    def test_empty_file_has_no_lines(self):
+        assert build(ChunkedIndexBuilder, "") == (0, {})
+
+    def test_parallel_builder_matches_chunked_builder(self):
+        contents = self.contents + ["".join("%d\n" % i * (i % 4) for i in range(200))]
+        for content in contents:
+            for num_of_lines_per_index_page in (1, 7):
+                expected = build(ChunkedIndexBuilder, content, num_of_lines_per_index_page)
+                for range_size in (1, 5):
+                    assert build(ParallelIndexBuilder, content, num_of_lines_per_index_page, 3,
+                                 range_size=range_size) == expected
@@ -0,0 +1,179 @@
+__author__ = 'white'
+import os
+import json
+import logging
+import shutil
+import signal
+import threading
+import time
+import tempfile
+from server.access_log import AccessLog
+from utils.tools import QueueLoggingHandler, LoggingUtil
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class TestQueueLoggingHandler():
+
+    def setup_method(self, method):
+        self.handler = ListHandler()
+        self.queue_handler = QueueLoggingHandler([self.handler])
+        self.logger = logging.getLogger("test_logging.%s" % method.__name__)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.queue_handler)
+
+    def teardown_method(self, method):
+        self.logger.removeHandler(self.queue_handler)
+
+    def test_records_are_written_by_the_writer_thread(self):
+        self.logger.info("line %d", 1)
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            self.logger.error("failed", exc_info=True)
+        self.queue_handler.flush()
+        assert self.handler.messages[0] == "line 1"
+        assert self.handler.messages[1].startswith("failed\nTraceback")
+        assert "ValueError: broken" in self.handler.messages[1]
+
+    def test_level_of_handlers_is_kept(self):
+        self.handler.setLevel(logging.WARNING)
+        self.logger.info("skipped")
+        self.logger.warning("kept")
+        self.queue_handler.flush()
+        assert self.handler.messages == ["kept"]
+
+    def test_forked_process_starts_its_own_writer(self):
+        self.logger.info("parent")
+        self.queue_handler.flush()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self.logger.info("child")
+            self.queue_handler.flush()
+            os.write(write_fd, json.dumps(self.handler.messages))
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        assert json.loads(os.read(read_fd, 4096)) == ["parent", "child"]
+        os.close(read_fd)
+
+    def test_threads_logging_first_start_one_writer(self):
+        num_writers = len([thread for thread in threading.enumerate() if thread.name == "LogWriter"])
+        start = threading.Event()
+
+        def log(i):
+            start.wait()
+            self.logger.info("thread %d", i)
+        threads = [threading.Thread(target=log, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.queue_handler.flush()
+        assert sorted(self.handler.messages) == sorted("thread %d" % i for i in range(20))
+        assert len([thread for thread in threading.enumerate() if thread.name == "LogWriter"]) == num_writers + 1
+
+    def test_forked_process_logs_while_the_parent_held_the_logging_lock(self):
+        self.logger.info("parent")
+        self.queue_handler.flush()
+        locked, forked = threading.Event(), threading.Event()
+
+        def hold_lock():
+            logging._acquireLock()
+            locked.set()
+            forked.wait()
+            logging._releaseLock()
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        pid = os.fork()
+        if pid == 0:
+            LoggingUtil.after_fork()
+            logging.getLogger("test_logging.child").info("child")
+            os._exit(0)
+        forked.set()
+        thread.join()
+        for i in range(500):
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return
+            time.sleep(0.01)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        assert False, "The forked process hangs"
+
+
+class TestAccessLog():
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "access.log")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.folder)
+
+    def read_entries(self):
+        if not os.path.exists(self.file_path):
+            return []
+        with open(self.file_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_entries_are_written_on_flush(self):
+        access_log = AccessLog(self.file_path, flush_interval=60)
+        access_log.log(("127.0.0.1", 5000), "GET", [None, 12], 0.000035, "OK\nline 12\n")
+        access_log.log(("127.0.0.1", 5000), "MGET", ["a.txt", 1, 5], 0.001, "ERR NOT READY\n")
+        assert self.read_entries() == []
+        access_log.flush()
+        entries = self.read_entries()
+        assert len(entries) == 2
+        assert entries[0]["client"] == "127.0.0.1:5000"
+        assert (entries[0]["command"], entries[0]["file"], entries[0]["args"]) == ("GET", None, [12])
+        assert (entries[0]["outcome"], entries[0]["latency_us"]) == ("ok", 35)
+        assert (entries[1]["file"], entries[1]["outcome"]) == ("a.txt", "not_ready")
+        assert entries[1]["pid"] == os.getpid()
+
+    def test_sampling_and_rate_limit(self):
+        access_log = AccessLog(self.file_path, sample_rate=0.0, flush_interval=60)
+        access_log.log(None, "GET", [None, 1], 0.001, "OK\na\n")
+        access_log.flush()
+        assert self.read_entries() == []
+        access_log = AccessLog(self.file_path, max_per_second=5, flush_interval=60)
+        for i in range(20):
+            access_log.log(None, "GET", [None, i], 0.001, "OK\na\n")
+        access_log.flush()
+        assert 5 <= len(self.read_entries()) <= 10
+
+    def test_full_batch_is_written_by_the_writer_thread(self):
+        access_log = AccessLog(self.file_path, flush_interval=60, batch_size=10)
+        for i in range(10):
+            access_log.log(None, "GET", [None, i], 0.001, "OK\na\n")
+        for i in range(100):
+            if len(self.read_entries()) == 10:
+                break
+            time.sleep(0.05)
+        assert [entry["args"] for entry in self.read_entries()] == [[i] for i in range(10)]
+
+    def test_forked_process_writes_its_own_entries(self):
+        access_log = AccessLog(self.file_path, flush_interval=60)
+        access_log.log(None, "GET", [None, 1], 0.001, "OK\na\n")
+        pid = os.fork()
+        if pid == 0:
+            access_log.log(None, "GET", [None, 2], 0.001, "OK\na\n")
+            access_log.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        access_log.flush()
+        entries = self.read_entries()
+        assert sorted(entry["args"] for entry in entries) == [[1], [2]]
+        assert len(set(entry["pid"] for entry in entries)) == 2
@@ -0,0 +1,58 @@
+__author__ = 'white'
+import os
+from server.metrics import ServerMetrics, PrometheusFormat
+
+
+class TestServerMetrics():
+
+    def test_requests_are_counted_by_outcome(self):
+        metrics = ServerMetrics()
+        metrics.request("GET", 0.001, "OK\na\n")
+        metrics.request("GET", 0.002, "ERR\n")
+        metrics.request("GET", 0.003, "ERR NOT READY\n")
+        metrics.request("STREAM", 0.004, "OK 1 2\n")
+        commands = metrics.to_dict()["commands"]
+        assert (commands["GET"]["requests"], commands["GET"]["ok"], commands["GET"]["err"],
+                commands["GET"]["not_ready"]) == (3, 1, 1, 1)
+        assert commands["GET"]["latency_us_sum"] == 6000
+        assert commands["STREAM"]["requests"] == 1
+        assert commands["MGET"]["requests"] == 0
+        assert commands["MGET"]["latency_us_p50"] is None
+
+    def test_percentiles_are_read_from_the_histogram(self):
+        metrics = ServerMetrics()
+        for i in range(98):
+            metrics.request("GET", 0.0001, "OK\na\n")
+        metrics.request("GET", 0.01, "OK\na\n")
+        metrics.request("GET", 0.1, "OK\na\n")
+        command = metrics.to_dict()["commands"]["GET"]
+        assert 100 <= command["latency_us_p50"] < 120
+        assert 100 <= command["latency_us_p95"] < 120
+        assert 10000 <= command["latency_us_p99"] < 12000
+
+    def test_counts_of_forked_processes_are_kept(self):
+        metrics = ServerMetrics()
+        metrics.count("connections_opened")
+        pid = os.fork()
+        if pid == 0:
+            metrics.count("connections_opened")
+            metrics.count("connections_closed")
+            metrics.request("MGET", 0.001, "OK\na\n")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        stats = metrics.to_dict()
+        assert (stats["connections_opened"], stats["connections_active"]) == (2, 1)
+        assert stats["commands"]["MGET"]["requests"] == 1
+
+    def test_prometheus_format(self):
+        metrics = ServerMetrics()
+        metrics.request("GET", 0.0003, "OK\na\n")
+        stats = {"metrics": metrics.to_dict(), "line_cache": None, "server": {"server_mode": "fork", "children": 2},
+                 "files": {"lines.txt": {"num_lines": 3, "index_progress": {"state": "ready", "lines_ready": 3}}}}
+        text = PrometheusFormat.format(stats)
+        assert 'linesvr_requests_total{command="GET",outcome="ok"} 1' in text
+        assert 'linesvr_request_duration_seconds_bucket{command="GET",le="0.000256"} 0' in text
+        assert 'linesvr_request_duration_seconds_bucket{command="GET",le="0.000512"} 1' in text
+        assert 'linesvr_request_duration_seconds_count{command="GET"} 1' in text
+        assert 'linesvr_index_ready{file="lines.txt"} 1' in text
+        assert 'linesvr_server_children 2' in text
@@ -0,0 +1,226 @@
+__author__ = 'white'
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import pytest
+from server.models import LineFile
+from server.index import IndexManifest, IndexPageError
+from server.indexer import ChunkedIndexBuilder
+from server.replica import IndexReplica, IndexShipping
+from server.compressed import CompressedSource
+from tests.test_server import ServerProcess, free_port
+
+
+# An index builder failing the test if a replica scans its text file
+class FailingIndexBuilder(ChunkedIndexBuilder):
+
+    def build(self):
+        raise AssertionError("The replica scanned its text file")
+
+
+# A file the index of a LineFile is sent to, which rebuilds the index while it is being sent
+class RebuildingFile(object):
+
+    def __init__(self, line_file):
+        self.line_file = line_file
+        self.data = []
+
+    def write(self, data):
+        if len(self.data) == 1:
+            # The index lock is not held while the index is sent
+            with self.line_file.index_lock.hold():
+                pass
+            self.line_file.buildIndex()
+        self.data.append(data)
+
+
+# A replica fetching no index, checking that the index lock is free while it fetches
+class LockCheckingReplica(object):
+
+    def __init__(self, line_file):
+        self.line_file = line_file
+        self.lock_taken = threading.Event()
+
+    def fetch(self, folder):
+        def take_lock():
+            with self.line_file.index_lock.hold():
+                self.lock_taken.set()
+        threading.Thread(target=take_lock).start()
+        self.lock_taken.wait(5)
+        return None
+
+
+# A primary server answering every connection with the manifest cut short
+class TruncatedManifestServer(threading.Thread):
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("127.0.0.1", free_port()))
+        self.socket.listen(5)
+        self.address = self.socket.getsockname()
+        self.connections = 0
+        super(TruncatedManifestServer, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            try:
+                s, client_address = self.socket.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            s.sendall('OK 1\nmanifest 11\n{"num_lines')
+            s.close()
+
+    def stop(self):
+        self.socket.shutdown(socket.SHUT_RDWR)
+        self.socket.close()
+
+
+class TestIndexReplica():
+
+    lines = ["line %d:" % i + "x" * (i % 9) for i in range(1, 101)]
+
+    def setup_method(self, method):
+        self.primary_folder = tempfile.mkdtemp()
+        self.replica_folder = tempfile.mkdtemp()
+        self.servers = []
+
+    def teardown_method(self, method):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.primary_folder)
+        shutil.rmtree(self.replica_folder)
+
+    def write_file(self, folder, lines, name="lines.txt"):
+        file_path = os.path.join(folder, name)
+        with open(file_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return file_path
+
+    def start_server(self, file_path, **settings):
+        server = ServerProcess(file_path, num_of_lines_per_index_page=8, **settings)
+        self.servers.append(server)
+        return server
+
+    # A LineFile with the index format of the servers, fetching its index from primary
+    def replica_line_file(self, file_path, primary, **settings):
+        line_file = LineFile(file_path, 8, **settings)
+        line_file.replica = IndexReplica((primary.settings["host"], primary.settings["control_port"]),
+                                         os.path.basename(file_path), wait_timeout=5, retry_interval=0.05)
+        return line_file
+
+    def index_pages(self, line_file):
+        folder = os.path.join(os.path.dirname(line_file.file_path), "index")
+        return sorted(open(os.path.join(folder, name), "rb").read() for name in os.listdir(folder)
+                      if name.startswith(line_file.file_path_hash) and name.endswith(".idx"))
+
+    def test_replica_copies_the_index_of_the_primary(self):
+        primary = self.start_server(self.write_file(self.primary_folder, self.lines))
+        line_file = self.replica_line_file(self.write_file(self.replica_folder, self.lines), primary)
+        line_file.index_builder = FailingIndexBuilder
+        line_file.prepare_index()
+        assert line_file.num_lines == 100
+        for line_no, line in enumerate(self.lines, 1):
+            assert line_file.get_line(line_no) == (200, line)
+        primary_line_file = LineFile(os.path.join(self.primary_folder, "lines.txt"), 8)
+        primary_line_file.prepare_index()
+        assert self.index_pages(line_file) == self.index_pages(primary_line_file)
+        # The copied index is reused by the next replica process
+        line_file = LineFile(line_file.file_path, 8)
+        line_file.index_builder = FailingIndexBuilder
+        line_file.prepare_index()
+        assert line_file.get_line(100) == (200, self.lines[99])
+
+    def test_index_is_sent_from_a_snapshot(self):
+        line_file = LineFile(self.write_file(self.primary_folder, self.lines), 8)
+        line_file.prepare_index()
+        files = [(name, open(path, "rb").read()) for name, path in line_file.index_files()]
+        wfile = RebuildingFile(line_file)
+        IndexShipping.send(wfile, line_file)
+        assert "".join(wfile.data) == "OK %d\n" % len(files) + \
+            "".join("%s %d\n%s" % (name, len(data), data) for name, data in files)
+        assert not [name for name in os.listdir(os.path.join(self.primary_folder, "index")) if ".send." in name]
+
+    def test_replica_builds_the_index_of_another_text(self):
+        primary = self.start_server(self.write_file(self.primary_folder, self.lines))
+        lines = list(self.lines)
+        lines[0] = "another first line"
+        line_file = self.replica_line_file(self.write_file(self.replica_folder, lines), primary)
+        line_file.prepare_index()
+        assert line_file.get_line(1) == (200, "another first line")
+        assert line_file.get_line(2) == (200, self.lines[1])
+
+    def test_replica_builds_an_index_of_another_format(self):
+        primary = self.start_server(self.write_file(self.primary_folder, self.lines))
+        line_file = self.replica_line_file(self.write_file(self.replica_folder, self.lines), primary,
+                                           index_checkpoint_interval=4)
+        line_file.prepare_index()
+        assert line_file.get_line(50) == (200, self.lines[49])
+
+    def test_replica_builds_the_index_of_a_file_the_primary_does_not_have(self):
+        primary = self.start_server(self.write_file(self.primary_folder, self.lines))
+        line_file = self.replica_line_file(self.write_file(self.replica_folder, self.lines, "other.txt"), primary)
+        line_file.prepare_index()
+        assert line_file.get_line(3) == (200, self.lines[2])
+
+    def test_replica_of_a_compressed_file(self, monkeypatch):
+        text_file_path = self.write_file(self.primary_folder, self.lines)
+        CompressedSource.write_blocks(text_file_path, text_file_path + ".gz", "gzip", 100)
+        shutil.copy(text_file_path + ".gz", self.replica_folder)
+        primary = self.start_server(text_file_path + ".gz")
+        line_file = self.replica_line_file(os.path.join(self.replica_folder, "lines.txt.gz"), primary)
+        monkeypatch.setattr("server.models.CompressedIndexBuilder", FailingIndexBuilder)
+        line_file.prepare_index()
+        assert line_file.compression == "gzip"
+        for line_no, line in enumerate(self.lines, 1):
+            assert line_file.get_line(line_no) == (200, line)
+
+    def test_pages_are_verified_against_the_text(self):
+        line_file = LineFile(self.write_file(self.replica_folder, self.lines), 8)
+        line_file.prepare_index()
+        source = IndexManifest.describe_source(line_file.file_path)
+        page_file_paths = [path for name, path in line_file.index_files() if name.endswith(".idx")]
+        line_file.verify_index_pages(page_file_paths, None, source, line_file.fingerprint, line_file.index_build)
+        for paths in (page_file_paths[:-1], page_file_paths[:2] + page_file_paths[3:],
+                      [page_file_paths[1], page_file_paths[0]] + page_file_paths[2:]):
+            with pytest.raises(IndexPageError):
+                line_file.verify_index_pages(paths, None, source, line_file.fingerprint, line_file.index_build)
+        with pytest.raises(IndexPageError):
+            line_file.verify_index_pages(page_file_paths, None, source, "f" * 16)
+        with pytest.raises(IndexPageError):
+            line_file.verify_index_pages(page_file_paths, None, source, line_file.fingerprint,
+                                         line_file.index_build + 1)
+
+    def test_index_lock_is_not_held_while_fetching(self):
+        line_file = LineFile(self.write_file(self.replica_folder, self.lines), 8)
+        line_file.replica = LockCheckingReplica(line_file)
+        line_file.prepare_index()
+        assert line_file.replica.lock_taken.is_set()
+        assert line_file.get_line(3) == (200, self.lines[2])
+
+    def test_truncated_manifest_is_fetched_again_and_the_index_built(self):
+        primary = TruncatedManifestServer()
+        primary.start()
+        try:
+            line_file = LineFile(self.write_file(self.replica_folder, self.lines), 8)
+            line_file.replica = IndexReplica(primary.address, "lines.txt", wait_timeout=0.2, retry_interval=0.05)
+            line_file.prepare_index()
+            assert primary.connections > 1
+            assert line_file.get_line(3) == (200, self.lines[2])
+        finally:
+            primary.stop()
+
+    def test_replica_server(self):
+        primary = self.start_server(self.write_file(self.primary_folder, self.lines))
+        replica = self.start_server(self.write_file(self.replica_folder, self.lines),
+                                    replica_of="%s:%d" % (primary.settings["host"], primary.settings["control_port"]))
+        for i in range(100):
+            reply = replica.send("GET 42\nQUIT\n")
+            if reply != "ERR NOT READY\n":
+                break
+            time.sleep(0.1)
+        assert reply == "OK\n%s\n" % self.lines[41]
@@ -0,0 +1,400 @@
+__author__ = 'white'
+import os
+import re
+import shutil
+import signal
+import socket
+import tempfile
+import json
+import multiprocessing
+import threading
+import time
+import pytest
+from server.server import Server
+from server.event_server import EventLoopServer, _answer_commands
+from server.metrics import ServerMetrics
+from server.lifecycle import SignalRequests
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def run_server(settings, text_file_path):
+    Server(settings, text_file_path).start()
+
+
+# A line server running in its own process, so the processes it forks do not inherit the sockets of the test clients
+class ServerProcess(object):
+
+    def __init__(self, text_file_path, **settings):
+        self.settings = {
+            "host": "127.0.0.1",
+            "port": free_port(),
+            "control_port": free_port(),
+            "num_of_lines_per_index_page": 2,
+            "index_refresh_interval": 0
+        }
+        self.settings.update(settings)
+        self.address = (self.settings["host"], self.settings["port"])
+        self.process = multiprocessing.Process(target=run_server, args=(self.settings, text_file_path))
+        self.process.start()
+        for i in range(500):
+            try:
+                socket.create_connection(self.address, 1).close()
+                socket.create_connection((self.settings["host"], self.settings["control_port"]), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.01)
+        raise Exception("The server did not start")
+
+    def connect(self):
+        return socket.create_connection(self.address, 5)
+
+    # Sends commands on one connection and returns everything the server sent back until it closed the connection
+    def send(self, data):
+        s = self.connect()
+        try:
+            s.sendall(data)
+            received = []
+            chunk = s.recv(65536)
+            while chunk:
+                received.append(chunk)
+                chunk = s.recv(65536)
+            return "".join(received)
+        finally:
+            s.close()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    # Reads until the server closes the connection
+    @classmethod
+    def receive_all(cls, s):
+        received = []
+        chunk = s.recv(65536)
+        while chunk:
+            received.append(chunk)
+            chunk = s.recv(65536)
+        return "".join(received)
+
+
+class TestServer():
+
+    server_mode = "fork"
+    settings = {}
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "lines.txt")
+        with open(self.file_path, "w") as f:
+            f.write("a\nb\nc\n")
+        self.server = ServerProcess(self.file_path, server_mode=self.server_mode, **self.settings)
+
+    def teardown_method(self, method):
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def test_get_and_quit(self):
+        assert self.server.send("GET 1\nGET 3\nGET 4\nGET x\nQUIT\nGET 2\n") == "OK\na\nOK\nc\nERR\nINVALID COMMAND!\n"
+
+    def test_get_range_and_mget(self):
+        assert self.server.send("GET 2-3\nGET 2-9\nGET 4-5\nGET 3-2\nMGET 3 9 1\nQUIT\n") == \
+            "OK 2\nb\nc\nOK 2\nb\nc\nERR\nINVALID COMMAND!\nOK\nc\nERR\nOK\na\n"
+
+    def test_stream_range(self):
+        assert self.server.send("GET 1\nSTREAM 2-3\nSTREAM 3-9\nSTREAM 4-5\nGET 1\nQUIT\n") == \
+            "OK\na\nOK 2 4\nb\nc\nOK 1 2\nc\nERR\nOK\na\n"
+
+    def test_pipelined_commands(self):
+        s = self.server.connect()
+        try:
+            s.sendall("".join("GET %d\n" % (i % 3 + 1) for i in range(3000)) + "QUIT\n")
+            received = []
+            chunk = s.recv(65536)
+            while chunk:
+                received.append(chunk)
+                chunk = s.recv(65536)
+        finally:
+            s.close()
+        assert "".join(received) == "".join("OK\n%s\n" % "abc"[i % 3] for i in range(3000))
+
+    def control(self, command):
+        s = socket.create_connection((self.server.settings["host"], self.server.settings["control_port"]), 5)
+        try:
+            s.sendall(command)
+            return s.makefile().read()
+        finally:
+            s.close()
+
+    def progress(self):
+        return json.loads(self.control("PROGRESS\n"))
+
+    def test_progress_on_control_port(self):
+        assert self.server.send("GET 3\nQUIT\n") == "OK\nc\n"
+        for i in range(500):
+            progress = self.progress()
+            if progress["lines.txt"]["state"] == "ready":
+                break
+            time.sleep(0.01)
+        assert progress["lines.txt"]["state"] == "ready"
+        assert progress["lines.txt"]["lines_ready"] == 3
+
+    def test_stats_on_control_port(self):
+        assert self.server.send("GET 1\nGET 9\nMGET 1 2\nSTREAM 1-2\nGET x\nQUIT\n") == \
+            "OK\na\nERR\nOK\na\nOK\nb\nOK 2 4\na\nb\nINVALID COMMAND!\n"
+        for i in range(500):
+            stats = json.loads(self.control("STATS\n"))
+            if stats["metrics"]["connections_active"] == 0:
+                break
+            time.sleep(0.01)
+        metrics = stats["metrics"]
+        # the connections checking that the server is listening are counted too
+        assert metrics["connections_opened"] >= 1
+        assert metrics["invalid_commands"] == 1
+        assert (metrics["commands"]["GET"]["requests"], metrics["commands"]["GET"]["err"]) == (2, 1)
+        assert metrics["commands"]["MGET"]["ok"] == 1
+        assert metrics["commands"]["STREAM"]["ok"] == 1
+        assert metrics["commands"]["GET"]["latency_us_p99"] > 0
+        assert stats["server"]["server_mode"] == self.server_mode
+        assert 'linesvr_requests_total{command="GET",outcome="ok"} 1' in self.control("METRICS\n")
+
+    def test_concurrent_connections(self):
+        connections = [self.server.connect() for i in range(20)]
+        try:
+            for i, s in enumerate(connections):
+                s.sendall("GET %d\n" % (i % 3 + 1))
+            for i, s in enumerate(connections):
+                assert s.recv(100) == "OK\n%s\n" % "abc"[i % 3]
+        finally:
+            for s in connections:
+                s.close()
+
+    # The commands sent before SIGTERM are answered, then the connections are closed and the server exits,
+    # without waiting for idle connections
+    def test_sigterm_drains_connections(self):
+        busy, idle = self.server.connect(), self.server.connect()
+        try:
+            for s in (busy, idle):
+                s.sendall("GET 1\n")
+                assert s.recv(100) == "OK\na\n"
+            busy.sendall("GET 2\nMGET 3 1\n")
+            started = time.time()
+            os.kill(self.server.process.pid, signal.SIGTERM)
+            assert ServerProcess.receive_all(busy) == "OK\nb\nOK\nc\nOK\na\n"
+            assert ServerProcess.receive_all(idle) == ""
+        finally:
+            busy.close()
+            idle.close()
+        self.server.process.join(5)
+        assert self.server.process.exitcode == 0
+        assert time.time() - started < 5
+        with pytest.raises(socket.error):
+            self.server.connect()
+
+    def test_shutdown_command_stops_the_server(self):
+        assert self.server.send("GET 1\nSHUTDOWN\n") == "OK\na\n"
+        self.server.process.join(5)
+        assert self.server.process.exitcode == 0
+
+    # After SIGHUP the server reads a text file replaced by a file of the same size
+    def test_sighup_reloads_a_replaced_file(self):
+        for i in range(500):
+            if self.progress()["lines.txt"]["state"] == "ready":
+                break
+            time.sleep(0.01)
+        assert self.server.send("GET 2\nQUIT\n") == "OK\nb\n"
+        with open(self.file_path + ".tmp", "w") as f:
+            f.write("x\ny\nz\n")
+        os.rename(self.file_path + ".tmp", self.file_path)
+        os.kill(self.server.process.pid, signal.SIGHUP)
+        # Pre-fork workers switch to the new index when the main process has reloaded it.
+        # Meanwhile every line is read from the old or from the new file
+        for i in range(500):
+            replies = [self.server.send("GET 1\nGET 2\nGET 3\nQUIT\n") for j in range(4)]
+            if replies == ["OK\nx\nOK\ny\nOK\nz\n"] * 4:
+                break
+            for reply in replies:
+                assert re.match("^OK\n[ax]\nOK\n[by]\nOK\n[cz]\n$", reply)
+            time.sleep(0.01)
+        assert replies == ["OK\nx\nOK\ny\nOK\nz\n"] * 4
+
+
+class TestSignalRequests():
+
+    def test_requests_of_a_signal_handler_run_in_the_thread(self):
+        threads = []
+        done = threading.Event()
+        signal_requests = SignalRequests({"x": lambda: (threads.append(threading.current_thread()), done.set())})
+        signal_requests.start()
+        old_handler = signal.signal(signal.SIGUSR1, lambda signum, frame: signal_requests.request("x"))
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            assert done.wait(5)
+            assert threads == [signal_requests]
+        finally:
+            signal.signal(signal.SIGUSR1, old_handler)
+
+
+class TestServerCatalog():
+
+    server_mode = "fork"
+
+    def setup_method(self, method):
+        self.folder = tempfile.mkdtemp()
+        file_paths = []
+        for name, lines in (("first.txt", "a\nb\nc\n"), ("second.txt", "x\ny\n")):
+            file_paths.append(os.path.join(self.folder, name))
+            with open(file_paths[-1], "w") as f:
+                f.write(lines)
+        self.server = ServerProcess(file_paths, server_mode=self.server_mode, index_build_mode="lazy")
+
+    def teardown_method(self, method):
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def test_use_and_named_get(self):
+        assert self.server.send("GET 1\nUSE second.txt\nGET 1\nGET first.txt 3\nMGET 2 1\nUSE third.txt\nGET 2\n"
+                                "GET third.txt 1\nQUIT\n") == "OK\na\nOK\nOK\nx\nOK\nc\nOK\ny\nOK\nx\nERR\nOK\ny\nERR\n"
+
+    def num_of_manifests(self):
+        return len([name for name in os.listdir(os.path.join(self.folder, "index")) if name.endswith(".manifest")])
+
+    def test_indexes_are_built_on_first_access(self):
+        assert self.num_of_manifests() == 0
+        assert self.server.send("GET second.txt 2-2\nQUIT\n") == "OK 1\ny\n"
+        # Lines are served from the index pages already written, before the manifest is written
+        for i in range(100):
+            if self.num_of_manifests():
+                break
+            time.sleep(0.05)
+        assert self.num_of_manifests() == 1
+
+
+class TestEventLoopServerCatalog(TestServerCatalog):
+
+    server_mode = "event"
+
+
+# A LineFile whose reads fail
+class FailingLineFile(object):
+
+    def get_line(self, line_no):
+        raise IOError("The disk is gone")
+
+
+# A LineFile whose reads wait until it is released
+class GatedLineFile(object):
+
+    def __init__(self):
+        self.released = threading.Event()
+
+    def get_line(self, line_no):
+        self.released.wait()
+        return 200, "a"
+
+
+# A catalog serving one GatedLineFile
+class GatedCatalog(object):
+
+    def __init__(self):
+        self.line_file = GatedLineFile()
+        self.metrics = ServerMetrics()
+        self.access_log = None
+
+    def get(self, name=None):
+        return self.line_file
+
+
+class TestEventLoopServer(TestServer):
+
+    server_mode = "event"
+    settings = {"output_buffer_max_bytes": 64 * 1024}
+
+    def test_failed_batch_has_no_reply(self):
+        assert _answer_commands(["OK\n", (FailingLineFile(), "GET", [None, 1])], None, ("127.0.0.1", 1)) is None
+
+    def test_commands_wait_while_the_client_does_not_read_replies(self):
+        self.server.stop()
+        line = "x" * 10000
+        with open(self.file_path, "w") as f:
+            f.write(line + "\n")
+        self.server = ServerProcess(self.file_path, server_mode=self.server_mode, **self.settings)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.settimeout(5)
+        s.connect(self.server.address)
+        try:
+            s.sendall("GET 1\n" * 2000 + "QUIT\n")
+            time.sleep(1)
+            # The replies fill the socket buffers and then the output buffer, and the next commands wait
+            stats = json.loads(self.control("STATS\n"))
+            assert stats["metrics"]["commands"]["GET"]["requests"] < 1000
+            assert ServerProcess.receive_all(s) == "OK\n%s\n" % line * 2000
+        finally:
+            s.close()
+
+    def test_commands_wait_while_the_thread_pool_does_not_answer(self):
+        catalog = GatedCatalog()
+        settings = {"num_of_connections_max": 10, "num_of_io_threads": 1, "output_buffer_max_bytes": 1024 * 1024}
+        server = EventLoopServer(catalog, settings, ("127.0.0.1", 0))
+        server.server_bind()
+        server.server_activate()
+        serving = threading.Thread(target=server.serve_forever)
+        serving.start()
+        s = socket.create_connection(server.server_address, 5)
+        try:
+            sending = threading.Thread(target=s.sendall, args=("GET 1\n" * 100000 + "QUIT\n",))
+            sending.start()
+            time.sleep(1)
+            # The first batch waits in the thread pool, and the connection is not read once a batch of commands waits
+            connection = server.connections.values()[0]
+            assert len(connection.commands) < server.max_batch_commands + server.recv_size / len("GET 1\n")
+            catalog.line_file.released.set()
+            assert ServerProcess.receive_all(s) == "OK\na\n" * 100000
+            sending.join()
+        finally:
+            catalog.line_file.released.set()
+            s.close()
+            server.shutdown()
+            server.server_close()
+            serving.join()
+
+
+class TestPreForkServer(TestServer):
+
+    server_mode = "prefork"
+    settings = {"num_of_worker_processes": 2}
+
+    def worker_pids(self):
+        with open("/proc/%d/task/%d/children" % (self.server.process.pid, self.server.process.pid)) as f:
+            return set(int(pid) for pid in f.read().split())
+
+    # Waits until the server has num_workers workers, none of them in dead_pids
+    def wait_for_workers(self, num_workers, dead_pids=set()):
+        for i in range(300):
+            pids = self.worker_pids()
+            if len(pids) == num_workers and not pids & dead_pids:
+                break
+            time.sleep(0.01)
+        return pids
+
+    def test_dead_worker_is_restarted(self):
+        pids = self.wait_for_workers(2)
+        assert len(pids) == 2
+        dead_pid = pids.pop()
+        os.kill(dead_pid, 9)
+        new_pids = self.wait_for_workers(2, set([dead_pid]))
+        assert len(new_pids) == 2 and pids < new_pids
+        assert self.server.send("GET 2\nQUIT\n") == "OK\nb\n"
+
+
+class TestPreForkReusePortServer(TestServer):
+
+    server_mode = "prefork"
+    settings = {"num_of_worker_processes": 2, "prefork_reuse_port": True}
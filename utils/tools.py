@@ -1,22 +1,120 @@
 
 import traceback
 import os
+import errno
 import sys
 import logging
 import re
+import fcntl
+import threading
+import Queue
+from contextlib import contextmanager
 
 
+# Log records are written to the log file and to stderr by a background thread (see QueueLoggingHandler),
+# so logging never makes a request wait for I/O.
 class LoggingUtil(object):
 
+    queue_handler = None
+
+    @classmethod
+    def init_logging(cls, level="INFO"):
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s")
+        handlers = [logging.FileHandler("{0}/{1}.log".format("../", "server")), logging.StreamHandler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        cls.queue_handler = QueueLoggingHandler(handlers)
+        root_logger = logging.getLogger()
+        root_logger.addHandler(cls.queue_handler)
+        root_logger.setLevel(getattr(logging, level))
+
+    # Waits until the records logged by this process are written, before a process exits
     @classmethod
-    def init_logging(cls):
-        logging.basicConfig(
-            format="%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s",
-            level=logging.INFO,
-            handlers=[
-                logging.FileHandler("{0}/{1}.log".format("../", "server")),
-                logging.StreamHandler()
-        ])
+    def flush(cls):
+        if cls.queue_handler is not None:
+            cls.queue_handler.flush()
+
+    # A lock held by a thread of the parent process when it forked is never released in the forked process, which
+    # would hang on its first log call. Called by a forked process before it logs anything.
+    @classmethod
+    def after_fork(cls):
+        if logging._lock is not None:
+            logging._lock = threading.RLock()
+        for handler_ref in logging._handlerList:
+            handler = handler_ref()
+            if handler is not None:
+                handler.createLock()
+        if cls.queue_handler is not None:
+            cls.queue_handler.start_lock = threading.Lock()
+
+
+# A logging handler which only puts records on a queue. A writer thread takes them off the queue and hands them to
+# the handlers doing the I/O, so a log call costs a queue put.
+# Messages are formatted by the writer thread, so log calls must not pass arguments which are changed afterwards.
+# Records are dropped and counted instead of blocking when the queue is full.
+# Threads do not survive a fork: a forked process gets a new queue and its own writer thread the first time it logs.
+# The threads of a process logging for the first time at once start a single writer.
+class QueueLoggingHandler(logging.Handler):
+
+    max_queue_size = 10000
+
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.dropped = 0
+
+    # Unlike Handler.handle, records are queued without taking the handler lock
+    def handle(self, record):
+        if not self.filter(record):
+            return False
+        self.emit(record)
+        return True
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.__start_writer()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def __start_writer(self):
+        # A handler lock held by a thread of the parent process would never be released in a forked process
+        for handler in self.handlers:
+            handler.createLock()
+        queue = Queue.Queue(self.max_queue_size)
+        writer = threading.Thread(target=self.__write, args=(queue,), name="LogWriter")
+        writer.daemon = True
+        self.queue = queue
+        self.pid = os.getpid()
+        writer.start()
+
+    def __write(self, queue):
+        while True:
+            record = queue.get()
+            try:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        self.flush()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
 
 
 class ErrorUtil(object):
@@ -56,3 +154,51 @@ class FileUtil(object):
         for f in os.listdir(folder):
             if re.search(file_regex, f):
                 os.remove(os.path.join(folder, f))
+
+
+# An exclusive lock shared by the threads of a process and by other processes, backed by fcntl.lockf on a lock file.
+# lockf locks are owned by the process, so they are not inherited by forked children.
+# A forked child also gets a new thread lock, in case the parent was holding it when forking.
+# The lock file is removed when the lock is released, so no lock file is left behind. A process which was waiting for
+# the lock of a removed file locks the file now at lock_file_path instead.
+class FileLock(object):
+
+    def __init__(self, lock_file_path):
+        self.lock_file_path = lock_file_path
+        self.thread_lock = threading.Lock()
+        self.pid = os.getpid()
+
+    @contextmanager
+    def hold(self):
+        if self.pid != os.getpid():
+            self.thread_lock = threading.Lock()
+            self.pid = os.getpid()
+        with self.thread_lock:
+            with self.__lock_file() as lock_file:
+                try:
+                    yield
+                finally:
+                    if self.__is_at_lock_file_path(lock_file):
+                        os.remove(self.lock_file_path)
+                    fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    # Opens and locks the lock file, until the file locked is still the file at lock_file_path
+    def __lock_file(self):
+        while True:
+            lock_file = open(self.lock_file_path, "a")
+            try:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX)
+                if self.__is_at_lock_file_path(lock_file):
+                    return lock_file
+            except:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def __is_at_lock_file_path(self, lock_file):
+        try:
+            return os.stat(self.lock_file_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False